@@ -1,19 +1,24 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from database import get_db, User, Note, Book, AbuseReport, UserRole
-from auth import get_current_admin
+from database import get_db, User, AbuseReport, UserRole
+from auth import get_current_admin, invalidate_principal, Principal
+from utils import paginate_keyset
+from pdf_processing import pdf_processor
+from ai_cache import ai_response_cache
+from ai_scheduler import ai_scheduler
+from analytics_rollups import daily_stats, SERIES_PERIODS
 
 admin_router = APIRouter(prefix="/api/admin")
 
 @admin_router.get("/users")
-async def get_all_users(
+def get_all_users(
     skip: int = 0,
     limit: int = 50,
-    current_admin: User = Depends(get_current_admin),
+    cursor: str = None,
+    current_admin: Principal = Depends(get_current_admin),
     db: Session = Depends(get_db)
 ):
-    users = db.query(User).offset(skip).limit(limit).all()
+    users, next_cursor = paginate_keyset(db.query(User), [User.id], cursor, limit, skip=skip, descending=False)
     
     result = []
     for user in users:
@@ -26,12 +31,12 @@ async def get_all_users(
             "created_at": user.created_at
         })
     
-    return {"users": result}
+    return {"users": result, "next_cursor": next_cursor}
 
 @admin_router.post("/users/{user_id}/block")
-async def block_user(
+def block_user(
     user_id: int,
-    current_admin: User = Depends(get_current_admin),
+    current_admin: Principal = Depends(get_current_admin),
     db: Session = Depends(get_db)
 ):
     user = db.query(User).filter(User.id == user_id).first()
@@ -40,13 +45,14 @@ async def block_user(
     
     user.is_blocked = True
     db.commit()
+    invalidate_principal(user_id)
     
     return {"message": "User blocked"}
 
 @admin_router.post("/users/{user_id}/unblock")
-async def unblock_user(
+def unblock_user(
     user_id: int,
-    current_admin: User = Depends(get_current_admin),
+    current_admin: Principal = Depends(get_current_admin),
     db: Session = Depends(get_db)
 ):
     user = db.query(User).filter(User.id == user_id).first()
@@ -55,13 +61,14 @@ async def unblock_user(
     
     user.is_blocked = False
     db.commit()
+    invalidate_principal(user_id)
     
     return {"message": "User unblocked"}
 
 @admin_router.post("/users/{user_id}/promote-premium")
-async def promote_to_premium(
+def promote_to_premium(
     user_id: int,
-    current_admin: User = Depends(get_current_admin),
+    current_admin: Principal = Depends(get_current_admin),
     db: Session = Depends(get_db)
 ):
     user = db.query(User).filter(User.id == user_id).first()
@@ -70,34 +77,63 @@ async def promote_to_premium(
     
     user.role = UserRole.PREMIUM
     db.commit()
+    invalidate_principal(user_id)
     
     return {"message": "User promoted to premium"}
 
 @admin_router.get("/analytics")
-async def get_analytics(
-    current_admin: User = Depends(get_current_admin),
+def get_analytics(
+    current_admin: Principal = Depends(get_current_admin),
     db: Session = Depends(get_db)
 ):
-    total_users = db.query(func.count(User.id)).scalar()
-    total_notes = db.query(func.count(Note.id)).scalar()
-    total_books = db.query(func.count(Book.id)).scalar()
-    total_earnings = db.query(func.sum(Note.earnings)).scalar() or 0
+    """Dashboard totals, summed from the daily rollups instead of four full-table aggregates.
+    
+    These count activity as it happened, not the rows that exist now: users
+    and notes/books are net of recorded deletes, and total_earnings keeps the
+    earnings of notes deleted since. A backfill resets them to what currently
+    exists. Read the source tables when an exact current count is needed.
+    """
+    totals = daily_stats.totals(db)
     
     return {
-        "total_users": total_users,
-        "total_notes": total_notes,
-        "total_books": total_books,
-        "total_earnings": round(total_earnings, 2)
+        "total_users": totals["signups"],
+        "total_notes": totals["notes_uploaded"] - totals["notes_deleted"],
+        "total_books": totals["books_listed"] - totals["books_deleted"],
+        "total_earnings": round(totals["earnings"], 2)
     }
 
+@admin_router.get("/analytics/series")
+def get_analytics_series(
+    period: str = "day",
+    buckets: int = None,
+    current_admin: Principal = Depends(get_current_admin),
+    db: Session = Depends(get_db)
+):
+    if period not in SERIES_PERIODS:
+        raise HTTPException(status_code=400, detail="period must be day, week or month")
+    
+    default_buckets, max_buckets = SERIES_PERIODS[period]
+    buckets = min(max(buckets or default_buckets, 1), max_buckets)
+    return {"period": period, "series": daily_stats.series(db, period, buckets)}
+
+@admin_router.post("/analytics/backfill")
+def backfill_analytics(current_admin: Principal = Depends(get_current_admin)):
+    days = daily_stats.backfill()
+    if days is None:
+        raise HTTPException(status_code=409, detail="A daily stats rebuild is already running")
+    return {"message": "Daily stats rebuilt", "days": days}
+
 @admin_router.get("/reports")
-async def get_abuse_reports(
+def get_abuse_reports(
     skip: int = 0,
     limit: int = 50,
-    current_admin: User = Depends(get_current_admin),
+    cursor: str = None,
+    current_admin: Principal = Depends(get_current_admin),
     db: Session = Depends(get_db)
 ):
-    reports = db.query(AbuseReport).offset(skip).limit(limit).all()
+    reports, next_cursor = paginate_keyset(
+        db.query(AbuseReport), [AbuseReport.id], cursor, limit, skip=skip, descending=False
+    )
     
     result = []
     for report in reports:
@@ -112,4 +148,16 @@ async def get_abuse_reports(
             "created_at": report.created_at
         })
     
-    return {"reports": result}
+    return {"reports": result, "next_cursor": next_cursor}
+
+@admin_router.get("/metrics/pdf")
+async def get_pdf_metrics(current_admin: Principal = Depends(get_current_admin)):
+    return pdf_processor.metrics()
+
+@admin_router.get("/metrics/ai-cache")
+async def get_ai_cache_metrics(current_admin: Principal = Depends(get_current_admin)):
+    return ai_response_cache.metrics()
+
+@admin_router.get("/metrics/ai-scheduler")
+async def get_ai_scheduler_metrics(current_admin: Principal = Depends(get_current_admin)):
+    return ai_scheduler.metrics()
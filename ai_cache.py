@@ -0,0 +1,90 @@
+import hashlib
+import re
+import threading
+import unicodedata
+from datetime import datetime, timedelta
+from typing import Optional
+from database import ChatLog
+from utils import TTLCache
+from config import get_settings
+
+settings = get_settings()
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_prompt(message: str) -> str:
+    """Fold case, whitespace and punctuation so trivially different questions share an answer"""
+    text = unicodedata.normalize("NFKC", message).casefold()
+    text = _PUNCTUATION.sub(" ", text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+class AIResponseCache:
+    """Reuses AI answers for repeated questions.
+    
+    Entries are keyed by the normalized prompt plus model and max_tokens, and
+    live in a TTL/LRU memory tier. With AI_CACHE_PERSISTENT on, a miss falls
+    back to recent ChatLog rows with the same prompt_hash, so answers survive
+    restarts and are shared between workers. Only answers the model actually
+    produced are reused: rows that were themselves cache hits, or that have
+    no tokens or no text, are skipped.
+    """
+    
+    def __init__(self):
+        self.ttl = settings.AI_CACHE_TTL_SECONDS
+        self.persistent = settings.AI_CACHE_PERSISTENT
+        self._entries = TTLCache(maxsize=settings.AI_CACHE_SIZE, ttl=self.ttl)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "persistent_hits": 0, "misses": 0}
+    
+    def key(self, message: str, model: str, max_tokens: int) -> str:
+        return hashlib.sha256(f"{model}\n{max_tokens}\n{normalize_prompt(message)}".encode()).hexdigest()
+    
+    def _hit(self, entry: dict, stat: str) -> dict:
+        with self._lock:
+            entry["hits"] += 1
+            self._stats[stat] += 1
+        return entry
+    
+    def get(self, prompt_hash: str) -> Optional[dict]:
+        """Memory tier only; cheap enough to call on the event loop"""
+        entry = self._entries.get(prompt_hash)
+        return self._hit(entry, "hits") if entry is not None else None
+    
+    def get_persistent(self, db, prompt_hash: str) -> Optional[dict]:
+        """Look up a recent answer in ChatLog and promote it to the memory tier"""
+        if self.persistent:
+            row = db.query(ChatLog.response, ChatLog.tokens_used).filter(
+                ChatLog.prompt_hash == prompt_hash,
+                ChatLog.created_at >= datetime.utcnow() - timedelta(seconds=self.ttl),
+                ChatLog.cached == False,
+                ChatLog.tokens_used > 0,
+                ChatLog.response != ""
+            ).order_by(ChatLog.created_at.desc()).first()
+            if row is not None:
+                entry = {"response": row.response, "tokens_used": row.tokens_used, "hits": 0}
+                self._entries.set(prompt_hash, entry)
+                return self._hit(entry, "persistent_hits")
+        
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+    
+    def set(self, prompt_hash: str, response: str, tokens_used: int):
+        self._entries.set(prompt_hash, {"response": response, "tokens_used": tokens_used, "hits": 0})
+    
+    def metrics(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["persistent_hits"] + stats["misses"]
+        top_entries = sorted(self._entries.items(), key=lambda item: item[1]["hits"], reverse=True)[:10]
+        return {
+            "entries": len(self._entries),
+            "hits": stats["hits"],
+            "persistent_hits": stats["persistent_hits"],
+            "misses": stats["misses"],
+            "hit_rate": round((stats["hits"] + stats["persistent_hits"]) / lookups, 4) if lookups else 0.0,
+            "top_entries": [{"prompt_hash": key[:16], "hits": entry["hits"]} for key, entry in top_entries]
+        }
+
+ai_response_cache = AIResponseCache()
@@ -0,0 +1,164 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable
+from fastapi import HTTPException
+from config import get_settings
+
+settings = get_settings()
+
+PRIORITY_LANE = 0
+NORMAL_LANE = 1
+LANE_NAMES = {PRIORITY_LANE: "priority", NORMAL_LANE: "normal"}
+
+class AIRequestScheduler:
+    """Admission control for upstream AI calls, per worker process.
+    
+    At most AI_MAX_CONCURRENT calls run at once and each user may have
+    AI_MAX_CONCURRENT_PER_USER running or waiting. Everyone else waits in a
+    bounded queue where the priority lane (premium users) is always served
+    first. A request is shed with 503 as soon as it is clear it cannot start
+    within AI_QUEUE_DEADLINE_SECONDS, instead of hanging until the client
+    gives up.
+    """
+    
+    def __init__(self):
+        self.max_concurrent = settings.AI_MAX_CONCURRENT
+        self.max_per_user = settings.AI_MAX_CONCURRENT_PER_USER
+        self.max_queue = settings.AI_MAX_QUEUE
+        self.deadline = settings.AI_QUEUE_DEADLINE_SECONDS
+        self._running = 0
+        self._per_user = defaultdict(int)
+        self._waiters = []  # heap of (lane, sequence, future)
+        self._waiting = {PRIORITY_LANE: 0, NORMAL_LANE: 0}
+        self._sequence = itertools.count()
+        # Moving average of upstream call time, used to predict queue waits
+        self._avg_service_seconds = 1.0
+        self._metrics = {
+            "completed": 0,
+            "shed_queue_full": 0,
+            "shed_deadline": 0,
+            "rejected_per_user": 0,
+            "wait_seconds_total": {PRIORITY_LANE: 0.0, NORMAL_LANE: 0.0},
+            "wait_seconds_max": {PRIORITY_LANE: 0.0, NORMAL_LANE: 0.0},
+            "admitted": {PRIORITY_LANE: 0, NORMAL_LANE: 0}
+        }
+    
+    def _shed(self, reason: str, detail: str):
+        self._metrics[reason] += 1
+        raise HTTPException(
+            status_code=503,
+            detail=detail,
+            headers={"Retry-After": str(max(int(self._avg_service_seconds), 1))}
+        )
+    
+    def _expected_wait(self, lane: int) -> float:
+        ahead = self._waiting[PRIORITY_LANE] if lane == PRIORITY_LANE else len(self._waiters)
+        return (ahead + 1) / self.max_concurrent * self._avg_service_seconds
+    
+    def _grant_next(self):
+        """Hand a free slot to the highest-priority waiter that is still waiting"""
+        while self._waiters and self._running < self.max_concurrent:
+            lane, _, future = heapq.heappop(self._waiters)
+            self._waiting[lane] -= 1
+            if not future.done():
+                self._running += 1
+                future.set_result(True)
+    
+    async def _acquire(self, lane: int):
+        if self._running < self.max_concurrent and not self._waiters:
+            self._running += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self._shed("shed_queue_full", "AI assistant is busy, try again shortly")
+        if self._expected_wait(lane) > self.deadline:
+            self._shed("shed_deadline", "AI assistant is busy, try again shortly")
+        
+        future = asyncio.get_running_loop().create_future()
+        entry = (lane, next(self._sequence), future)
+        heapq.heappush(self._waiters, entry)
+        self._waiting[lane] += 1
+        try:
+            await asyncio.wait_for(future, timeout=self.deadline)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # Granted a slot just as the wait ended: give it back
+                self._release_slot()
+            else:
+                # Still queued: leave the queue now, not when a slot next frees
+                self._remove_waiter(entry)
+            if isinstance(e, asyncio.TimeoutError):
+                self._shed("shed_deadline", "AI assistant is busy, try again shortly")
+            raise
+    
+    def _remove_waiter(self, entry):
+        self._waiters.remove(entry)
+        heapq.heapify(self._waiters)
+        self._waiting[entry[0]] -= 1
+    
+    def _release_slot(self):
+        self._running -= 1
+        self._grant_next()
+    
+    @asynccontextmanager
+    async def slot(self, user_id: int, premium: bool):
+        """Hold one upstream slot for the body; raises 429 or 503 if the request is rejected or shed"""
+        if self._per_user[user_id] >= self.max_per_user:
+            self._metrics["rejected_per_user"] += 1
+            raise HTTPException(status_code=429, detail="You already have AI requests in progress, wait for them to finish")
+        
+        lane = PRIORITY_LANE if premium else NORMAL_LANE
+        self._per_user[user_id] += 1
+        enqueued_at = time.monotonic()
+        try:
+            await self._acquire(lane)
+            waited = time.monotonic() - enqueued_at
+            self._metrics["admitted"][lane] += 1
+            self._metrics["wait_seconds_total"][lane] += waited
+            self._metrics["wait_seconds_max"][lane] = max(self._metrics["wait_seconds_max"][lane], waited)
+            
+            started_at = time.monotonic()
+            try:
+                yield
+            finally:
+                self._avg_service_seconds = 0.8 * self._avg_service_seconds + 0.2 * (time.monotonic() - started_at)
+                self._metrics["completed"] += 1
+                self._release_slot()
+        finally:
+            self._per_user[user_id] -= 1
+            if not self._per_user[user_id]:
+                del self._per_user[user_id]
+    
+    async def run(self, user_id: int, premium: bool, call: Callable[[], Awaitable]):
+        """Run `call()` once admitted; raises 429 or 503 if the request is rejected or shed"""
+        async with self.slot(user_id, premium):
+            return await call()
+    
+    def metrics(self) -> dict:
+        metrics = self._metrics
+        lanes = {}
+        for lane, name in LANE_NAMES.items():
+            admitted = metrics["admitted"][lane]
+            lanes[name] = {
+                "queued": self._waiting[lane],
+                "admitted": admitted,
+                "avg_wait_seconds": round(metrics["wait_seconds_total"][lane] / admitted, 4) if admitted else 0.0,
+                "max_wait_seconds": round(metrics["wait_seconds_max"][lane], 4)
+            }
+        return {
+            "running": self._running,
+            "max_concurrent": self.max_concurrent,
+            "queue_depth": len(self._waiters),
+            "max_queue": self.max_queue,
+            "avg_service_seconds": round(self._avg_service_seconds, 4),
+            "completed": metrics["completed"],
+            "shed_queue_full": metrics["shed_queue_full"],
+            "shed_deadline": metrics["shed_deadline"],
+            "rejected_per_user": metrics["rejected_per_user"],
+            "lanes": lanes
+        }
+
+ai_scheduler = AIRequestScheduler()
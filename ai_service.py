@@ -1,48 +1,278 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Tuple
 import httpx
 from config import get_settings
 from fastapi import HTTPException
 
 settings = get_settings()
 
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class CircuitBreaker:
+    """Fails fast after repeated upstream failures.
+    
+    After `failure_threshold` consecutive failures the breaker opens and
+    rejects calls for `reset_timeout` seconds. Then one trial call is let
+    through (half-open): success closes the breaker, failure re-opens it.
+    """
+    
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+    
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+    
+    def retry_after(self) -> int:
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            return max(int(self.reset_timeout - (time.monotonic() - self._opened_at)) + 1, 1)
+    
+    def allow(self) -> bool:
+        return self.acquire()[0]
+    
+    def acquire(self) -> Tuple[bool, bool]:
+        """(allowed, whether this call holds the half-open trial and must settle or release it)"""
+        with self._lock:
+            if self._opened_at is None:
+                return True, False
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                return False, False
+            self._trial_in_flight = True
+            return True, True
+    
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+    
+    def release(self):
+        """Give back a half-open trial slot whose call never finished (e.g. cancelled)"""
+        with self._lock:
+            self._trial_in_flight = False
+    
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+def parse_retry_after(value: str):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date), or None"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
 class AIService:
     def __init__(self):
         self.api_key = settings.GROQ_API_KEY
         self.base_url = "https://api.groq.com/openai/v1/chat/completions"
         self.model = "llama-3.3-70b-versatile"
+        self.max_tokens = 500
+        self.max_message_chars = 2000
+        self.max_retries = settings.AI_MAX_RETRIES
+        self.breaker = CircuitBreaker(settings.AI_BREAKER_FAILURE_THRESHOLD, settings.AI_BREAKER_RESET_SECONDS)
+        self._client = None
     
-    async def chat(self, message: str, max_tokens: int = 500) -> dict:
-        """Send message to AI and get response"""
-        if len(message) > 2000:
-            raise HTTPException(status_code=400, detail="Message too long (max 2000 characters)")
-        
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
+    def _create_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            http2=settings.AI_HTTP2,
+            timeout=httpx.Timeout(settings.AI_REQUEST_TIMEOUT_SECONDS, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=settings.AI_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.AI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.AI_KEEPALIVE_EXPIRY_SECONDS
+            ),
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
+            }
+        )
+    
+    async def start(self):
+        """Open the shared upstream client; called from the app lifespan"""
+        if self._client is None:
+            self._client = self._create_client()
+    
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Scripts and tests may call chat() without the app lifespan having run
+        if self._client is None:
+            self._client = self._create_client()
+        return self._client
+    
+    def _retry_delay(self, attempt: int, response: httpx.Response = None) -> float:
+        retry_after = parse_retry_after(response.headers.get("retry-after")) if response is not None else None
+        if retry_after is None:
+            # Full jitter keeps a burst of failed requests from retrying in lockstep
+            retry_after = random.uniform(0, settings.AI_RETRY_BACKOFF_SECONDS * 2 ** attempt)
+        return min(retry_after, settings.AI_RETRY_MAX_DELAY_SECONDS)
+    
+    def _check_breaker(self) -> bool:
+        """Raise 503 while the breaker is open; returns whether this call holds the half-open trial"""
+        allowed, trial = self.breaker.acquire()
+        if not allowed:
+            raise HTTPException(
+                status_code=503,
+                detail="AI service temporarily unavailable, try again shortly",
+                headers={"Retry-After": str(self.breaker.retry_after())}
+            )
+        return trial
+    
+    async def _post(self, payload: dict) -> dict:
+        """POST with retries on 429/5xx and transport errors, tracked by the circuit breaker"""
+        trial = self._check_breaker()
+        try:
+            response = await self._send_with_retries(payload)
+        finally:
+            # Cancellation or an unexpected error must not leave a half-open trial
+            # hanging; calls that never held the trial must not free someone else's
+            if trial:
+                self.breaker.release()
+        try:
+            return response.json()
+        except ValueError:
+            raise HTTPException(status_code=502, detail="AI service returned invalid JSON")
+    
+    async def _send_with_retries(self, payload: dict, stream: bool = False) -> httpx.Response:
+        """Send until a successful status; with `stream` the body is left unread for the caller"""
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            try:
+                request = self.client.build_request("POST", self.base_url, json=payload)
+                response = await self.client.send(request, stream=stream)
+            except httpx.TransportError as e:
+                if last_attempt:
+                    self.breaker.record_failure()
+                    raise HTTPException(status_code=502, detail=f"AI service error: {str(e)}")
+                await asyncio.sleep(self._retry_delay(attempt))
+                continue
+            
+            if response.status_code in RETRYABLE_STATUS_CODES:
+                await response.aclose()
+                if last_attempt:
+                    if response.status_code == 429:
+                        # Rate limited, not down: leave the breaker as it is, so
+                        # this neither trips it nor closes a half-open one
+                        raise HTTPException(
+                            status_code=503,
+                            detail="AI service is busy, try again shortly",
+                            headers={"Retry-After": str(int(self._retry_delay(attempt, response)) or 1)}
+                        )
+                    self.breaker.record_failure()
+                    raise HTTPException(status_code=502, detail=f"AI service error: HTTP {response.status_code}")
+                await asyncio.sleep(self._retry_delay(attempt, response))
+                continue
+            
+            self.breaker.record_success()
+            if response.is_error:
+                await response.aclose()
+                raise HTTPException(status_code=502, detail=f"AI service error: HTTP {response.status_code}")
+            return response
+    
+    def check_message(self, message: str):
+        """Reject messages the model should not be sent; routes call this before taking quota"""
+        if len(message) > self.max_message_chars:
+            raise HTTPException(status_code=400, detail=f"Message too long (max {self.max_message_chars} characters)")
+    
+    def _payload(self, message: str, max_tokens: int = None) -> dict:
+        return {
             "model": self.model,
             "messages": [
                 {"role": "system", "content": "You are a helpful AI assistant for students. Help them with their studies, homework, and learning."},
                 {"role": "user", "content": message}
             ],
-            "max_tokens": max_tokens,
+            "max_tokens": max_tokens or self.max_tokens,
             "temperature": 0.7
         }
+    
+    async def chat(self, message: str, max_tokens: int = None) -> dict:
+        """Send message to AI and get response"""
+        data = await self._post(self._payload(message, max_tokens))
+        try:
+            return {
+                "response": data["choices"][0]["message"]["content"],
+                "tokens_used": data.get("usage", {}).get("total_tokens", 0)
+            }
+        except (KeyError, IndexError, TypeError) as e:
+            raise HTTPException(status_code=502, detail=f"Unexpected AI response: {str(e)}")
+    
+    async def chat_stream(self, message: str, max_tokens: int = None):
+        """Yield {"delta": text} as the model generates, then {"tokens_used": n, "finished": bool}.
         
+        Errors before the first byte (limits, breaker, upstream status) raise
+        HTTPException like chat(); only that part is retried. A stream that
+        breaks off later raises HTTPException 502 from the iterator.
+        """
+        payload = self._payload(message, max_tokens)
+        payload["stream"] = True
+        
+        trial = self._check_breaker()
+        try:
+            response = await self._send_with_retries(payload, stream=True)
+        finally:
+            if trial:
+                self.breaker.release()
+        
+        tokens_used = None
+        finished = False
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(self.base_url, json=payload, headers=headers)
-                response.raise_for_status()
-                data = response.json()
-                
-                return {
-                    "response": data["choices"][0]["message"]["content"],
-                    "tokens_used": data.get("usage", {}).get("total_tokens", 0)
-                }
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    finished = True
+                    break
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    continue
+                # Groq reports usage on the last chunk under x_groq; OpenAI-style APIs use "usage"
+                usage = chunk.get("usage") or chunk.get("x_groq", {}).get("usage")
+                if usage:
+                    tokens_used = usage.get("total_tokens", tokens_used)
+                for choice in chunk.get("choices") or ():
+                    content = (choice.get("delta") or {}).get("content")
+                    if content:
+                        yield {"delta": content}
+                    if choice.get("finish_reason"):
+                        finished = True
         except httpx.HTTPError as e:
-            raise HTTPException(status_code=500, detail=f"AI service error: {str(e)}")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+            raise HTTPException(status_code=502, detail=f"AI stream interrupted: {str(e)}")
+        finally:
+            await response.aclose()
+        
+        yield {"tokens_used": tokens_used, "finished": finished}
 
 ai_service = AIService()
@@ -0,0 +1,312 @@
+import asyncio
+import threading
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import event, func, or_, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from database import SessionLocal, DailyStat, RollupState, User, Note, Book, NoteDownload, ChatLog
+from config import get_settings
+
+settings = get_settings()
+
+ROLLUP_FIELDS = (
+    "signups", "notes_uploaded", "notes_deleted", "books_listed", "books_deleted",
+    "downloads", "earnings", "ai_messages", "ai_tokens"
+)
+DOWNLOAD_EARNINGS = 0.1  # credited per first download, see download_note
+# period -> (default buckets, max buckets)
+SERIES_PERIODS = {"day": (30, 366), "week": (12, 104), "month": (12, 60)}
+PENDING_DELTAS_KEY = "pending_daily_stats"
+
+def _month_start(day: date, months_back: int = 0) -> date:
+    month_index = day.year * 12 + day.month - 1 - months_back
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+def _empty_day() -> Dict[str, float]:
+    return dict.fromkeys(ROLLUP_FIELDS, 0)
+
+class DailyStatsRollup:
+    """Keeps daily_stats in step with the tables the admin dashboard reports on.
+    
+    Writes call `record` inside their own transaction; the deltas reach an
+    in-memory buffer only when that transaction commits, and a background
+    task upserts the buffer every DAILY_STATS_FLUSH_INTERVAL_SECONDS. Writes
+    therefore never queue on the lock of the day's single hot row. A failed
+    flush puts its deltas back and shutdown flushes the rest, as with the
+    engagement counters. Totals and series add this worker's unflushed
+    deltas, so other workers' activity shows up one interval late.
+    
+    `backfill` rebuilds the rows from the source tables, for the first deploy
+    or after a suspected drift. Only one worker rebuilds at a time, under a
+    lease on the rollup_state row, and the time the rebuild read the source
+    tables is stored there. Every worker's flush drops buffered deltas that
+    committed before that time, since the rebuild already counted them.
+    Buffered deltas are kept per second, so writes committed within a second
+    of the rebuild's read may be counted twice; this assumes worker clocks agree.
+    """
+    
+    NAME = "daily_stats"
+    
+    def __init__(self):
+        self.flush_interval = settings.DAILY_STATS_FLUSH_INTERVAL_SECONDS
+        self.rebuild_lease = timedelta(seconds=settings.DAILY_STATS_REBUILD_LEASE_SECONDS)
+        # (day, second the deltas committed in) -> deltas
+        self._deltas: Dict[Tuple[date, datetime], Dict[str, float]] = defaultdict(_empty_day)
+        self._rebuilt_at = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._task = None
+    
+    def record(self, db, **deltas):
+        """Add deltas to today's row once the caller commits, e.g. record(db, signups=1)"""
+        deltas = {field: delta for field, delta in deltas.items() if delta}
+        if deltas:
+            db.info.setdefault(PENDING_DELTAS_KEY, []).append((datetime.utcnow().date(), deltas))
+    
+    def _add(self, day: date, deltas: Dict[str, float]):
+        committed_at = datetime.utcnow().replace(microsecond=0)
+        self._merge_back({(day, committed_at): deltas})
+    
+    def _merge_back(self, batch: Dict[Tuple[date, datetime], Dict[str, float]]):
+        with self._lock:
+            for key, deltas in batch.items():
+                buffered = self._deltas[key]
+                for field, delta in deltas.items():
+                    buffered[field] += delta
+    
+    def _by_day(self, batch, rebuilt_at) -> Dict[date, Dict[str, float]]:
+        """Sum a batch per day, leaving out deltas committed before the last rebuild read the tables"""
+        days = defaultdict(_empty_day)
+        for (day, committed_at), deltas in batch.items():
+            # The key is the start of the second the deltas committed in
+            if rebuilt_at is not None and committed_at + timedelta(seconds=1) <= rebuilt_at:
+                continue
+            for field, delta in deltas.items():
+                days[day][field] += delta
+        return days
+    
+    def pending(self) -> Dict[date, Dict[str, float]]:
+        """The deltas not flushed yet, by day"""
+        with self._lock:
+            return self._by_day(self._deltas, self._rebuilt_at)
+    
+    def _upsert(self, db, day: date, values: Dict[str, float], replace: bool = False):
+        """Add `values` to the day's row, or overwrite it with them when `replace` is set"""
+        statement = mysql_insert(DailyStat).values(day=day, **values)
+        db.execute(statement.on_duplicate_key_update({
+            field: statement.inserted[field] if replace else getattr(DailyStat, field) + statement.inserted[field]
+            for field in values
+        }))
+    
+    def _state(self, db, lock: bool = False):
+        """The rollup_state row, created on first use; `lock` takes it FOR UPDATE"""
+        if db.get(RollupState, self.NAME) is None:
+            try:
+                db.add(RollupState(name=self.NAME))
+                db.commit()
+            except IntegrityError:
+                # Another worker created it first
+                db.rollback()
+        query = db.query(RollupState).filter(RollupState.name == self.NAME)
+        return query.with_for_update().one() if lock else query.one()
+    
+    def flush(self) -> int:
+        """Write all buffered deltas to daily_stats; returns the number of days updated"""
+        with self._flush_lock:
+            with self._lock:
+                batch = self._deltas
+                self._deltas = defaultdict(_empty_day)
+            
+            if not batch:
+                return 0
+            
+            db = SessionLocal()
+            try:
+                self._state(db)
+                # A shared lock on the state row waits out a rebuild in progress,
+                # so the cutoff read here is the one the rebuild commits
+                rebuilt_at = db.query(RollupState.rebuilt_at).filter(
+                    RollupState.name == self.NAME
+                ).with_for_update(read=True).scalar()
+                with self._lock:
+                    self._rebuilt_at = rebuilt_at
+                days = self._by_day(batch, rebuilt_at)
+                for day, deltas in days.items():
+                    deltas = {field: delta for field, delta in deltas.items() if delta}
+                    if deltas:
+                        self._upsert(db, day, deltas)
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                self._merge_back(batch)
+                print(f"❌ Daily stats flush failed, {len(batch)} batches re-queued: {e}")
+                raise
+            finally:
+                db.close()
+            return len(days)
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception:
+                pass
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Stop the background flusher and write out everything still buffered"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            await asyncio.to_thread(self.flush)
+        except Exception:
+            pass
+    
+    def totals(self, db) -> dict:
+        sums = dict(zip(ROLLUP_FIELDS, db.query(*[func.coalesce(func.sum(getattr(DailyStat, field)), 0) for field in ROLLUP_FIELDS]).one()))
+        # MySQL returns SUM() as Decimal
+        totals = {field: float(total) if field == "earnings" else int(total) for field, total in sums.items()}
+        for deltas in self.pending().values():
+            for field, delta in deltas.items():
+                totals[field] += delta
+        totals["earnings"] = round(totals["earnings"], 2)
+        return totals
+    
+    def series(self, db, period: str, buckets: int) -> List[dict]:
+        """Per-day, week (from Monday) or month totals for the last `buckets` periods, oldest first"""
+        today = datetime.utcnow().date()
+        if period == "day":
+            bucket_of = lambda day: day
+            starts = [today - timedelta(days=back) for back in range(buckets - 1, -1, -1)]
+        elif period == "week":
+            bucket_of = lambda day: day - timedelta(days=day.weekday())
+            starts = [bucket_of(today) - timedelta(weeks=back) for back in range(buckets - 1, -1, -1)]
+        else:
+            bucket_of = _month_start
+            starts = [_month_start(today, back) for back in range(buckets - 1, -1, -1)]
+        
+        totals = {start: _empty_day() for start in starts}
+        days = [(row.day, {field: getattr(row, field) for field in ROLLUP_FIELDS}) for row in db.query(DailyStat).filter(DailyStat.day >= starts[0])]
+        days += [(day, deltas) for day, deltas in self.pending().items() if day >= starts[0]]
+        for day, values in days:
+            bucket = totals[bucket_of(day)]
+            for field in ROLLUP_FIELDS:
+                bucket[field] += values[field]
+        
+        return [
+            {"start": start, **values, "earnings": round(values["earnings"], 2)}
+            for start, values in totals.items()
+        ]
+    
+    def _claim(self, db) -> bool:
+        """Take the rebuild lease; False while another worker's rebuild holds it"""
+        self._state(db)
+        now = datetime.utcnow()
+        claimed = db.execute(
+            update(RollupState)
+            .where(
+                RollupState.name == self.NAME,
+                or_(RollupState.locked_until.is_(None), RollupState.locked_until < now)
+            )
+            .values(locked_until=now + self.rebuild_lease)
+            .execution_options(synchronize_session=False)
+        ).rowcount == 1
+        db.commit()
+        return claimed
+    
+    def _release(self, db):
+        db.rollback()
+        db.execute(
+            update(RollupState).where(RollupState.name == self.NAME).values(locked_until=None)
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+    
+    def backfill(self, only_if_never_built: bool = False) -> Optional[int]:
+        """Rebuild every day from the source tables; returns how many days have activity.
+        
+        Returns None without rebuilding when another worker's rebuild holds the
+        lease, or with `only_if_never_built` when a rebuild has already run.
+        Each day's row is overwritten in place rather than deleted, and days
+        with no activity left are zeroed. Deleted notes and books leave no
+        trace, so rebuilt days count what still exists: the rebuilt earnings
+        exclude deleted notes, whose downloads are deleted with them.
+        """
+        db = SessionLocal()
+        try:
+            if not self._claim(db):
+                return None
+            try:
+                # Held until commit: flushes wait here and then read the new cutoff
+                state = self._state(db, lock=True)
+                if only_if_never_built and state.rebuilt_at is not None:
+                    self._release(db)
+                    return None
+                
+                rebuilt_at = datetime.utcnow()
+                days = defaultdict(_empty_day)
+                sources = (
+                    ("signups", User.id, User.created_at),
+                    ("notes_uploaded", Note.id, Note.created_at),
+                    ("books_listed", Book.id, Book.created_at),
+                    ("downloads", NoteDownload.id, NoteDownload.downloaded_at),
+                    ("ai_messages", ChatLog.id, ChatLog.created_at)
+                )
+                for field, id_column, created_column in sources:
+                    day_column = func.date(created_column)
+                    for day, count in db.query(day_column, func.count(id_column)).filter(created_column.isnot(None)).group_by(day_column):
+                        days[day][field] = count
+                
+                day_column = func.date(ChatLog.created_at)
+                for day, tokens in db.query(day_column, func.sum(ChatLog.tokens_used)).filter(ChatLog.created_at.isnot(None)).group_by(day_column):
+                    days[day]["ai_tokens"] = int(tokens or 0)
+                
+                rebuilt = {}
+                for day, values in days.items():
+                    values["earnings"] = round(values["downloads"] * DOWNLOAD_EARNINGS, 2)
+                    rebuilt[date.fromisoformat(day) if isinstance(day, str) else day] = values
+                for (day,) in db.query(DailyStat.day):
+                    rebuilt.setdefault(day, _empty_day())
+                for day, values in rebuilt.items():
+                    self._upsert(db, day, values, replace=True)
+                
+                state.rebuilt_at = rebuilt_at
+                state.locked_until = None
+                db.commit()
+            except BaseException:
+                self._release(db)
+                raise
+            
+            with self._lock:
+                self._rebuilt_at = rebuilt_at
+            return sum(1 for values in rebuilt.values() if any(values.values()))
+        finally:
+            db.close()
+    
+    def run_backfill_if_empty(self):
+        """Startup job: build the rollups the first time, on whichever worker claims the rebuild"""
+        try:
+            days = self.backfill(only_if_never_built=True)
+        except Exception as e:
+            print(f"❌ Daily stats backfill failed: {e}")
+            return
+        if days is not None:
+            print(f"📊 Backfilled daily stats for {days} days")
+
+daily_stats = DailyStatsRollup()
+
+@event.listens_for(Session, "after_commit")
+def _buffer_committed_deltas(session):
+    for day, deltas in session.info.pop(PENDING_DELTAS_KEY, []):
+        daily_stats._add(day, deltas)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending_deltas(session):
+    session.info.pop(PENDING_DELTAS_KEY, None)
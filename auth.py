@@ -4,51 +4,229 @@ from jose import JWTError, jwt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
-from database import get_db, User, TokenBlacklist
+from database import get_db, SessionLocal, User, TokenBlacklist
 from config import get_settings
+from utils import TTLCache
+import asyncio
+import hashlib
+import threading
+import time
+import uuid
 
 settings = get_settings()
 security = HTTPBearer()
 
+class RevokedTokenFilter:
+    """In-process set of revoked token ids, kept in sync with token_blacklist.
+    
+    Checks never hit the database. New revocations from other workers are
+    picked up by an incremental load every TOKEN_REVOCATION_REFRESH_SECONDS,
+    and a periodic full reload drops expired entries. The incremental load
+    re-reads rows blacklisted since TOKEN_REVOCATION_SKEW_SECONDS before the
+    previous load started, so a row that commits after a later-numbered one
+    (or on a worker whose clock lags) is still picked up.
+    """
+    
+    def __init__(self):
+        self.revoked = {}  # jti -> expires_at
+        self.last_loaded_at = None
+        self.next_refresh = 0.0
+        self.next_full_reload = 0.0
+        self._lock = threading.Lock()
+    
+    def _refresh(self, db: Session):
+        now = datetime.utcnow()
+        monotonic_now = time.monotonic()
+        query = db.query(TokenBlacklist.jti, TokenBlacklist.expires_at).filter(
+            TokenBlacklist.expires_at > now
+        )
+        
+        if monotonic_now >= self.next_full_reload or self.last_loaded_at is None:
+            revoked = {row.jti: row.expires_at for row in query.all()}
+            self.next_full_reload = monotonic_now + settings.TOKEN_REVOCATION_FULL_RELOAD_SECONDS
+        else:
+            since = self.last_loaded_at - timedelta(seconds=settings.TOKEN_REVOCATION_SKEW_SECONDS)
+            rows = query.filter(TokenBlacklist.blacklisted_at >= since).all()
+            revoked = {jti: expires_at for jti, expires_at in self.revoked.items() if expires_at > now}
+            revoked.update({row.jti: row.expires_at for row in rows})
+        
+        self.revoked = revoked
+        self.last_loaded_at = now
+        self.next_refresh = monotonic_now + settings.TOKEN_REVOCATION_REFRESH_SECONDS
+    
+    def is_revoked(self, jti: str, db: Session) -> bool:
+        if time.monotonic() >= self.next_refresh:
+            with self._lock:
+                if time.monotonic() >= self.next_refresh:
+                    try:
+                        self._refresh(db)
+                    except Exception as e:
+                        if self.last_loaded_at is None:
+                            # Nothing loaded yet: an empty set would let every revoked token through
+                            raise
+                        # Keep serving the last good set and wait a full interval
+                        # instead of retrying on every request
+                        self.next_refresh = time.monotonic() + settings.TOKEN_REVOCATION_REFRESH_SECONDS
+                        print(f"⚠️ Revoked token refresh failed, using the set loaded at {self.last_loaded_at}: {e}")
+        return jti in self.revoked
+    
+    def add(self, jti: str, expires_at: datetime):
+        # A refresh rebuilds the dict from the old one; the lock keeps this entry from being dropped
+        with self._lock:
+            self.revoked[jti] = expires_at
+
+revoked_tokens = RevokedTokenFilter()
+
+class Principal:
+    """Authenticated user as most routes need it: enough to authorize without loading the ORM User"""
+    
+    def __init__(self, id: int, role, is_blocked: bool, name: str):
+        self.id = id
+        self.role = role
+        self.is_blocked = is_blocked
+        self.name = name
+
+# sha256(token) -> verified payload, so repeat requests skip signature verification
+token_payload_cache = TTLCache(maxsize=settings.TOKEN_PAYLOAD_CACHE_SIZE, ttl=settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+# user id -> Principal; admin actions invalidate entries through principal_invalidations
+principal_cache = TTLCache(maxsize=settings.TOKEN_PAYLOAD_CACHE_SIZE, ttl=settings.PRINCIPAL_CACHE_TTL_SECONDS)
+
+class PrincipalInvalidations:
+    """Drops a user's cached Principal after an admin changes the user.
+    
+    Without Redis only this worker's entry is dropped and the others converge
+    within PRINCIPAL_CACHE_TTL_SECONDS. With REDIS_URL set the user id is
+    published on a pub/sub channel, so a block takes effect on every worker.
+    """
+    
+    CHANNEL = "principal_invalidations"
+    
+    def __init__(self, redis_url: str = ""):
+        self.redis_url = redis_url
+        self.redis = None
+        if redis_url:
+            import redis
+            self.redis = redis.Redis.from_url(redis_url)
+        self._listener = None
+    
+    def invalidate(self, user_id: int):
+        principal_cache.pop(user_id)
+        if self.redis is not None:
+            try:
+                self.redis.publish(self.CHANNEL, user_id)
+            except Exception as e:
+                print(f"❌ Failed to publish principal invalidation for user {user_id}: {e}")
+    
+    def _dispatch(self, message):
+        principal_cache.pop(int(message))
+    
+    async def _listen(self):
+        import redis.asyncio
+        client = redis.asyncio.Redis.from_url(self.redis_url)
+        try:
+            while True:
+                try:
+                    async with client.pubsub() as pubsub:
+                        await pubsub.subscribe(self.CHANNEL)
+                        async for message in pubsub.listen():
+                            if message["type"] == "message":
+                                self._dispatch(message["data"])
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"⚠️ Principal invalidation channel lost, reconnecting: {e}")
+                    # Entries cached while disconnected may have missed a block
+                    principal_cache.clear()
+                    await asyncio.sleep(1)
+        finally:
+            await client.aclose()
+    
+    async def start(self):
+        if self.redis_url:
+            self._listener = asyncio.create_task(self._listen())
+    
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+
+principal_invalidations = PrincipalInvalidations(settings.REDIS_URL)
+
+def invalidate_principal(user_id: int):
+    principal_invalidations.invalidate(user_id)
+
+def token_jti(payload: dict, token: str) -> str:
+    """Token id used for revocation; tokens issued before jti existed fall back to their hash"""
+    return payload.get("jti") or hashlib.sha256(token.encode()).hexdigest()
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire, "type": "access"})
+    to_encode.update({"exp": expire, "type": "access", "jti": uuid.uuid4().hex})
     return jwt.encode(to_encode, settings.JWT_SECRET, algorithm=settings.JWT_ALGORITHM)
 
 def create_refresh_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)
-    to_encode.update({"exp": expire, "type": "refresh"})
+    to_encode.update({"exp": expire, "type": "refresh", "jti": uuid.uuid4().hex})
     return jwt.encode(to_encode, settings.JWT_SECRET, algorithm=settings.JWT_ALGORITHM)
 
 def verify_token(token: str, db: Session):
-    # Check if token is blacklisted
-    blacklisted = db.query(TokenBlacklist).filter(TokenBlacklist.token == token).first()
-    if blacklisted:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has been revoked")
-    
     try:
         payload = jwt.decode(token, settings.JWT_SECRET, algorithms=[settings.JWT_ALGORITHM])
-        return payload
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
-    token = credentials.credentials
-    payload = verify_token(token, db)
     
-    if payload.get("type") != "access":
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token type")
+    # Check if token is blacklisted
+    if revoked_tokens.is_revoked(token_jti(payload, token), db):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has been revoked")
+    
+    return payload
+
+def _access_token_user_id(token: str, db: Session) -> int:
+    """Verify an access token (using the payload cache) and return its user id"""
+    cache_key = hashlib.sha256(token.encode()).hexdigest()
+    payload = token_payload_cache.get(cache_key)
     
-    user_id = payload.get("sub")
-    if user_id is None:
+    if payload is None:
+        payload = verify_token(token, db)
+        if payload.get("type") != "access":
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token type")
+        if payload.get("sub") is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+        token_payload_cache.set(cache_key, payload, ttl=max(payload["exp"] - time.time(), 0))
+    elif payload["exp"] <= time.time():
+        token_payload_cache.pop(cache_key)
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    elif revoked_tokens.is_revoked(token_jti(payload, token), db):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has been revoked")
+    
+    return int(payload["sub"])
+
+def get_current_principal(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+    user_id = _access_token_user_id(credentials.credentials, db)
+    
+    principal = principal_cache.get(user_id)
+    if principal is None:
+        row = db.query(User.id, User.role, User.is_blocked, User.name).filter(User.id == user_id).first()
+        if row is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        principal = Principal(row.id, row.role, row.is_blocked, row.name)
+        principal_cache.set(user_id, principal)
     
-    user = db.query(User).filter(User.id == int(user_id)).first()
+    if principal.is_blocked:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User is blocked")
+    
+    return principal
+
+def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+    """Full ORM User, for routes that read profile fields or mutate the user row"""
+    user_id = _access_token_user_id(credentials.credentials, db)
+    
+    user = db.query(User).filter(User.id == user_id).first()
     if user is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     
@@ -57,14 +235,43 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
     
     return user
 
-def get_current_admin(current_user: User = Depends(get_current_user)):
+def get_current_admin(current_user: Principal = Depends(get_current_principal)):
     if current_user.role != "admin":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
     return current_user
 
 def blacklist_token(token: str, db: Session):
-    existing = db.query(TokenBlacklist).filter(TokenBlacklist.token == token).first()
+    try:
+        payload = jwt.decode(
+            token, settings.JWT_SECRET, algorithms=[settings.JWT_ALGORITHM], options={"verify_exp": False}
+        )
+    except JWTError:
+        # Tokens that don't verify can't authenticate anyway
+        return
+    
+    expires_at = datetime.utcfromtimestamp(payload["exp"]) if "exp" in payload else (
+        datetime.utcnow() + timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)
+    )
+    if expires_at <= datetime.utcnow():
+        return
+    
+    jti = token_jti(payload, token)
+    existing = db.query(TokenBlacklist.id).filter(TokenBlacklist.jti == jti).first()
     if not existing:
-        blacklisted = TokenBlacklist(token=token)
+        blacklisted = TokenBlacklist(jti=jti, expires_at=expires_at)
         db.add(blacklisted)
         db.commit()
+    revoked_tokens.add(jti, expires_at)
+
+def purge_expired_revocations():
+    """Delete blacklist rows for tokens that have expired on their own"""
+    db = SessionLocal()
+    try:
+        deleted = db.query(TokenBlacklist).filter(
+            TokenBlacklist.expires_at <= datetime.utcnow()
+        ).delete(synchronize_session=False)
+        db.commit()
+        if deleted:
+            print(f"🧹 Purged {deleted} expired token revocations")
+    finally:
+        db.close()
@@ -12,21 +12,43 @@ class Settings(BaseSettings):
     DB_PASSWORD: str
     DB_NAME: str
     DB_PORT: int = 3306
+    DB_POOL_SIZE: int = 20
+    DB_MAX_OVERFLOW: int = 20
+    # Worker threads for sync route handlers; keep close to the DB pool size
+    DB_THREADPOOL_SIZE: int = 40
     
     # JWT
     JWT_SECRET: str
     JWT_ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
     REFRESH_TOKEN_EXPIRE_DAYS: int = 7
+    TOKEN_REVOCATION_REFRESH_SECONDS: int = 10
+    TOKEN_REVOCATION_FULL_RELOAD_SECONDS: int = 300
+    # Overlap re-read by each incremental revocation load (slow commits, worker clock drift)
+    TOKEN_REVOCATION_SKEW_SECONDS: int = 60
+    TOKEN_BLACKLIST_PURGE_INTERVAL_MINUTES: int = 60
+    PRINCIPAL_CACHE_TTL_SECONDS: int = 30
+    TOKEN_PAYLOAD_CACHE_SIZE: int = 10000
     
     # Google OAuth
     GOOGLE_CLIENT_ID: str
     
-    # AWS S3
-    AWS_REGION: str
-    AWS_ACCESS_KEY_ID: str
-    AWS_SECRET_ACCESS_KEY: str
-    AWS_S3_BUCKET: str
+    # Storage: "s3", or "local" to keep files on disk and serve them from the app
+    STORAGE_BACKEND: str = "s3"
+    LOCAL_STORAGE_DIR: str = "storage"
+    LOCAL_STORAGE_SIGNING_KEY: str = ""  # defaults to a key derived from JWT_SECRET
+    
+    # AWS S3 (required when STORAGE_BACKEND is "s3")
+    AWS_REGION: str = ""
+    AWS_ACCESS_KEY_ID: str = ""
+    AWS_SECRET_ACCESS_KEY: str = ""
+    AWS_S3_BUCKET: str = ""
+    PRESIGNED_URL_CACHE_SIZE: int = 10000
+    
+    # Deletion outbox and orphan reconciliation
+    STORAGE_DELETION_INTERVAL_SECONDS: int = 10
+    STORAGE_RECONCILE_INTERVAL_HOURS: int = 24
+    STORAGE_RECONCILE_GRACE_HOURS: int = 24
     
     # OpenRouter
     OPENROUTER_API_KEY: str
@@ -34,17 +56,85 @@ class Settings(BaseSettings):
     # Groq AI
     GROQ_API_KEY: str
     
+    # Groq HTTP client
+    AI_HTTP2: bool = True
+    AI_MAX_CONNECTIONS: int = 50
+    AI_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    AI_KEEPALIVE_EXPIRY_SECONDS: float = 60
+    AI_REQUEST_TIMEOUT_SECONDS: float = 30
+    AI_MAX_RETRIES: int = 2
+    AI_RETRY_BACKOFF_SECONDS: float = 0.5
+    AI_RETRY_MAX_DELAY_SECONDS: float = 10
+    AI_BREAKER_FAILURE_THRESHOLD: int = 5
+    AI_BREAKER_RESET_SECONDS: float = 30
+    
+    # AI request scheduler (per worker process)
+    AI_MAX_CONCURRENT: int = 8
+    AI_MAX_CONCURRENT_PER_USER: int = 2
+    AI_MAX_QUEUE: int = 100
+    AI_QUEUE_DEADLINE_SECONDS: float = 10  # shed with 503 if a request cannot start by then
+    
+    # AI response cache
+    AI_CACHE_SIZE: int = 5000
+    AI_CACHE_TTL_SECONDS: int = 86400
+    AI_CACHE_PERSISTENT: bool = True  # fall back to recent chat_logs rows on a memory miss
+    AI_CACHE_HITS_COUNT_AGAINST_QUOTA: bool = False
+    
     # App
     APP_URL: str
     FRONTEND_URL: str = "http://localhost:3000"
     
     # Rate Limiting
     RATE_LIMIT_PER_MINUTE: int = 60
+    RATE_LIMIT_MAX_KEYS: int = 100000
+    
+    # Daily quotas per role
+    AI_DAILY_LIMIT_NORMAL: int = 50
+    AI_DAILY_LIMIT_PREMIUM: int = 100
+    AI_DAILY_LIMIT_ADMIN: int = 50
+    NOTE_UPLOAD_DAILY_LIMIT_NORMAL: int = 3
+    NOTE_UPLOAD_DAILY_LIMIT_PREMIUM: int = 3
+    NOTE_UPLOAD_DAILY_LIMIT_ADMIN: int = 3
+    
+    # Redis (optional; shared state across workers when set)
+    REDIS_URL: str = ""
+    
+    # Notification streams (server-sent events)
+    NOTIFICATION_STREAM_KEEPALIVE_SECONDS: float = 25
+    NOTIFICATION_STREAM_QUEUE_SIZE: int = 100
+    NOTIFICATION_MAX_STREAMS_PER_USER: int = 5
+    
+    # Pagination
+    LIST_COUNT_CACHE_SECONDS: int = 60
+    
+    # Trending
+    TRENDING_HALF_LIFE_HOURS: float = 72
+    TRENDING_REDECAY_INTERVAL_MINUTES: int = 15
+    
+    # Engagement counters (write-behind)
+    COUNTER_FLUSH_INTERVAL_SECONDS: float = 5
+    COUNTER_FLUSH_MAX_PENDING: int = 1000
+    
+    # Dashboard rollups (write-behind)
+    DAILY_STATS_FLUSH_INTERVAL_SECONDS: float = 10
+    DAILY_STATS_REBUILD_LEASE_SECONDS: int = 600
     
     # File Limits
     MAX_PDF_SIZE_MB: int = 20
     MAX_IMAGE_SIZE_MB: int = 5
     
+    # Streaming uploads
+    UPLOAD_CHUNK_SIZE_KB: int = 1024
+    S3_MULTIPART_THRESHOLD_MB: int = 8
+    S3_MULTIPART_CHUNK_SIZE_MB: int = 8
+    S3_MAX_POOL_CONNECTIONS: int = 32
+    IMAGE_UPLOAD_CONCURRENCY: int = 16
+    
+    # PDF processing pool
+    PDF_WORKERS: int = 2
+    PDF_MAX_QUEUE: int = 8
+    PDF_JOB_TIMEOUT_SECONDS: int = 60
+    
     @property
     def DATABASE_URL(self) -> str:
         return f"mysql+pymysql://{self.DB_USER}:{self.DB_PASSWORD}@{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}"
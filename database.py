@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Boolean, Text, ForeignKey, Enum, Index
+from sqlalchemy import create_engine, Column, Integer, String, Float, Date, DateTime, Boolean, Text, ForeignKey, Enum, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
@@ -42,6 +42,7 @@ class User(Base):
     ai_messages_reset_date = Column(DateTime, default=datetime.utcnow)
     notes_uploaded_today = Column(Integer, default=0)
     notes_upload_reset_date = Column(DateTime, default=datetime.utcnow)
+    unread_notifications = Column(Integer, default=0, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -71,8 +72,19 @@ class TokenBlacklist(Base):
     __tablename__ = "token_blacklist"
     
     id = Column(Integer, primary_key=True, index=True)
-    token = Column(String(500), unique=True, nullable=False)
-    blacklisted_at = Column(DateTime, default=datetime.utcnow)
+    jti = Column(String(64), unique=True, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    blacklisted_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class StorageDeletion(Base):
+    __tablename__ = "storage_deletions"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    file_key = Column(String(500), nullable=False, index=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+    last_error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
 
 class Note(Base):
     __tablename__ = "notes"
@@ -90,6 +102,8 @@ class Note(Base):
     shares = Column(Integer, default=0)
     likes = Column(Integer, default=0)
     earnings = Column(Float, default=0.0)
+    trending_score = Column(Float, default=0.0, nullable=False)
+    trending_updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     is_approved = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -98,7 +112,13 @@ class Note(Base):
     note_likes = relationship("NoteLike", back_populates="note", cascade="all, delete-orphan")
     note_downloads = relationship("NoteDownload", back_populates="note", cascade="all, delete-orphan")
     
-    __table_args__ = (Index('idx_subject_created', 'subject', 'created_at'),)
+    __table_args__ = (
+        Index('idx_subject_created', 'subject', 'created_at'),
+        Index('idx_approved_trending', 'is_approved', 'trending_score'),
+        Index('idx_approved_subject_trending', 'is_approved', 'subject', 'trending_score'),
+        Index('ft_notes_title', 'title', mysql_prefix='FULLTEXT'),
+        Index('ft_notes_search', 'title', 'description', 'subject', mysql_prefix='FULLTEXT'),
+    )
 
 class NoteLike(Base):
     __tablename__ = "note_likes"
@@ -142,6 +162,9 @@ class Book(Base):
     latitude = Column(Float, nullable=False)
     longitude = Column(Float, nullable=False)
     location_name = Column(String(255))
+    geohash = Column(String(12))
+    primary_image_path = Column(String(500))
+    primary_image_prefix = Column(String(500))
     status = Column(Enum(BookStatus), default=BookStatus.AVAILABLE, nullable=False)
     expires_at = Column(DateTime, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -151,7 +174,10 @@ class Book(Base):
     images = relationship("BookImage", back_populates="book", cascade="all, delete-orphan")
     buy_requests = relationship("BookBuyRequest", back_populates="book", cascade="all, delete-orphan")
     
-    __table_args__ = (Index('idx_status_location', 'status', 'latitude', 'longitude'),)
+    __table_args__ = (
+        Index('idx_status_location', 'status', 'latitude', 'longitude'),
+        Index('idx_status_geohash', 'status', 'geohash'),
+    )
 
 class BookImage(Base):
     __tablename__ = "book_images"
@@ -159,6 +185,7 @@ class BookImage(Base):
     id = Column(Integer, primary_key=True, index=True)
     book_id = Column(Integer, ForeignKey("books.id", ondelete="CASCADE"), nullable=False)
     image_path = Column(String(500), nullable=False)
+    variant_prefix = Column(String(500), nullable=True)  # thumb/medium/full variants live under this key prefix
     is_primary = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     
@@ -207,11 +234,16 @@ class ChatLog(Base):
     message = Column(Text, nullable=False)
     response = Column(Text, nullable=False)
     tokens_used = Column(Integer, default=0)
+    prompt_hash = Column(String(64))  # normalized prompt + model + max_tokens, for the response cache
+    cached = Column(Boolean, default=False, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     user = relationship("User", back_populates="chat_logs")
     
-    __table_args__ = (Index('idx_user_chat_date', 'user_id', 'created_at'),)
+    __table_args__ = (
+        Index('idx_user_chat_date', 'user_id', 'created_at'),
+        Index('idx_prompt_hash_created', 'prompt_hash', 'created_at'),
+    )
 
 class AbuseReport(Base):
     __tablename__ = "abuse_reports"
@@ -225,11 +257,40 @@ class AbuseReport(Base):
     status = Column(String(50), default="pending")
     created_at = Column(DateTime, default=datetime.utcnow)
 
+class DailyStat(Base):
+    """Per-day activity totals for the admin dashboard, incremented alongside the writes they count"""
+    __tablename__ = "daily_stats"
+    
+    day = Column(Date, primary_key=True)
+    signups = Column(Integer, default=0, nullable=False)
+    notes_uploaded = Column(Integer, default=0, nullable=False)
+    notes_deleted = Column(Integer, default=0, nullable=False)
+    books_listed = Column(Integer, default=0, nullable=False)
+    books_deleted = Column(Integer, default=0, nullable=False)
+    downloads = Column(Integer, default=0, nullable=False)
+    earnings = Column(Float, default=0, nullable=False)
+    ai_messages = Column(Integer, default=0, nullable=False)
+    ai_tokens = Column(Integer, default=0, nullable=False)
+
+class RollupState(Base):
+    """One row per rollup: when it was last rebuilt, and until when a rebuild holds it"""
+    __tablename__ = "rollup_state"
+    
+    name = Column(String(50), primary_key=True)
+    rebuilt_at = Column(DateTime)
+    locked_until = Column(DateTime)
+
 # Database connection and session management
 from config import get_settings
 
 settings = get_settings()
-engine = create_engine(settings.DATABASE_URL, pool_pre_ping=True, pool_recycle=3600)
+engine = create_engine(
+    settings.DATABASE_URL,
+    pool_pre_ping=True,
+    pool_recycle=3600,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 def init_db():
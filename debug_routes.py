@@ -1,12 +1,12 @@
 from fastapi import APIRouter, Depends
 from sqlalchemy.orm import Session
 from database import get_db, Book, BookImage
-from auth import get_current_user, User
+from auth import get_current_principal, Principal
 
 debug_router = APIRouter()
 
 @debug_router.get("/api/debug/books/{book_id}")
-async def debug_book(book_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def debug_book(book_id: int, current_user: Principal = Depends(get_current_principal), db: Session = Depends(get_db)):
     book = db.query(Book).filter(Book.id == book_id).first()
     if not book:
         return {"error": "Book not found"}
@@ -21,6 +21,7 @@ async def debug_book(book_id: int, current_user: User = Depends(get_current_user
             {
                 "id": img.id,
                 "image_path": img.image_path,
+                "variant_prefix": img.variant_prefix,
                 "is_primary": img.is_primary
             } for img in images
         ]
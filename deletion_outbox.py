@@ -0,0 +1,140 @@
+from datetime import datetime, timedelta
+from typing import Iterable, List
+from sqlalchemy import delete
+from database import SessionLocal, StorageDeletion, Note, BookImage
+from storage import storage
+from config import get_settings
+
+settings = get_settings()
+
+DELETE_BATCH_SIZE = 1000  # S3 DeleteObjects accepts at most 1000 keys per call
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 3600
+RECONCILE_PREFIXES = ("notes-pdf/", "book-images/")
+
+class StorageDeletionOutbox:
+    """Deletes stored files after the rows that referenced them are gone.
+    
+    Endpoints enqueue keys in the same transaction that deletes the row, so
+    a key is only ever queued if the delete committed. A background job
+    drains the table with batched deletes and retries failures with
+    exponential backoff; a slower reconciliation job queues anything left
+    in storage that no row points at.
+    """
+    
+    def enqueue(self, db, file_keys: Iterable[str]):
+        """Queue keys for deletion; committed together with the caller's transaction"""
+        db.add_all([StorageDeletion(file_key=file_key) for file_key in file_keys])
+    
+    def delete_now(self, file_keys: List[str]) -> int:
+        """Delete keys right away, queueing whatever storage could not delete; returns how many were queued"""
+        try:
+            failed = list(storage.delete_files(file_keys))
+        except Exception as e:
+            print(f"⚠️ Storage delete failed: {e}")
+            failed = list(file_keys)
+        if failed:
+            db = SessionLocal()
+            try:
+                self.enqueue(db, failed)
+                db.commit()
+            finally:
+                db.close()
+        return len(failed)
+    
+    def drain_batch(self) -> int:
+        """Delete one batch of due keys from storage; returns how many rows were handled"""
+        db = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            rows = db.query(StorageDeletion).filter(
+                StorageDeletion.next_attempt_at <= now
+            ).order_by(StorageDeletion.id).limit(DELETE_BATCH_SIZE).with_for_update(skip_locked=True).all()
+            if not rows:
+                db.commit()
+                return 0
+            
+            try:
+                failed = storage.delete_files([row.file_key for row in rows])
+            except Exception as e:
+                failed = {row.file_key: str(e) for row in rows}
+            
+            done_ids = [row.id for row in rows if row.file_key not in failed]
+            if done_ids:
+                db.execute(delete(StorageDeletion).where(StorageDeletion.id.in_(done_ids)))
+            for row in rows:
+                if row.file_key in failed:
+                    row.attempts += 1
+                    row.last_error = failed[row.file_key][:1000]
+                    row.next_attempt_at = now + timedelta(
+                        seconds=min(RETRY_BASE_SECONDS * 2 ** (row.attempts - 1), RETRY_MAX_SECONDS)
+                    )
+            db.commit()
+            
+            if failed:
+                print(f"⚠️ {len(failed)} storage deletions failed, will retry")
+            return len(rows)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+    
+    def run_drain_job(self):
+        """Drain everything that is due, one batch at a time"""
+        total = 0
+        while True:
+            handled = self.drain_batch()
+            total += handled
+            if handled < DELETE_BATCH_SIZE:
+                break
+        if total:
+            print(f"🗑️ Processed {total} storage deletions")
+    
+    def _unreferenced(self, db, file_keys: List[str]) -> List[str]:
+        variant_prefixes = list({file_key.rsplit("/", 1)[0] for file_key in file_keys})
+        referenced = {path for (path,) in db.query(Note.file_path).filter(Note.file_path.in_(file_keys))}
+        referenced.update(path for (path,) in db.query(BookImage.image_path).filter(BookImage.image_path.in_(file_keys)))
+        referenced.update(key for (key,) in db.query(StorageDeletion.file_key).filter(StorageDeletion.file_key.in_(file_keys)))
+        live_prefixes = {
+            prefix for (prefix,) in db.query(BookImage.variant_prefix).filter(BookImage.variant_prefix.in_(variant_prefixes))
+        }
+        return [
+            file_key for file_key in file_keys
+            if file_key not in referenced and file_key.rsplit("/", 1)[0] not in live_prefixes
+        ]
+    
+    def reconcile(self) -> int:
+        """Queue stored files that no note or book image references; returns how many were queued"""
+        # Skip recent files so uploads whose rows are not committed yet are left alone
+        cutoff = datetime.utcnow() - timedelta(hours=settings.STORAGE_RECONCILE_GRACE_HOURS)
+        queued = 0
+        db = SessionLocal()
+        try:
+            for prefix in RECONCILE_PREFIXES:
+                batch = []
+                for file_key, last_modified in storage.list_keys(prefix):
+                    if last_modified < cutoff:
+                        batch.append(file_key)
+                    if len(batch) == DELETE_BATCH_SIZE:
+                        queued += self._queue_orphans(db, batch)
+                        batch = []
+                if batch:
+                    queued += self._queue_orphans(db, batch)
+        finally:
+            db.close()
+        return queued
+    
+    def _queue_orphans(self, db, file_keys: List[str]) -> int:
+        orphans = self._unreferenced(db, file_keys)
+        if orphans:
+            self.enqueue(db, orphans)
+        db.commit()
+        return len(orphans)
+    
+    def run_reconcile_job(self):
+        queued = self.reconcile()
+        if queued:
+            print(f"🧹 Queued {queued} orphaned files for deletion")
+
+deletion_outbox = StorageDeletionOutbox()
@@ -0,0 +1,267 @@
+import asyncio
+import threading
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict
+from sqlalchemy import update, bindparam
+from database import Note, SessionLocal
+from trending_service import trending_service
+from config import get_settings
+
+settings = get_settings()
+
+COUNTER_FIELDS = ("views", "shares", "likes", "trending")
+
+def _empty_counters() -> Dict[str, float]:
+    return dict.fromkeys(COUNTER_FIELDS, 0)
+
+class RedisCounterStore:
+    """Counter deltas kept in a Redis hash, so a worker crash does not lose them.
+    
+    Clicks HINCRBYFLOAT into KEY. A flush moves KEY into FLUSHING_KEY in one
+    script and deletes FLUSHING_KEY only after the database commit, so a
+    batch whose flush failed or whose worker died is picked up by the next
+    flush. A crash between the commit and the delete applies that batch
+    twice; nothing is ever lost. The flush lock keeps workers from draining
+    the same batch at once.
+    """
+    
+    KEY = "engagement_counters"
+    FLUSHING_KEY = "engagement_counters:flushing"
+    LOCK_KEY = "engagement_counters:flush_lock"
+    LOCK_SECONDS = 60
+    
+    TAKE_SCRIPT = """
+    local values = redis.call('HGETALL', KEYS[1])
+    for i = 1, #values, 2 do
+        redis.call('HINCRBYFLOAT', KEYS[2], values[i], values[i + 1])
+    end
+    redis.call('DEL', KEYS[1])
+    return redis.call('HGETALL', KEYS[2])
+    """
+    
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.take_script = redis_client.register_script(self.TAKE_SCRIPT)
+    
+    def add(self, note_id: int, deltas: Dict[str, float]):
+        pipeline = self.redis.pipeline(transaction=False)
+        for field, delta in deltas.items():
+            if delta:
+                pipeline.hincrbyfloat(self.KEY, f"{note_id}:{field}", delta)
+        pipeline.execute()
+    
+    def pending(self, note_id: int, field: str) -> float:
+        values = self.redis.hmget(self.KEY, f"{note_id}:{field}") + self.redis.hmget(self.FLUSHING_KEY, f"{note_id}:{field}")
+        return sum(float(value) for value in values if value is not None)
+    
+    def lock(self):
+        return self.redis.lock(self.LOCK_KEY, timeout=self.LOCK_SECONDS, blocking=False)
+    
+    def take(self) -> Dict[int, Dict[str, float]]:
+        """Everything not flushed yet, including a batch left by a failed flush"""
+        values = self.take_script(keys=[self.KEY, self.FLUSHING_KEY])
+        batch = defaultdict(_empty_counters)
+        for name, value in zip(values[::2], values[1::2]):
+            note_id, field = (name.decode() if isinstance(name, bytes) else name).split(":")
+            batch[int(note_id)][field] += float(value)
+        return batch
+    
+    def done(self):
+        self.redis.delete(self.FLUSHING_KEY)
+
+class EngagementCounterBuffer:
+    """Write-behind buffer for per-note engagement counters.
+    
+    Clicks only add deltas. A background task flushes them on an interval, or
+    early once COUNTER_FLUSH_MAX_PENDING events are waiting, as one transaction
+    of `SET views = views + n` updates. With REDIS_URL set the deltas are
+    written to Redis before the request returns, so they survive a worker
+    crash or OOM kill (see RedisCounterStore). Without Redis, or while Redis
+    is unreachable, they are held in this process: a failed flush puts them
+    back and shutdown flushes them, but a hard crash loses up to one interval
+    of views and shares, which cannot be recounted. Downloads and earnings
+    never go through here; download_note writes them synchronously.
+    """
+    
+    def __init__(self, store: RedisCounterStore = None):
+        self.store = store
+        self.flush_interval = settings.COUNTER_FLUSH_INTERVAL_SECONDS
+        self.max_pending = settings.COUNTER_FLUSH_MAX_PENDING
+        self._deltas: Dict[int, Dict[str, float]] = defaultdict(_empty_counters)
+        self._store_down = False
+        self._pending_events = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._loop = None
+        self._flush_requested = None
+        self._task = None
+    
+    def increment(self, note_id: int, **deltas):
+        """Queue counter deltas for a note, e.g. increment(5, views=1)"""
+        if not self._add_to_store(note_id, deltas):
+            with self._lock:
+                note_deltas = self._deltas[note_id]
+                for field, delta in deltas.items():
+                    note_deltas[field] += delta
+        with self._lock:
+            self._pending_events += 1
+            flush_due = self._pending_events >= self.max_pending
+        
+        if flush_due and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._flush_requested.set)
+    
+    def _add_to_store(self, note_id: int, deltas: Dict[str, float]) -> bool:
+        if self.store is None:
+            return False
+        try:
+            self.store.add(note_id, deltas)
+        except Exception as e:
+            # One line per outage, not one per click
+            if not self._store_down:
+                self._store_down = True
+                print(f"⚠️ Counter store unreachable, buffering clicks in memory: {e}")
+            return False
+        if self._store_down:
+            self._store_down = False
+            print("✅ Counter store reachable again")
+        return True
+    
+    def pending(self, note_id: int, field: str) -> float:
+        """Delta for one counter that has not been flushed yet"""
+        with self._lock:
+            note_deltas = self._deltas.get(note_id)
+            pending = note_deltas[field] if note_deltas else 0
+        if self.store is not None:
+            try:
+                pending += self.store.pending(note_id, field)
+            except Exception:
+                pass
+        return pending
+    
+    def _merge_back(self, batch: Dict[int, Dict[str, float]], events: int):
+        with self._lock:
+            for note_id, deltas in batch.items():
+                note_deltas = self._deltas[note_id]
+                for field, delta in deltas.items():
+                    note_deltas[field] += delta
+            self._pending_events += events
+    
+    def _take_from_store(self):
+        """(lock, batch) of the deltas in Redis; no lock and no batch if another worker is flushing or Redis is down"""
+        if self.store is None:
+            return None, {}
+        lock = self.store.lock()
+        try:
+            if not lock.acquire():
+                # Another worker is flushing the shared batch
+                return None, {}
+            return lock, self.store.take()
+        except Exception as e:
+            print(f"⚠️ Could not take counters from the store: {e}")
+            self._release(lock)
+            return None, {}
+    
+    def _release(self, lock):
+        try:
+            if lock is not None and lock.owned():
+                lock.release()
+        except Exception:
+            pass
+    
+    def flush(self) -> int:
+        """Write all buffered deltas to the database; returns the number of notes updated"""
+        with self._flush_lock:
+            with self._lock:
+                local_batch = self._deltas
+                events = self._pending_events
+                self._deltas = defaultdict(_empty_counters)
+                self._pending_events = 0
+            
+            lock, store_batch = self._take_from_store()
+            try:
+                batch = defaultdict(_empty_counters)
+                for source in (local_batch, store_batch):
+                    for note_id, deltas in source.items():
+                        for field, delta in deltas.items():
+                            batch[note_id][field] += delta
+                
+                if not batch:
+                    return 0
+                
+                params = [
+                    {
+                        "b_note_id": note_id,
+                        "b_views": int(deltas["views"]),
+                        "b_shares": int(deltas["shares"]),
+                        "b_likes": int(deltas["likes"]),
+                        "b_trending": deltas["trending"]
+                    }
+                    for note_id, deltas in batch.items()
+                ]
+                now = datetime.utcnow()
+                statement = update(Note.__table__).where(Note.id == bindparam("b_note_id")).values(
+                    views=Note.views + bindparam("b_views"),
+                    shares=Note.shares + bindparam("b_shares"),
+                    likes=Note.likes + bindparam("b_likes"),
+                    trending_score=trending_service.score_after_engagement(now, bindparam("b_trending")),
+                    trending_updated_at=now
+                )
+                
+                db = SessionLocal()
+                try:
+                    db.execute(statement, params)
+                    db.commit()
+                except Exception as e:
+                    db.rollback()
+                    # The store's batch stays in its flushing key for the next flush
+                    self._merge_back(local_batch, events)
+                    print(f"❌ Counter flush failed, {len(batch)} notes re-queued: {e}")
+                    raise
+                finally:
+                    db.close()
+                
+                if store_batch:
+                    try:
+                        self.store.done()
+                    except Exception as e:
+                        print(f"⚠️ Flushed counters could not be cleared from the store and may be applied again: {e}")
+                return len(batch)
+            finally:
+                self._release(lock)
+    
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception:
+                pass
+    
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._flush_requested = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Stop the background flusher and write out everything still buffered"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._loop = None
+        try:
+            await asyncio.to_thread(self.flush)
+        except Exception:
+            pass
+
+def create_engagement_counters() -> EngagementCounterBuffer:
+    if settings.REDIS_URL:
+        import redis
+        return EngagementCounterBuffer(RedisCounterStore(redis.Redis.from_url(settings.REDIS_URL)))
+    return EngagementCounterBuffer()
+
+engagement_counters = create_engagement_counters()
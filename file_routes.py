@@ -0,0 +1,115 @@
+from fastapi import APIRouter, HTTPException, Request
+from starlette.responses import FileResponse
+from typing import Optional, Tuple
+import anyio
+import mimetypes
+import os
+import stat
+import time
+
+from storage import storage, LocalStorageBackend
+
+file_router = APIRouter()
+
+class RangeFileResponse(FileResponse):
+    """FileResponse that can answer a single byte range with 206.
+    
+    When the server offers the ASGI zero-copy extension the file descriptor
+    is handed over for sendfile; otherwise the range is read in large chunks
+    off the event loop, never holding more than one chunk in memory.
+    """
+    
+    chunk_size = 1024 * 1024
+    
+    def __init__(self, path: str, stat_result: os.stat_result, **kwargs):
+        super().__init__(path, stat_result=stat_result, **kwargs)
+        self.headers["accept-ranges"] = "bytes"
+        self.offset, self.count = 0, stat_result.st_size
+    
+    def set_range(self, start: int, end: int):
+        self.status_code = 206
+        self.headers["content-range"] = f"bytes {start}-{end}/{self.count}"
+        self.offset, self.count = start, end - start + 1
+        self.headers["content-length"] = str(self.count)
+    
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"].upper() == "HEAD" or self.count == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        
+        if "http.response.zerocopy" in scope.get("extensions", {}):
+            with open(self.path, "rb") as file:
+                await send({
+                    "type": "http.response.zerocopy",
+                    "file": file,
+                    "offset": self.offset,
+                    "count": self.count,
+                    "more_body": False
+                })
+            return
+        
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            await file.seek(self.offset)
+            remaining = self.count
+            while remaining > 0:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                # File shrank underneath us; end the response rather than hang
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+def parse_range_header(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """(start, end) of a single "bytes=" range, or None to send the whole file.
+    
+    Multiple or malformed ranges are ignored, which RFC 9110 allows; a range
+    that starts past the end of the file raises 416. An empty file has no
+    satisfiable range, so it is always sent whole (an empty 200).
+    """
+    if size == 0 or not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start, _, end = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if start == "":
+            suffix = int(end)
+            if suffix <= 0:
+                raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+            return max(size - suffix, 0), size - 1
+        first = int(start)
+        last = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if first >= size or last < first:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return first, min(last, size - 1)
+
+@file_router.api_route("/api/files/{file_key:path}", methods=["GET", "HEAD"])
+def serve_file(file_key: str, expires: int, signature: str, request: Request):
+    """Serve a file from local storage through a signed, expiring URL"""
+    if not isinstance(storage, LocalStorageBackend):
+        raise HTTPException(status_code=404, detail="Not found")
+    if not storage.verify_signature(file_key, expires, signature):
+        raise HTTPException(status_code=403, detail="Invalid or expired link")
+    
+    try:
+        path = storage.path_for(file_key)
+        stat_result = os.stat(path)
+    except (ValueError, FileNotFoundError):
+        raise HTTPException(status_code=404, detail="File not found")
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    response = RangeFileResponse(
+        path,
+        stat_result,
+        headers={"Cache-Control": f"private, max-age={max(int(expires - time.time()), 0)}"},
+        media_type=mimetypes.guess_type(path)[0] or "application/octet-stream"
+    )
+    byte_range = parse_range_header(request.headers.get("range"), stat_result.st_size)
+    # A stale If-Range validator means the client's partial copy is out of date
+    if byte_range is not None and request.headers.get("if-range", response.headers["etag"]) == response.headers["etag"]:
+        response.set_range(*byte_range)
+    return response
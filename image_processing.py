@@ -0,0 +1,63 @@
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+from PIL import Image, ImageOps
+
+# Longest side in pixels; images are never upscaled
+IMAGE_VARIANTS = {
+    "thumb": 200,
+    "medium": 800,
+    "full": 1600
+}
+IMAGE_FORMATS = {
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+    "jpg": ("JPEG", "image/jpeg", {"quality": 82, "optimize": True, "progressive": True})
+}
+
+class InvalidImageError(Exception):
+    pass
+
+def build_image_variants(image_bytes: bytes) -> Dict[str, Tuple[str, bytes]]:
+    """Resize an uploaded image into every variant and format.
+    
+    Returns {"thumb.webp": (content_type, bytes), ...}. Images are re-encoded
+    from pixels only, so EXIF (GPS position, camera serials) is dropped;
+    the EXIF orientation is applied first so nothing ends up sideways.
+    """
+    try:
+        image = Image.open(BytesIO(image_bytes))
+        # Let JPEG decode at reduced scale when the original is far larger than we need
+        image.draft("RGB", (IMAGE_VARIANTS["full"], IMAGE_VARIANTS["full"]))
+        image = ImageOps.exif_transpose(image)
+        
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[-1])
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise InvalidImageError(f"Invalid image: {e}")
+    
+    variants = {}
+    # Largest first, so each smaller variant resizes from the previous one
+    for name, max_side in sorted(IMAGE_VARIANTS.items(), key=lambda item: -item[1]):
+        image = image.copy()
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        for extension, (pil_format, content_type, options) in IMAGE_FORMATS.items():
+            buffer = BytesIO()
+            image.save(buffer, pil_format, **options)
+            variants[f"{name}.{extension}"] = (content_type, buffer.getvalue())
+    return variants
+
+def variant_key(image_path: Optional[str], variant_prefix: Optional[str], variant: str, extension: str = "jpg") -> str:
+    """S3 key of one variant; images from before variants existed only have the original"""
+    if not variant_prefix:
+        return image_path
+    return f"{variant_prefix}/{variant}.{extension}"
+
+def variant_keys(image_path: str, variant_prefix: Optional[str]) -> List[str]:
+    """Every S3 key stored for an image"""
+    if not variant_prefix:
+        return [image_path]
+    return [f"{variant_prefix}/{name}.{extension}" for name in IMAGE_VARIANTS for extension in IMAGE_FORMATS]
@@ -1,33 +1,93 @@
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form, Request
+from fastapi import FastAPI, Depends, HTTPException, status, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
-from sqlalchemy import func, and_, or_
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import func, and_, or_, case
+from sqlalchemy.dialects.mysql import match
 from datetime import datetime, timedelta
 from typing import List, Optional
 from pydantic import BaseModel
 import uvicorn
 
-from database import init_db, get_db, User, LoginLog, Note, NoteLike, NoteDownload, Book, BookImage, BookBuyRequest, Notification, ChatLog, AbuseReport, UserRole, BookStatus, RequestStatus
-from auth import create_access_token, create_refresh_token, get_current_user, get_current_admin, blacklist_token, verify_token
+from database import init_db, get_db, SessionLocal, User, LoginLog, Note, NoteLike, NoteDownload, Book, BookImage, BookBuyRequest, Notification, ChatLog, AbuseReport, UserRole, BookStatus, RequestStatus
+from auth import create_access_token, create_refresh_token, get_current_user, get_current_principal, Principal, get_current_admin, blacklist_token, verify_token, purge_expired_revocations, principal_invalidations
 from google_auth import google_auth_service
-from s3_service import s3_service
+from storage import storage
 from ai_service import ai_service
-from utils import rate_limiter, calculate_distance, is_within_radius, reset_daily_counter_if_needed
+from trending_service import trending_service, DOWNLOAD_WEIGHT, LIKE_WEIGHT, SHARE_WEIGHT
+from engagement_counters import engagement_counters
+from quota_service import quota_service
+from pdf_processing import pdf_processor
+from deletion_outbox import deletion_outbox
+from notifications import notification_hub
+from analytics_rollups import daily_stats, DOWNLOAD_EARNINGS
+from utils import run_periodically, rate_limiter, backfill_book_geohashes, StreamingUploadParser, remove_temp_file, UploadSizeLimitMiddleware, MB, fulltext_boolean_query, TTLCache, encode_cursor, paginate_keyset, offset_cursor_page
 from config import get_settings
 from routes import router
 from admin_routes import admin_router
 from debug_routes import debug_router
+from file_routes import file_router
 
 from contextlib import asynccontextmanager
+import asyncio
+import anyio
+import os
+import tempfile
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
+    # DB-bound handlers are plain `def` routes, which FastAPI runs on this bounded pool
+    anyio.to_thread.current_default_thread_limiter().total_tokens = settings.DB_THREADPOOL_SIZE
     init_db()
     print("Database initialized successfully")
+    db = SessionLocal()
+    try:
+        backfilled = backfill_book_geohashes(db)
+        if backfilled:
+            print(f"Backfilled geohash for {backfilled} books")
+    finally:
+        db.close()
+    
+    background_tasks = [
+        asyncio.create_task(run_periodically(
+            settings.TRENDING_REDECAY_INTERVAL_MINUTES * 60,
+            trending_service.run_redecay_job,
+            "Trending re-decay"
+        )),
+        asyncio.create_task(run_periodically(
+            settings.TOKEN_BLACKLIST_PURGE_INTERVAL_MINUTES * 60,
+            purge_expired_revocations,
+            "Token blacklist purge"
+        )),
+        asyncio.create_task(run_periodically(
+            settings.STORAGE_DELETION_INTERVAL_SECONDS,
+            deletion_outbox.run_drain_job,
+            "Storage deletion"
+        )),
+        asyncio.create_task(run_periodically(
+            settings.STORAGE_RECONCILE_INTERVAL_HOURS * 3600,
+            deletion_outbox.run_reconcile_job,
+            "Storage reconciliation"
+        )),
+        asyncio.create_task(asyncio.to_thread(daily_stats.run_backfill_if_empty))
+    ]
+    engagement_counters.start()
+    daily_stats.start()
+    await ai_service.start()
+    await notification_hub.start()
+    await principal_invalidations.start()
     yield
-    # Shutdown (if needed)
+    # Shutdown
+    for task in background_tasks:
+        task.cancel()
+    await engagement_counters.stop()
+    await daily_stats.stop()
+    pdf_processor.shutdown()
+    await ai_service.close()
+    await notification_hub.stop()
+    await principal_invalidations.stop()
 
 settings = get_settings()
 app = FastAPI(title="NotesHub API", version="1.0.0", lifespan=lifespan)
@@ -35,6 +95,16 @@ app = FastAPI(title="NotesHub API", version="1.0.0", lifespan=lifespan)
 app.include_router(router)
 app.include_router(admin_router)
 app.include_router(debug_router)
+app.include_router(file_router)
+
+# Refuse uploads that announce an oversized body before any of it is parsed
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    limits={
+        "/api/notes/upload": settings.MAX_PDF_SIZE_MB * MB,
+        "/api/books/upload": 5 * settings.MAX_IMAGE_SIZE_MB * MB
+    }
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -56,7 +126,7 @@ class GoogleLoginRequest(BaseModel):
 
 # AUTH ROUTES
 @app.post("/api/auth/google")
-async def google_login(
+def google_login(
     login_data: GoogleLoginRequest,
     request: Request,
     db: Session = Depends(get_db)
@@ -74,6 +144,7 @@ async def google_login(
             role=UserRole.NORMAL
         )
         db.add(user)
+        daily_stats.record(db, signups=1)
         db.commit()
         db.refresh(user)
     
@@ -106,7 +177,7 @@ async def google_login(
     }
 
 @app.post("/api/auth/refresh")
-async def refresh_token_endpoint(refresh_token: str = Form(...), db: Session = Depends(get_db)):
+def refresh_token_endpoint(refresh_token: str = Form(...), db: Session = Depends(get_db)):
     payload = verify_token(refresh_token, db)
     
     if payload.get("type") != "refresh":
@@ -123,7 +194,7 @@ async def refresh_token_endpoint(refresh_token: str = Form(...), db: Session = D
     return {"access_token": new_access_token, "token_type": "bearer"}
 
 @app.post("/api/auth/logout")
-async def logout(token: str = Form(...), db: Session = Depends(get_db)):
+def logout(token: str = Form(...), db: Session = Depends(get_db)):
     blacklist_token(token, db)
     return {"message": "Logged out successfully"}
 
@@ -141,166 +212,182 @@ async def get_profile(current_user: User = Depends(get_current_user)):
 # NOTES ROUTES
 @app.post("/api/notes/upload")
 async def upload_note(
-    title: str = Form(...),
-    subject: str = Form(...),
-    description: str = Form(None),
-    file: UploadFile = File(...),
+    request: Request,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    print(f"📤 Upload request from user {current_user.id}: {title}")
-    print(f"File: {file.filename}, Content-Type: {file.content_type}")
-    
-    if file.content_type not in ["application/pdf", "application/octet-stream"]:
-        print(f"❌ Invalid content type: {file.content_type}")
-        raise HTTPException(status_code=400, detail="Only PDF files allowed")
-    
-    file_content = await file.read()
-    file_size = len(file_content)
-    print(f"📏 File size: {file_size} bytes")
-    
-    if file_size > settings.MAX_PDF_SIZE_MB * 1024 * 1024:
-        raise HTTPException(status_code=400, detail=f"File too large (max {settings.MAX_PDF_SIZE_MB}MB)")
-    
-    # Check PDF pages
+    # The form is parsed here as it streams in, not by FastAPI, so the PDF is
+    # written to disk once, hashed on the way, and an oversize file stops at the limit
+    upload = StreamingUploadParser("file", settings.MAX_PDF_SIZE_MB * MB, ".pdf")
+    await upload.parse(request)
+    upload_path, file_size, file_hash = upload.path, upload.size, upload.sha256
+    watermarked_path = None
+    # Reserving commits, which expires current_user; reading it again afterwards would query on the event loop
+    user_id, role = current_user.id, current_user.role
     try:
-        from PyPDF2 import PdfReader
-        from io import BytesIO
-        pdf_reader = PdfReader(BytesIO(file_content))
-        page_count = len(pdf_reader.pages)
-        print(f"📄 PDF pages: {page_count}")
+        title = upload.fields.get("title")
+        subject = upload.fields.get("subject")
+        description = upload.fields.get("description")
+        if not title or not subject:
+            raise HTTPException(status_code=400, detail="Title and subject are required")
+        if upload.filename is None:
+            raise HTTPException(status_code=400, detail="No PDF file uploaded")
+        
+        print(f"📤 Upload request from user {user_id}: {title}")
+        print(f"File: {upload.filename}, Content-Type: {upload.content_type}")
+        
+        if upload.content_type not in ["application/pdf", "application/octet-stream"]:
+            print(f"❌ Invalid content type: {upload.content_type}")
+            raise HTTPException(status_code=400, detail="Only PDF files allowed")
+        
+        print(f"📏 File size: {file_size} bytes")
+        print(f"🔐 File hash: {file_hash[:16]}...")
         
-        if page_count < 1:
-            raise HTTPException(status_code=400, detail=f"PDF must have at least 1 page (found {page_count})")
-    except HTTPException:
-        raise
-    except Exception as e:
-        print(f"❌ PDF validation error: {e}")
-        raise HTTPException(status_code=400, detail=f"Invalid PDF file: {str(e)}")
-    
-    # Check daily upload limit
-    from utils import reset_daily_counter_if_needed
-    reset_daily_counter_if_needed(current_user, "notes_uploaded_today", "notes_upload_reset_date")
-    
-    if current_user.notes_uploaded_today >= 3:
-        raise HTTPException(status_code=400, detail="Daily upload limit reached (3 notes per day)")
-    
-    # Check for duplicate PDF using hash
-    import hashlib
-    file_hash = hashlib.sha256(file_content).hexdigest()
-    print(f"🔐 File hash: {file_hash[:16]}...")
-    
-    existing_note = db.query(Note).filter(Note.file_hash == file_hash).first()
-    if existing_note:
-        raise HTTPException(
-            status_code=400, 
-            detail=f"This PDF already exists: '{existing_note.title}' uploaded by {existing_note.user.name}"
+        # Take one of today's uploads before doing any PDF work; it is refunded if the upload fails
+        uploads_left = await run_in_threadpool(
+            quota_service.reserve, db, user_id, role, "note_uploads"
         )
-    
-    file_path = s3_service.upload_note(file_content, file.filename, current_user.id)
-    print(f"☁️ Uploaded to S3: {file_path}")
-    
-    note = Note(
-        user_id=current_user.id,
-        title=title,
-        subject=subject,
-        description=description,
-        file_path=file_path,
-        file_size=file_size,
-        file_hash=file_hash
-    )
-    db.add(note)
-    
-    current_user.notes_uploaded_today += 1
-    db.commit()
-    db.refresh(note)
-    
-    print(f"✅ Note uploaded successfully: ID {note.id}")
-    return {"message": "Note uploaded successfully", "note_id": note.id}
+        if uploads_left is None:
+            upload_limit = quota_service.limit_for("note_uploads", role)
+            raise HTTPException(status_code=400, detail=f"Daily upload limit reached ({upload_limit} notes per day)")
+        
+        try:
+            # Check for duplicate PDF using hash
+            existing_note = await run_in_threadpool(
+                lambda: db.query(Note).options(joinedload(Note.user)).filter(Note.file_hash == file_hash).first()
+            )
+            if existing_note:
+                raise HTTPException(
+                    status_code=400, 
+                    detail=f"This PDF already exists: '{existing_note.title}' uploaded by {existing_note.user.name}"
+                )
+            
+            # Validation and watermarking run in the PDF process pool, file to file
+            fd, watermarked_path = tempfile.mkstemp(prefix="noteshub-", suffix=".pdf")
+            os.close(fd)
+            processed = await pdf_processor.process(upload_path, watermarked_path, user_id)
+            print(f"📄 PDF pages: {processed['page_count']}")
+            
+            # Storage and the database block, so run them off the event loop
+            def store_note():
+                file_path = storage.upload_note_file(watermarked_path, upload.filename, user_id)
+                print(f"☁️ Uploaded to storage: {file_path}")
+                
+                note = Note(
+                    user_id=user_id,
+                    title=title,
+                    subject=subject,
+                    description=description,
+                    file_path=file_path,
+                    file_size=file_size,
+                    file_hash=file_hash
+                )
+                db.add(note)
+                daily_stats.record(db, notes_uploaded=1)
+                db.commit()
+                db.refresh(note)
+                
+                print(f"✅ Note uploaded successfully: ID {note.id}")
+                return {"message": "Note uploaded successfully", "note_id": note.id}
+            
+            return await run_in_threadpool(store_note)
+        except BaseException:
+            await run_in_threadpool(quota_service.refund, db, user_id, "note_uploads")
+            raise
+    finally:
+        remove_temp_file(upload_path)
+        remove_temp_file(watermarked_path)
+
+note_count_cache = TTLCache(maxsize=1024, ttl=settings.LIST_COUNT_CACHE_SECONDS)
+
+def serialize_note_summary(note: Note) -> dict:
+    return {
+        "id": note.id,
+        "title": note.title,
+        "subject": note.subject,
+        "description": note.description,
+        "downloads": note.downloads,
+        "views": note.views,
+        "shares": note.shares,
+        "likes": note.likes,
+        "created_at": note.created_at,
+        "user": {
+            "id": note.user.id,
+            "name": note.user.name
+        }
+    }
 
 @app.get("/api/notes")
-async def get_notes(
+def get_notes(
     skip: int = 0,
     limit: int = 20,
     subject: str = None,
     search: str = None,
     sort: str = "recent",
+    cursor: str = None,
+    include_total: bool = True,
     db: Session = Depends(get_db)
 ):
-    query = db.query(Note).filter(Note.is_approved == True)
+    query = db.query(Note).options(joinedload(Note.user)).filter(Note.is_approved == True)
     
     if subject:
         query = query.filter(Note.subject == subject)
     
     if search:
-        # Exact match first, then partial match
-        exact_match = query.filter(Note.title.ilike(search)).all()
-        partial_match = query.filter(
-            or_(
-                Note.title.ilike(f"%{search}%"),
-                Note.description.ilike(f"%{search}%"),
-                Note.subject.ilike(f"%{search}%")
+        boolean_query = fulltext_boolean_query(search)
+        if boolean_query:
+            # Ranked FULLTEXT search: exact title first, then title hits weighted over body hits
+            title_relevance = match(Note.title, against=boolean_query).in_boolean_mode()
+            relevance = match(Note.title, Note.description, Note.subject, against=boolean_query).in_boolean_mode()
+            query = query.filter(relevance)
+            ranking = (
+                case((func.lower(Note.title) == search.lower(), 1), else_=0).desc(),
+                (title_relevance * 3 + relevance).desc(),
+                Note.id.desc()
+            )
+        else:
+            # Too short for the FULLTEXT index; fall back to a paginated pattern match
+            query = query.filter(
+                or_(
+                    Note.title.ilike(f"%{search}%"),
+                    Note.description.ilike(f"%{search}%"),
+                    Note.subject.ilike(f"%{search}%")
+                )
+            )
+            ranking = (
+                case((func.lower(Note.title) == search.lower(), 1), else_=0).desc(),
+                Note.created_at.desc()
             )
-        ).all()
-        
-        # Combine: exact first, then partial (remove duplicates)
-        seen_ids = set()
-        notes = []
-        for note in exact_match + partial_match:
-            if note.id not in seen_ids:
-                notes.append(note)
-                seen_ids.add(note.id)
-        
-        result = []
-        for note in notes[skip:skip+limit]:
-            result.append({
-                "id": note.id,
-                "title": note.title,
-                "subject": note.subject,
-                "description": note.description,
-                "downloads": note.downloads,
-                "views": note.views,
-                "shares": note.shares,
-                "likes": note.likes,
-                "created_at": note.created_at,
-                "user": {
-                    "id": note.user.id,
-                    "name": note.user.name
-                }
-            })
         
-        return {"notes": result, "total": len(notes)}
-    
-    if sort == "trending":
-        query = query.order_by((Note.downloads + Note.likes * 2 + Note.shares * 3).desc())
+        # Relevance scores are not stable sort keys, so search cursors wrap an offset
+        start = offset_cursor_page(cursor, skip)
+        notes = query.order_by(*ranking).offset(start).limit(limit).all()
+        next_cursor = encode_cursor([start + limit]) if len(notes) == limit else None
+    elif sort == "trending":
+        # Engagement flushes and the re-decay job rewrite scores between pages,
+        # so a score cursor would skip or repeat notes; trending cursors wrap an offset
+        start = offset_cursor_page(cursor, skip)
+        notes = query.order_by(Note.trending_score.desc(), Note.id.desc()).offset(start).limit(limit).all()
+        next_cursor = encode_cursor([start + limit]) if len(notes) == limit else None
     else:
-        query = query.order_by(Note.created_at.desc())
+        notes, next_cursor = paginate_keyset(query, [Note.created_at, Note.id], cursor, limit, skip=skip)
     
-    notes = query.offset(skip).limit(limit).all()
+    response = {"notes": [serialize_note_summary(note) for note in notes], "next_cursor": next_cursor}
     
-    result = []
-    for note in notes:
-        result.append({
-            "id": note.id,
-            "title": note.title,
-            "subject": note.subject,
-            "description": note.description,
-            "downloads": note.downloads,
-            "views": note.views,
-            "shares": note.shares,
-            "likes": note.likes,
-            "created_at": note.created_at,
-            "user": {
-                "id": note.user.id,
-                "name": note.user.name
-            }
-        })
+    if include_total:
+        # Totals are an estimate cached for a short while instead of a COUNT on every page
+        count_key = (subject, search)
+        total = note_count_cache.get(count_key)
+        if total is None:
+            total = query.enable_eagerloads(False).order_by(None).count()
+            note_count_cache.set(count_key, total)
+        response["total"] = total
     
-    return {"notes": result, "total": query.count()}
+    return response
 
 @app.get("/api/notes/{note_id}")
-async def get_note_detail(note_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    note = db.query(Note).filter(Note.id == note_id).first()
+def get_note_detail(note_id: int, current_user: Principal = Depends(get_current_principal), db: Session = Depends(get_db)):
+    note = db.query(Note).options(joinedload(Note.user)).filter(Note.id == note_id).first()
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
     
@@ -333,10 +420,10 @@ async def get_note_detail(note_id: int, current_user: User = Depends(get_current
     }
 
 @app.post("/api/notes/{note_id}/download")
-async def download_note(
+def download_note(
     note_id: int,
     request: Request,
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_principal),
     db: Session = Depends(get_db)
 ):
     note = db.query(Note).filter(Note.id == note_id).first()
@@ -360,35 +447,42 @@ async def download_note(
             ip_address=ip_address
         )
         db.add(download)
-        note.downloads += 1
-        
+        # Earnings are not buffered: the download row, count and credit commit
+        # together. Each user takes this path once per note, so unlike views it
+        # is not a hot-row write.
         # Earnings: 1000 downloads = ₹100, so 1 download = ₹0.1
-        note.earnings += 0.1
-        
+        db.query(Note).filter(Note.id == note_id).update(
+            {
+                Note.downloads: Note.downloads + 1,
+                Note.earnings: Note.earnings + DOWNLOAD_EARNINGS
+            },
+            synchronize_session=False
+        )
+        daily_stats.record(db, downloads=1, earnings=DOWNLOAD_EARNINGS)
         db.commit()
+        
+        engagement_counters.increment(note_id, trending=DOWNLOAD_WEIGHT)
     
-    presigned_url = s3_service.generate_presigned_url(note.file_path, 3600)
+    presigned_url = storage.generate_presigned_url(note.file_path, 3600)
     
     return {"download_url": presigned_url, "filename": note.title + ".pdf"}
 
 @app.post("/api/notes/{note_id}/view")
-async def track_view(
+def track_view(
     note_id: int,
     view_duration: int = Form(...),
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_principal),
     db: Session = Depends(get_db)
 ):
-    note = db.query(Note).filter(Note.id == note_id).first()
-    if not note:
+    if not db.query(Note.id).filter(Note.id == note_id).first():
         raise HTTPException(status_code=404, detail="Note not found")
     
-    note.views += 1
-    db.commit()
+    engagement_counters.increment(note_id, views=1)
     
     return {"message": "View tracked"}
 
 @app.post("/api/notes/{note_id}/like")
-async def like_note(note_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def like_note(note_id: int, current_user: Principal = Depends(get_current_principal), db: Session = Depends(get_db)):
     note = db.query(Note).filter(Note.id == note_id).first()
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
@@ -400,30 +494,31 @@ async def like_note(note_id: int, current_user: User = Depends(get_current_user)
     
     if existing_like:
         db.delete(existing_like)
-        note.likes -= 1
+        delta = -1
         message = "Like removed"
     else:
         like = NoteLike(note_id=note_id, user_id=current_user.id)
         db.add(like)
-        note.likes += 1
+        delta = 1
         message = "Note liked"
     
     db.commit()
-    return {"message": message, "likes": note.likes}
+    engagement_counters.increment(note_id, likes=delta, trending=delta * LIKE_WEIGHT)
+    
+    likes = note.likes + int(engagement_counters.pending(note_id, "likes"))
+    return {"message": message, "likes": likes}
 
 @app.post("/api/notes/{note_id}/share")
-async def share_note(note_id: int, db: Session = Depends(get_db)):
-    note = db.query(Note).filter(Note.id == note_id).first()
-    if not note:
+def share_note(note_id: int, db: Session = Depends(get_db)):
+    if not db.query(Note.id).filter(Note.id == note_id).first():
         raise HTTPException(status_code=404, detail="Note not found")
     
-    note.shares += 1
-    db.commit()
+    engagement_counters.increment(note_id, shares=1, trending=SHARE_WEIGHT)
     
     return {"message": "Share counted"}
 
 @app.delete("/api/notes/{note_id}")
-async def delete_note(note_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def delete_note(note_id: int, current_user: Principal = Depends(get_current_principal), db: Session = Depends(get_db)):
     note = db.query(Note).filter(Note.id == note_id).first()
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
@@ -431,14 +526,16 @@ async def delete_note(note_id: int, current_user: User = Depends(get_current_use
     if note.user_id != current_user.id and current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Not authorized")
     
-    s3_service.delete_file(note.file_path)
+    # The file is removed by the outbox worker once this commit lands
+    deletion_outbox.enqueue(db, [note.file_path])
     db.delete(note)
+    daily_stats.record(db, notes_deleted=1)
     db.commit()
     
     return {"message": "Note deleted"}
 
 @app.get("/api/user/my-notes")
-async def get_my_notes(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def get_my_notes(current_user: Principal = Depends(get_current_principal), db: Session = Depends(get_db)):
     notes = db.query(Note).filter(Note.user_id == current_user.id).order_by(Note.created_at.desc()).all()
     
     result = []
@@ -458,7 +555,7 @@ async def get_my_notes(current_user: User = Depends(get_current_user), db: Sessi
     return {"notes": result}
 
 @app.get("/api/user/earnings")
-async def get_earnings(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def get_earnings(current_user: Principal = Depends(get_current_principal), db: Session = Depends(get_db)):
     total_earnings = db.query(func.sum(Note.earnings)).filter(Note.user_id == current_user.id).scalar() or 0
     total_downloads = db.query(func.sum(Note.downloads)).filter(Note.user_id == current_user.id).scalar() or 0
     total_views = db.query(func.sum(Note.views)).filter(Note.user_id == current_user.id).scalar() or 0
@@ -10,3 +10,118 @@ ADD INDEX idx_file_hash (file_hash);
 
 -- Update existing notes with NULL hash (they won't be checked for duplicates)
 UPDATE notes SET file_hash = NULL WHERE file_hash IS NULL;
+
+-- Geohash cell for indexed radius search on books (backfilled at startup)
+ALTER TABLE books
+ADD COLUMN geohash VARCHAR(12),
+ADD INDEX idx_status_geohash (status, geohash);
+
+-- Denormalized primary image pointer so listings don't load book_images
+ALTER TABLE books
+ADD COLUMN primary_image_path VARCHAR(500);
+
+UPDATE books b
+JOIN book_images bi ON bi.id = (
+    SELECT id FROM book_images
+    WHERE book_id = b.id
+    ORDER BY is_primary DESC, id ASC
+    LIMIT 1
+)
+SET b.primary_image_path = bi.image_path;
+
+-- FULLTEXT indexes for ranked note search
+ALTER TABLE notes
+ADD FULLTEXT INDEX ft_notes_title (title),
+ADD FULLTEXT INDEX ft_notes_search (title, description, subject);
+
+-- Time-decayed trending score (72h half-life), seeded from existing engagement
+ALTER TABLE notes
+ADD COLUMN trending_score DOUBLE NOT NULL DEFAULT 0,
+ADD COLUMN trending_updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+ADD INDEX idx_approved_trending (is_approved, trending_score),
+ADD INDEX idx_approved_subject_trending (is_approved, subject, trending_score);
+
+UPDATE notes
+SET trending_score = (downloads + likes * 2 + shares * 3)
+        * POW(0.5, TIMESTAMPDIFF(SECOND, created_at, UTC_TIMESTAMP()) / (72 * 3600)),
+    trending_updated_at = UTC_TIMESTAMP();
+
+-- Revoke tokens by jti + expiry instead of storing the full token string.
+-- Legacy tokens without a jti claim are identified by SHA-256 of the token.
+ALTER TABLE token_blacklist
+ADD COLUMN jti VARCHAR(64),
+ADD COLUMN expires_at DATETIME;
+
+UPDATE token_blacklist
+SET jti = SHA2(token, 256),
+    expires_at = DATE_ADD(blacklisted_at, INTERVAL 7 DAY);
+
+ALTER TABLE token_blacklist
+DROP COLUMN token,
+MODIFY jti VARCHAR(64) NOT NULL,
+MODIFY expires_at DATETIME NOT NULL,
+ADD UNIQUE INDEX ix_token_blacklist_jti (jti),
+ADD INDEX ix_token_blacklist_expires_at (expires_at);
+
+-- Resized thumb/medium/full variants (WebP + JPEG) for book images.
+-- Existing images keep a NULL prefix and are served from image_path as before.
+ALTER TABLE book_images
+ADD COLUMN variant_prefix VARCHAR(500);
+
+ALTER TABLE books
+ADD COLUMN primary_image_prefix VARCHAR(500);
+
+-- Outbox of stored files to delete, written in the same transaction as the row delete
+CREATE TABLE IF NOT EXISTS storage_deletions (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    file_key VARCHAR(500) NOT NULL,
+    attempts INT NOT NULL DEFAULT 0,
+    next_attempt_at DATETIME NOT NULL,
+    last_error TEXT,
+    created_at DATETIME,
+    INDEX ix_storage_deletions_file_key (file_key),
+    INDEX ix_storage_deletions_next_attempt_at (next_attempt_at)
+);
+
+-- AI response cache: persistent tier keyed by normalized prompt hash.
+-- Existing rows keep a NULL hash and are simply never served from cache.
+ALTER TABLE chat_logs
+ADD COLUMN prompt_hash CHAR(64),
+ADD COLUMN cached BOOLEAN NOT NULL DEFAULT FALSE,
+ADD INDEX idx_prompt_hash_created (prompt_hash, created_at);
+
+-- Unread notification counter, kept in step with notifications.is_read
+ALTER TABLE users
+ADD COLUMN unread_notifications INT NOT NULL DEFAULT 0;
+
+UPDATE users u
+SET unread_notifications = (
+    SELECT COUNT(*) FROM notifications n WHERE n.user_id = u.id AND n.is_read = FALSE
+);
+
+-- Daily activity rollups for the admin dashboard; fill with POST /api/admin/analytics/backfill
+-- (also run automatically on startup while the table is empty)
+CREATE TABLE IF NOT EXISTS daily_stats (
+    day DATE PRIMARY KEY,
+    signups INT NOT NULL DEFAULT 0,
+    notes_uploaded INT NOT NULL DEFAULT 0,
+    notes_deleted INT NOT NULL DEFAULT 0,
+    books_listed INT NOT NULL DEFAULT 0,
+    books_deleted INT NOT NULL DEFAULT 0,
+    downloads INT NOT NULL DEFAULT 0,
+    earnings DOUBLE NOT NULL DEFAULT 0,
+    ai_messages INT NOT NULL DEFAULT 0,
+    ai_tokens INT NOT NULL DEFAULT 0
+);
+
+-- Incremental revocation loads read recent rows by blacklisted_at
+ALTER TABLE token_blacklist
+ADD INDEX ix_token_blacklist_blacklisted_at (blacklisted_at);
+
+-- Coordinates daily_stats rebuilds between workers: a lease for the running
+-- rebuild, and the time it read the source tables
+CREATE TABLE IF NOT EXISTS rollup_state (
+    name VARCHAR(50) PRIMARY KEY,
+    rebuilt_at DATETIME NULL,
+    locked_until DATETIME NULL
+);
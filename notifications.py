@@ -0,0 +1,196 @@
+import asyncio
+import json
+from collections import defaultdict
+from typing import Callable, Optional
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import event, update, select
+from sqlalchemy.orm import Session
+from database import Notification, User
+from config import get_settings
+
+settings = get_settings()
+
+PENDING_EVENTS_KEY = "pending_notification_events"
+
+class InProcessNotificationBackend:
+    """Delivers events only to streams connected to this worker"""
+    
+    def __init__(self):
+        self._loop = None
+        self._dispatch = None
+    
+    def publish(self, message: str):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._dispatch, message)
+    
+    async def listen(self, dispatch: Callable[[str], None]):
+        self._loop = asyncio.get_running_loop()
+        self._dispatch = dispatch
+    
+    async def close(self):
+        self._loop = None
+
+class RedisNotificationBackend:
+    """Fans events out to every worker through a Redis pub/sub channel"""
+    
+    CHANNEL = "notifications"
+    
+    def __init__(self, redis_url: str):
+        import redis
+        self.redis_url = redis_url
+        self.redis = redis.Redis.from_url(redis_url)
+        self._client = None
+    
+    def publish(self, message: str):
+        self.redis.publish(self.CHANNEL, message)
+    
+    async def listen(self, dispatch: Callable[[str], None]):
+        import redis.asyncio
+        self._client = redis.asyncio.Redis.from_url(self.redis_url)
+        while True:
+            try:
+                async with self._client.pubsub() as pubsub:
+                    await pubsub.subscribe(self.CHANNEL)
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            dispatch(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Notification channel lost, reconnecting: {e}")
+                await asyncio.sleep(1)
+    
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+class NotificationHub:
+    """Pushes notification events to the user's open event streams.
+    
+    Each stream owns a bounded queue; when a slow client falls behind, the
+    oldest events are dropped because the client can always re-fetch the
+    list. Events go through the backend so that, with Redis, a notification
+    committed on one worker reaches streams held by the others.
+    """
+    
+    def __init__(self, backend=None):
+        self.backend = backend or InProcessNotificationBackend()
+        self.queue_size = settings.NOTIFICATION_STREAM_QUEUE_SIZE
+        self.max_streams_per_user = settings.NOTIFICATION_MAX_STREAMS_PER_USER
+        self._streams = defaultdict(set)
+        self._listener = None
+    
+    async def start(self):
+        self._listener = asyncio.create_task(self.backend.listen(self._dispatch))
+    
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        await self.backend.close()
+    
+    def has_capacity(self, user_id: int) -> bool:
+        return len(self._streams.get(user_id, ())) < self.max_streams_per_user
+    
+    def subscribe(self, user_id: int) -> Optional[asyncio.Queue]:
+        """Queue of events for one stream, or None if the user has too many streams open"""
+        if not self.has_capacity(user_id):
+            return None
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._streams[user_id].add(queue)
+        return queue
+    
+    def unsubscribe(self, user_id: int, queue: asyncio.Queue):
+        streams = self._streams.get(user_id)
+        if streams is not None:
+            streams.discard(queue)
+            if not streams:
+                del self._streams[user_id]
+    
+    def connected_streams(self) -> int:
+        return sum(len(streams) for streams in self._streams.values())
+    
+    def publish(self, user_id: int, event: dict):
+        """Send an event to the user's streams on every worker; safe to call from any thread"""
+        message = json.dumps({"user_id": user_id, "event": jsonable_encoder(event)})
+        try:
+            self.backend.publish(message)
+        except Exception as e:
+            print(f"❌ Failed to publish notification event for user {user_id}: {e}")
+    
+    def _dispatch(self, message):
+        data = json.loads(message)
+        for queue in self._streams.get(data["user_id"], ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(data["event"])
+
+def create_notification_hub() -> NotificationHub:
+    if settings.REDIS_URL:
+        return NotificationHub(RedisNotificationBackend(settings.REDIS_URL))
+    return NotificationHub()
+
+notification_hub = create_notification_hub()
+
+def serialize_notification(notification: Notification) -> dict:
+    return {
+        "id": notification.id,
+        "title": notification.title,
+        "message": notification.message,
+        "is_read": notification.is_read,
+        "created_at": notification.created_at
+    }
+
+def publish_after_commit(db: Session, user_id: int, event: dict):
+    """Push `event` to the user once the session's current transaction commits"""
+    db.info.setdefault(PENDING_EVENTS_KEY, []).append((user_id, event))
+
+@event.listens_for(Session, "after_commit")
+def _publish_pending_events(session):
+    for user_id, pending_event in session.info.pop(PENDING_EVENTS_KEY, []):
+        notification_hub.publish(user_id, pending_event)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending_events(session):
+    session.info.pop(PENDING_EVENTS_KEY, None)
+
+def unread_count(db: Session, user_id: int) -> int:
+    return db.execute(select(User.unread_notifications).where(User.id == user_id)).scalar_one_or_none() or 0
+
+def _adjust_unread(db: Session, user_id: int, delta: int) -> int:
+    db.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(unread_notifications=User.unread_notifications + delta)
+        .execution_options(synchronize_session=False)
+    )
+    # Read back inside the transaction, while the row is still locked
+    return unread_count(db, user_id)
+
+def create_notification(db: Session, user_id: int, title: str, message: str) -> Notification:
+    """Add a notification and bump the unread counter; it is pushed when the caller commits"""
+    notification = Notification(user_id=user_id, title=title, message=message, is_read=False)
+    db.add(notification)
+    db.flush()
+    
+    publish_after_commit(db, user_id, {
+        "type": "notification",
+        "notification": serialize_notification(notification),
+        "unread_count": _adjust_unread(db, user_id, 1)
+    })
+    return notification
+
+def mark_read(db: Session, user_id: int, notification_ids=None) -> int:
+    """Mark the given (or all) unread notifications read; returns how many changed"""
+    statement = update(Notification).where(Notification.user_id == user_id, Notification.is_read == False)
+    if notification_ids is not None:
+        statement = statement.where(Notification.id.in_(notification_ids))
+    marked = db.execute(statement.values(is_read=True).execution_options(synchronize_session=False)).rowcount
+    
+    if marked:
+        publish_after_commit(db, user_id, {
+            "type": "unread_count",
+            "unread_count": _adjust_unread(db, user_id, -marked)
+        })
+    return marked
@@ -0,0 +1,281 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from fastapi import HTTPException
+from collections import OrderedDict
+from PyPDF2 import PdfReader, PdfWriter, Transformation
+from reportlab.pdfgen import canvas
+from config import get_settings
+
+settings = get_settings()
+
+class InvalidPdfError(Exception):
+    pass
+
+WATERMARK_FONT_SIZE = 8
+WATERMARK_OFFSET = (50, 30)  # from the bottom-left corner of the page as displayed
+WATERMARK_CACHE_SIZE = 32
+
+# (width, height, rotation, text) -> parsed overlay page, per process
+_overlay_cache = OrderedDict()
+_overlay_lock = threading.Lock()
+
+def _render_overlay(width: float, height: float, rotation: int, text: str):
+    """Render a one-page watermark overlay matching a page's size and /Rotate"""
+    packet = BytesIO()
+    can = canvas.Canvas(packet, pagesize=(width, height))
+    can.setFont("Helvetica", WATERMARK_FONT_SIZE)
+    can.setFillColorRGB(0.7, 0.7, 0.7, alpha=0.3)
+    
+    # Map the displayed bottom-left offset back into unrotated page space
+    x, y = WATERMARK_OFFSET
+    if rotation == 90:
+        can.translate(width - y, x)
+    elif rotation == 180:
+        can.translate(width - x, height - y)
+    elif rotation == 270:
+        can.translate(y, height - x)
+    else:
+        can.translate(x, y)
+    can.rotate(rotation)
+    can.drawString(0, 0, text)
+    can.save()
+    
+    packet.seek(0)
+    return PdfReader(packet).pages[0]
+
+def get_watermark_overlay(width: float, height: float, rotation: int, text: str):
+    """Cached overlay page; pages of the same size share one rendered overlay"""
+    key = (round(width, 2), round(height, 2), rotation, text)
+    with _overlay_lock:
+        overlay = _overlay_cache.get(key)
+        if overlay is not None:
+            _overlay_cache.move_to_end(key)
+            return overlay
+    
+    overlay = _render_overlay(width, height, rotation, text)
+    with _overlay_lock:
+        _overlay_cache[key] = overlay
+        while len(_overlay_cache) > WATERMARK_CACHE_SIZE:
+            _overlay_cache.popitem(last=False)
+    return overlay
+
+def add_watermark(source, user_id: int, output=None) -> bytes:
+    """Add watermark to PDF.
+    
+    `source` is the PDF bytes or a path to the PDF. Writes to `output` when
+    given (and returns None), otherwise returns the watermarked bytes. On
+    failure the original PDF is passed through.
+    """
+    start = output.tell() if output is not None else 0
+    try:
+        pdf_reader = PdfReader(BytesIO(source) if isinstance(source, bytes) else source)
+        pdf_writer = PdfWriter()
+        
+        watermark_text = f"NotesHub - User ID: {user_id}"
+        
+        for page in pdf_reader.pages:
+            mediabox = page.mediabox
+            rotation = (page.rotation or 0) % 360
+            overlay = get_watermark_overlay(float(mediabox.width), float(mediabox.height), rotation, watermark_text)
+            
+            left, bottom = float(mediabox.left), float(mediabox.bottom)
+            if left or bottom:
+                page.merge_transformed_page(overlay, Transformation().translate(left, bottom))
+            else:
+                page.merge_page(overlay)
+            pdf_writer.add_page(page)
+        
+        if output is not None:
+            pdf_writer.write(output)
+            return None
+        
+        buffer = BytesIO()
+        pdf_writer.write(buffer)
+        return buffer.getvalue()
+    except Exception as e:
+        print(f"Watermark error: {e}")
+        original = source if isinstance(source, bytes) else None
+        if output is None:
+            if original is None:
+                with open(source, "rb") as f:
+                    original = f.read()
+            return original
+        output.seek(start)
+        output.truncate()
+        if original is not None:
+            output.write(original)
+        else:
+            with open(source, "rb") as f:
+                shutil.copyfileobj(f, output)
+        return None
+
+def process_pdf_job(pdf_path: str, output_path: str, user_id: int, submitted_at: float) -> dict:
+    """Validate and watermark a spooled PDF upload. Runs in a worker process.
+    
+    Reads from `pdf_path` and writes the watermarked PDF to `output_path`, so
+    neither copy has to be pickled across the process boundary.
+    """
+    started_at = time.time()
+    
+    try:
+        page_count = len(PdfReader(pdf_path).pages)
+    except Exception as e:
+        raise InvalidPdfError(f"Invalid PDF file: {str(e)}")
+    if page_count < 1:
+        raise InvalidPdfError(f"PDF must have at least 1 page (found {page_count})")
+    
+    with open(output_path, "wb") as output:
+        add_watermark(pdf_path, user_id, output)
+    
+    return {
+        "page_count": page_count,
+        "watermarked_size": os.path.getsize(output_path),
+        "queue_wait_seconds": started_at - submitted_at,
+        "processing_seconds": time.time() - started_at
+    }
+
+class PdfProcessor:
+    """Process pool for PDF ingestion with bounded queue depth and per-job timeouts.
+    
+    Jobs beyond PDF_WORKERS + PDF_MAX_QUEUE in flight are rejected with 503
+    instead of piling up. A running job cannot be cancelled, so one that
+    outlives PDF_JOB_TIMEOUT_SECONDS gets its pool's workers terminated and
+    gives its slot back at once; other jobs on that pool fail with a
+    retryable 503 and the next job starts a fresh pool.
+    """
+    
+    def __init__(self):
+        self.max_workers = settings.PDF_WORKERS
+        self.max_in_flight = settings.PDF_WORKERS + settings.PDF_MAX_QUEUE
+        self.timeout = settings.PDF_JOB_TIMEOUT_SECONDS
+        self._executor = None
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._metrics = {
+            "completed": 0,
+            "rejected": 0,
+            "timed_out": 0,
+            "failed": 0,
+            "queue_wait_seconds_total": 0.0,
+            "queue_wait_seconds_max": 0.0,
+            "processing_seconds_total": 0.0,
+            "processing_seconds_max": 0.0
+        }
+    
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn avoids forking a process that already runs threads
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+    
+    def _slot_releaser(self):
+        """Callable that gives back one in-flight slot the first time it is called"""
+        released = False
+        
+        def release(_future=None):
+            nonlocal released
+            with self._lock:
+                if not released:
+                    released = True
+                    self._in_flight -= 1
+        return release
+    
+    def _discard(self, executor: ProcessPoolExecutor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+    
+    def _recycle(self, executor: ProcessPoolExecutor):
+        """Kill the workers of a pool holding a stuck job; the next submit starts a fresh pool"""
+        self._discard(executor)
+        # The executor has no public handle on its workers
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        # Jobs still on this pool, running or queued, fail with BrokenProcessPool
+        executor.shutdown(wait=False)
+    
+    def _record(self, result: dict):
+        with self._lock:
+            metrics = self._metrics
+            metrics["completed"] += 1
+            metrics["queue_wait_seconds_total"] += result["queue_wait_seconds"]
+            metrics["queue_wait_seconds_max"] = max(metrics["queue_wait_seconds_max"], result["queue_wait_seconds"])
+            metrics["processing_seconds_total"] += result["processing_seconds"]
+            metrics["processing_seconds_max"] = max(metrics["processing_seconds_max"], result["processing_seconds"])
+    
+    async def process(self, pdf_path: str, output_path: str, user_id: int) -> dict:
+        with self._lock:
+            if self._in_flight >= self.max_in_flight:
+                self._metrics["rejected"] += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail="PDF processing is busy, try again shortly",
+                    headers={"Retry-After": "5"}
+                )
+            self._in_flight += 1
+        
+        release = self._slot_releaser()
+        executor = self._get_executor()
+        try:
+            job = executor.submit(process_pdf_job, pdf_path, output_path, user_id, time.time())
+        except (BrokenProcessPool, RuntimeError):
+            # Broken, or shut down by a recycle that raced with this submit
+            self._discard(executor)
+            release()
+            raise HTTPException(status_code=503, detail="PDF processing unavailable, try again shortly")
+        job.add_done_callback(release)
+        
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(job), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self._recycle(executor)
+            release()
+            with self._lock:
+                self._metrics["timed_out"] += 1
+            raise HTTPException(status_code=503, detail="PDF processing timed out")
+        except InvalidPdfError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except BrokenProcessPool:
+            # A worker died, or the pool was recycled because of another job
+            self._discard(executor)
+            with self._lock:
+                self._metrics["failed"] += 1
+            raise HTTPException(status_code=503, detail="PDF processing unavailable, try again shortly")
+        
+        self._record(result)
+        return result
+    
+    def metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+            in_flight = self._in_flight
+        completed = metrics["completed"] or 1
+        return {
+            "in_flight": in_flight,
+            "max_in_flight": self.max_in_flight,
+            "completed": metrics["completed"],
+            "rejected": metrics["rejected"],
+            "timed_out": metrics["timed_out"],
+            "failed": metrics["failed"],
+            "avg_queue_wait_seconds": round(metrics["queue_wait_seconds_total"] / completed, 4),
+            "max_queue_wait_seconds": round(metrics["queue_wait_seconds_max"], 4),
+            "avg_processing_seconds": round(metrics["processing_seconds_total"] / completed, 4),
+            "max_processing_seconds": round(metrics["processing_seconds_max"], 4)
+        }
+    
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+pdf_processor = PdfProcessor()
@@ -0,0 +1,75 @@
+from datetime import datetime, time
+from typing import Optional
+from sqlalchemy import update, select, case, or_, func
+from database import User, UserRole
+from config import get_settings
+
+settings = get_settings()
+
+QUOTAS = {
+    "ai_messages": (User.ai_messages_today, User.ai_messages_reset_date, "AI_DAILY_LIMIT"),
+    "note_uploads": (User.notes_uploaded_today, User.notes_upload_reset_date, "NOTE_UPLOAD_DAILY_LIMIT")
+}
+
+class QuotaService:
+    """Daily per-user quotas kept on the users row.
+    
+    A reservation checks the limit, resets a counter left over from a previous
+    day and increments it in one conditional UPDATE, so parallel requests
+    cannot both take the last unit. The reservation is committed straight
+    away; callers refund it if the work it paid for fails.
+    """
+    
+    def limit_for(self, kind: str, role) -> int:
+        role = UserRole(role)
+        return getattr(settings, f"{QUOTAS[kind][2]}_{role.name}")
+    
+    def remaining(self, user: User, kind: str) -> int:
+        """Units left today according to an already loaded user row"""
+        count_column, reset_column, _ = QUOTAS[kind]
+        limit = self.limit_for(kind, user.role)
+        reset_date = getattr(user, reset_column.key)
+        if reset_date is None or reset_date.date() < datetime.utcnow().date():
+            return limit
+        return max(limit - (getattr(user, count_column.key) or 0), 0)
+    
+    def reserve(self, db, user_id: int, role, kind: str) -> Optional[int]:
+        """Take one unit of today's quota; returns how many are left, or None if the limit is reached"""
+        count_column, reset_column, _ = QUOTAS[kind]
+        limit = self.limit_for(kind, role)
+        now = datetime.utcnow()
+        stale = or_(reset_column.is_(None), reset_column < datetime.combine(now.date(), time.min))
+        
+        # MySQL applies SET assignments left to right, so the count must be
+        # computed before the reset date it depends on is overwritten
+        result = db.execute(
+            update(User)
+            .where(User.id == user_id, or_(stale, count_column < limit))
+            .ordered_values(
+                (count_column, case((stale, 1), else_=func.coalesce(count_column, 0) + 1)),
+                (reset_column, case((stale, now), else_=reset_column))
+            )
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            db.rollback()
+            return None
+        
+        used = db.execute(select(count_column).where(User.id == user_id)).scalar_one()
+        db.commit()
+        return limit - used
+    
+    def refund(self, db, user_id: int, kind: str):
+        """Give back a unit taken today by `reserve` whose work did not go through"""
+        count_column, reset_column, _ = QUOTAS[kind]
+        today = datetime.combine(datetime.utcnow().date(), time.min)
+        db.rollback()
+        db.execute(
+            update(User)
+            .where(User.id == user_id, count_column > 0, reset_column >= today)
+            .values({count_column: count_column - 1})
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+
+quota_service = QuotaService()
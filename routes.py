@@ -1,16 +1,41 @@
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Request
-from sqlalchemy.orm import Session
-from sqlalchemy import and_, func, or_
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy import and_, func, or_, insert
 from datetime import datetime, timedelta
 from typing import List
+import asyncio
+import json
+import anyio
+from contextlib import AsyncExitStack
 
-from database import get_db, User, Book, BookImage, BookBuyRequest, Notification, ChatLog, BookStatus, BookCondition, RequestStatus, UserRole
-from auth import get_current_user
-from s3_service import s3_service
+from database import get_db, SessionLocal, User, Book, BookImage, BookBuyRequest, Notification, ChatLog, BookStatus, BookCondition, RequestStatus, UserRole
+from auth import get_current_user, get_current_principal, Principal
+from storage import storage
 from ai_service import ai_service
-from utils import rate_limiter, is_within_radius, reset_daily_counter_if_needed, calculate_distance
+from ai_cache import ai_response_cache
+from ai_scheduler import ai_scheduler
+from quota_service import quota_service
+from analytics_rollups import daily_stats
+from notifications import notification_hub, create_notification, mark_read, unread_count, serialize_notification
+from config import get_settings
+from deletion_outbox import deletion_outbox
+from image_processing import build_image_variants, variant_key, variant_keys, InvalidImageError
+from utils import rate_limiter, encode_geohash, bounding_box, geohash_cells_for_bbox, haversine_distances, encode_cursor, paginate_keyset, offset_cursor_page, read_upload_limited, MB
 
 router = APIRouter()
+settings = get_settings()
+
+# Caps image uploads to storage in flight across all requests
+image_upload_slots = asyncio.Semaphore(settings.IMAGE_UPLOAD_CONCURRENCY)
+
+def variant_urls(image_path: str, variant_prefix: str, variant: str):
+    """(JPEG URL, WebP URL) for one image variant, valid for 24 hours"""
+    return (
+        storage.generate_presigned_url(variant_key(image_path, variant_prefix, variant, "jpg"), 86400),
+        storage.generate_presigned_url(variant_key(image_path, variant_prefix, variant, "webp"), 86400)
+    )
 
 # BOOKS ROUTES
 @router.post("/api/books/upload")
@@ -23,7 +48,7 @@ async def upload_book(
     longitude: float = Form(...),
     location_name: str = Form(None),
     images: List[UploadFile] = File(...),
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_principal),
     db: Session = Depends(get_db)
 ):
     print(f"📤 Uploading book with {len(images)} images")
@@ -31,27 +56,13 @@ async def upload_book(
     if len(images) > 5:
         raise HTTPException(status_code=400, detail="Maximum 5 images allowed")
     
-    expires_at = datetime.utcnow() + timedelta(days=30)
-    
-    book = Book(
-        user_id=current_user.id,
-        title=title,
-        description=description,
-        condition=BookCondition(condition),
-        price=price,
-        latitude=latitude,
-        longitude=longitude,
-        location_name=location_name,
-        status=BookStatus.AVAILABLE,
-        expires_at=expires_at
-    )
-    db.add(book)
-    db.commit()
-    db.refresh(book)
-    
-    print(f"✅ Book created with ID: {book.id}")
+    try:
+        book_condition = BookCondition(condition)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid condition")
     
-    uploaded_count = 0
+    # Read and validate images on the event loop; everything after this blocks
+    valid_images = []
     for idx, image in enumerate(images):
         print(f"📷 Processing image {idx + 1}: {image.filename}, type: {image.content_type}")
         
@@ -66,41 +77,102 @@ async def upload_book(
             print(f"❌ Skipped - invalid extension: {image.filename}")
             continue
         
-        image_content = await image.read()
-        print(f"📏 Image size: {len(image_content)} bytes")
-        
-        if len(image_content) > 5 * 1024 * 1024:
+        # Read in chunks and stop as soon as the image passes the limit
+        image_content = await read_upload_limited(image, settings.MAX_IMAGE_SIZE_MB * MB)
+        if image_content is None:
             print(f"❌ Skipped - too large")
             continue
+        print(f"📏 Image size: {len(image_content)} bytes")
         
+        valid_images.append((idx, image.filename, image_content))
+    
+    async def upload_variant(file_key, content_type, content):
+        async with image_upload_slots:
+            return await run_in_threadpool(storage.upload_book_image_variant, file_key, content, content_type)
+    
+    # Process and upload all images in parallel; book latency tracks the slowest image, not the sum
+    async def upload_image(idx, filename, image_content):
         try:
-            image_path = s3_service.upload_book_image(image_content, image.filename, current_user.id)
-            print(f"☁️ Uploaded to S3: {image_path}")
-            
-            book_image = BookImage(
-                book_id=book.id,
-                image_path=image_path,
-                is_primary=(idx == 0)
-            )
-            db.add(book_image)
-            uploaded_count += 1
-            print(f"✅ Image {idx + 1} saved to database")
-        except Exception as e:
-            print(f"❌ Error uploading image {idx + 1}: {e}")
+            variants = await run_in_threadpool(build_image_variants, image_content)
+        except InvalidImageError as e:
+            print(f"❌ Skipped image {idx + 1}: {e}")
+            return None
+        
+        variant_prefix = storage.book_image_prefix(current_user.id)
+        results = await asyncio.gather(*[
+            upload_variant(f"{variant_prefix}/{name}", content_type, content)
+            for name, (content_type, content) in variants.items()
+        ], return_exceptions=True)
+        
+        failed = [result for result in results if isinstance(result, BaseException)]
+        if failed:
+            print(f"❌ Error uploading image {idx + 1}: {failed[0]}")
+            uploaded = [key for key in results if isinstance(key, str)]
+            if uploaded:
+                await run_in_threadpool(deletion_outbox.delete_now, uploaded)
+            return None
+        
+        print(f"☁️ Uploaded to storage: {variant_prefix}/ ({len(results)} variants)")
+        return variant_prefix
     
-    db.commit()
-    print(f"🎉 Total {uploaded_count} images uploaded for book {book.id}")
+    results = await asyncio.gather(*[upload_image(*image) for image in valid_images])
+    variant_prefixes = [prefix for prefix in results if prefix]
+    image_paths = [variant_key(None, prefix, "full") for prefix in variant_prefixes]
     
-    return {"message": "Book uploaded successfully", "book_id": book.id, "images_uploaded": uploaded_count}
+    def store_book():
+        expires_at = datetime.utcnow() + timedelta(days=30)
+        
+        book = Book(
+            user_id=current_user.id,
+            title=title,
+            description=description,
+            condition=book_condition,
+            price=price,
+            latitude=latitude,
+            longitude=longitude,
+            location_name=location_name,
+            geohash=encode_geohash(latitude, longitude),
+            status=BookStatus.AVAILABLE,
+            expires_at=expires_at,
+            primary_image_path=image_paths[0] if image_paths else None,
+            primary_image_prefix=variant_prefixes[0] if variant_prefixes else None
+        )
+        db.add(book)
+        db.flush()
+        
+        # Book and all of its images land in one transaction
+        if image_paths:
+            db.execute(insert(BookImage), [
+                {"book_id": book.id, "image_path": image_path, "variant_prefix": prefix, "is_primary": position == 0}
+                for position, (image_path, prefix) in enumerate(zip(image_paths, variant_prefixes))
+            ])
+        daily_stats.record(db, books_listed=1)
+        db.commit()
+        
+        print(f"✅ Book created with ID: {book.id}")
+        print(f"🎉 Total {len(image_paths)} images uploaded for book {book.id}")
+        
+        return {"message": "Book uploaded successfully", "book_id": book.id, "images_uploaded": len(image_paths)}
+    
+    try:
+        return await run_in_threadpool(store_book)
+    except Exception:
+        # Don't leave orphaned objects behind when the book never got saved
+        await run_in_threadpool(db.rollback)
+        keys = [key for image_path, prefix in zip(image_paths, variant_prefixes) for key in variant_keys(image_path, prefix)]
+        if keys:
+            await run_in_threadpool(deletion_outbox.delete_now, keys)
+        raise
 
 @router.get("/api/books")
-async def get_books(
+def get_books(
     skip: int = 0,
     limit: int = 20,
     latitude: float = None,
     longitude: float = None,
     radius: float = 10,
     search: str = None,
+    cursor: str = None,
     db: Session = Depends(get_db)
 ):
     query = db.query(Book).filter(
@@ -116,22 +188,51 @@ async def get_books(
             )
         )
     
-    books = query.order_by(Book.created_at.desc()).offset(skip).limit(limit).all()
+    distances = {}
+    if latitude is not None and longitude is not None:
+        # Geo mode: prefilter candidates in SQL with geohash cells and a bounding box,
+        # then rank by exact distance and paginate over the ranked list
+        min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius)
+        query = query.filter(Book.latitude.between(min_lat, max_lat))
+        
+        cells = geohash_cells_for_bbox(min_lat, max_lat, min_lon, max_lon)
+        if cells:
+            query = query.filter(
+                Book.longitude.between(min_lon, max_lon),
+                or_(*[Book.geohash.like(f"{cell}%") for cell in cells])
+            )
+        
+        candidates = query.with_entities(Book.id, Book.latitude, Book.longitude).all()
+        candidate_distances = haversine_distances(
+            latitude, longitude, [(c.latitude, c.longitude) for c in candidates]
+        )
+        ranked = sorted(
+            (distance, c.id) for c, distance in zip(candidates, candidate_distances) if distance <= radius
+        )
+        # Distance order is computed per request, so geo cursors wrap an offset
+        start = offset_cursor_page(cursor, skip)
+        page = ranked[start:start + limit]
+        next_cursor = encode_cursor([start + limit]) if start + limit < len(ranked) else None
+        distances = {book_id: distance for distance, book_id in page}
+        
+        books_by_id = {
+            book.id: book
+            for book in db.query(Book).options(joinedload(Book.user)).filter(Book.id.in_(list(distances))).all()
+        } if distances else {}
+        books = [books_by_id[book_id] for _, book_id in page if book_id in books_by_id]
+    else:
+        books, next_cursor = paginate_keyset(
+            query.options(joinedload(Book.user)), [Book.created_at, Book.id], cursor, limit, skip=skip
+        )
     
     result = []
     for book in books:
-        distance = None
-        if latitude and longitude:
-            distance = round(calculate_distance(latitude, longitude, book.latitude, book.longitude), 2)
-            if distance > radius:
-                continue
+        distance = round(distances[book.id], 2) if book.id in distances else None
         
-        primary_image = next((img for img in book.images if img.is_primary), book.images[0] if book.images else None)
-        
-        image_url = None
-        if primary_image:
+        image_url = image_url_webp = None
+        if book.primary_image_path:
             try:
-                image_url = s3_service.generate_presigned_url(primary_image.image_path, 86400)  # 24 hours
+                image_url, image_url_webp = variant_urls(book.primary_image_path, book.primary_image_prefix, "thumb")
             except Exception as e:
                 print(f"Error generating presigned URL for book {book.id}: {e}")
         
@@ -144,6 +245,7 @@ async def get_books(
             "location_name": book.location_name,
             "distance_km": distance,
             "primary_image": image_url,
+            "primary_image_webp": image_url_webp,
             "created_at": book.created_at,
             "user": {
                 "id": book.user.id,
@@ -151,21 +253,26 @@ async def get_books(
             }
         })
     
-    return {"books": result}
+    return {"books": result, "next_cursor": next_cursor}
 
 @router.get("/api/books/{book_id}")
-async def get_book_detail(book_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    book = db.query(Book).filter(Book.id == book_id).first()
+def get_book_detail(book_id: int, current_user: Principal = Depends(get_current_principal), db: Session = Depends(get_db)):
+    book = db.query(Book).options(
+        joinedload(Book.user),
+        selectinload(Book.images)
+    ).filter(Book.id == book_id).first()
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
     images = []
     for img in book.images:
         try:
-            url = s3_service.generate_presigned_url(img.image_path, 86400)  # 24 hours
+            url, url_webp = variant_urls(img.image_path, img.variant_prefix, "medium")
             images.append({
                 "id": img.id,
                 "url": url,
+                "url_webp": url_webp,
+                "full_url": storage.generate_presigned_url(variant_key(img.image_path, img.variant_prefix, "full"), 86400),
                 "is_primary": img.is_primary
             })
             print(f"✅ Image URL generated for book {book_id}: {img.image_path}")
@@ -212,11 +319,11 @@ class BuyRequestData(BaseModel):
     message: Optional[str] = None
 
 @router.post("/api/books/{book_id}/buy-request")
-async def create_buy_request(
+def create_buy_request(
     book_id: int,
     data: BuyRequestData,
     request: Request,
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_principal),
     db: Session = Depends(get_db)
 ):
     book = db.query(Book).filter(Book.id == book_id).first()
@@ -255,13 +362,12 @@ async def create_buy_request(
     db.add(buy_request)
     db.flush()
     
-    notification = Notification(
-        user_id=book.user_id,
-        title="New Buy Request",
-        message=f"{current_user.name} wants to buy your book: {book.title}"
+    create_notification(
+        db,
+        book.user_id,
+        "New Buy Request",
+        f"{current_user.name} wants to buy your book: {book.title}"
     )
-    db.add(notification)
-    
     db.commit()
     
     print(f"✅ Notification created for user {book.user_id}: {current_user.name} wants to buy {book.title}")
@@ -269,22 +375,29 @@ async def create_buy_request(
     return {"message": "Buy request sent successfully"}
 
 @router.get("/api/user/my-books")
-async def get_my_books(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def get_my_books(current_user: Principal = Depends(get_current_principal), db: Session = Depends(get_db)):
     books = db.query(Book).filter(Book.user_id == current_user.id).order_by(Book.created_at.desc()).all()
     
+    # One grouped count for all of the user's books instead of one COUNT per book
+    pending_counts = dict(
+        db.query(BookBuyRequest.book_id, func.count(BookBuyRequest.id))
+        .join(Book, Book.id == BookBuyRequest.book_id)
+        .filter(
+            Book.user_id == current_user.id,
+            BookBuyRequest.status == RequestStatus.PENDING
+        )
+        .group_by(BookBuyRequest.book_id)
+        .all()
+    )
+    
     result = []
     for book in books:
-        primary_image = next((img for img in book.images if img.is_primary), book.images[0] if book.images else None)
+        pending_requests = pending_counts.get(book.id, 0)
         
-        pending_requests = db.query(BookBuyRequest).filter(
-            BookBuyRequest.book_id == book.id,
-            BookBuyRequest.status == RequestStatus.PENDING
-        ).count()
-        
-        image_url = None
-        if primary_image:
+        image_url = image_url_webp = None
+        if book.primary_image_path:
             try:
-                image_url = s3_service.generate_presigned_url(primary_image.image_path, 86400)  # 24 hours
+                image_url, image_url_webp = variant_urls(book.primary_image_path, book.primary_image_prefix, "thumb")
             except Exception as e:
                 print(f"Error generating presigned URL: {e}")
         
@@ -294,6 +407,7 @@ async def get_my_books(current_user: User = Depends(get_current_user), db: Sessi
             "price": book.price,
             "status": book.status,
             "primary_image": image_url,
+            "primary_image_webp": image_url_webp,
             "requests_count": pending_requests,
             "created_at": book.created_at,
             "expires_at": book.expires_at
@@ -302,7 +416,7 @@ async def get_my_books(current_user: User = Depends(get_current_user), db: Sessi
     return {"books": result}
 
 @router.get("/api/books/{book_id}/requests")
-async def get_book_requests(book_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def get_book_requests(book_id: int, current_user: Principal = Depends(get_current_principal), db: Session = Depends(get_db)):
     book = db.query(Book).filter(Book.id == book_id).first()
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
@@ -310,7 +424,9 @@ async def get_book_requests(book_id: int, current_user: User = Depends(get_curre
     if book.user_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not authorized")
     
-    requests = db.query(BookBuyRequest).filter(BookBuyRequest.book_id == book_id).order_by(BookBuyRequest.created_at.desc()).all()
+    requests = db.query(BookBuyRequest).options(
+        joinedload(BookBuyRequest.buyer)
+    ).filter(BookBuyRequest.book_id == book_id).order_by(BookBuyRequest.created_at.desc()).all()
     
     result = []
     for req in requests:
@@ -331,7 +447,7 @@ async def get_book_requests(book_id: int, current_user: User = Depends(get_curre
     return {"requests": result}
 
 @router.post("/api/books/requests/{request_id}/accept")
-async def accept_request(request_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def accept_request(request_id: int, current_user: Principal = Depends(get_current_principal), db: Session = Depends(get_db)):
     buy_request = db.query(BookBuyRequest).filter(BookBuyRequest.id == request_id).first()
     if not buy_request:
         raise HTTPException(status_code=404, detail="Request not found")
@@ -343,19 +459,18 @@ async def accept_request(request_id: int, current_user: User = Depends(get_curre
     buy_request.status = RequestStatus.ACCEPTED
     book.status = BookStatus.RESERVED
     
-    notification = Notification(
-        user_id=buy_request.buyer_id,
-        title="Request Accepted",
-        message=f"Your request for {book.title} has been accepted"
+    create_notification(
+        db,
+        buy_request.buyer_id,
+        "Request Accepted",
+        f"Your request for {book.title} has been accepted"
     )
-    db.add(notification)
-    
     db.commit()
     
     return {"message": "Request accepted"}
 
 @router.post("/api/books/requests/{request_id}/reject")
-async def reject_request(request_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def reject_request(request_id: int, current_user: Principal = Depends(get_current_principal), db: Session = Depends(get_db)):
     buy_request = db.query(BookBuyRequest).filter(BookBuyRequest.id == request_id).first()
     if not buy_request:
         raise HTTPException(status_code=404, detail="Request not found")
@@ -366,19 +481,18 @@ async def reject_request(request_id: int, current_user: User = Depends(get_curre
     
     buy_request.status = RequestStatus.REJECTED
     
-    notification = Notification(
-        user_id=buy_request.buyer_id,
-        title="Request Rejected",
-        message=f"Your request for {book.title} has been rejected"
+    create_notification(
+        db,
+        buy_request.buyer_id,
+        "Request Rejected",
+        f"Your request for {book.title} has been rejected"
     )
-    db.add(notification)
-    
     db.commit()
     
     return {"message": "Request rejected"}
 
 @router.post("/api/books/{book_id}/mark-sold")
-async def mark_book_sold(book_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def mark_book_sold(book_id: int, current_user: Principal = Depends(get_current_principal), db: Session = Depends(get_db)):
     book = db.query(Book).filter(Book.id == book_id).first()
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
@@ -392,7 +506,7 @@ async def mark_book_sold(book_id: int, current_user: User = Depends(get_current_
     return {"message": "Book marked as sold"}
 
 @router.delete("/api/books/{book_id}")
-async def delete_book(book_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def delete_book(book_id: int, current_user: Principal = Depends(get_current_principal), db: Session = Depends(get_db)):
     book = db.query(Book).filter(Book.id == book_id).first()
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
@@ -400,56 +514,213 @@ async def delete_book(book_id: int, current_user: User = Depends(get_current_use
     if book.user_id != current_user.id and current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Not authorized")
     
-    for image in book.images:
-        s3_service.delete_file(image.image_path)
-    
+    # Files are removed by the outbox worker once this commit lands
+    deletion_outbox.enqueue(db, [
+        key for image in book.images for key in variant_keys(image.image_path, image.variant_prefix)
+    ])
     db.delete(book)
+    daily_stats.record(db, books_deleted=1)
     db.commit()
     
     return {"message": "Book deleted"}
 
 # AI CHAT ROUTES
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+class EventStreamResponse(StreamingResponse):
+    """StreamingResponse that awaits `on_close()` once it has been sent, however sending ended"""
+    
+    def __init__(self, content, on_close=None, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+    
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.on_close is not None:
+                # Runs on disconnect too, so shield it from the cancellation
+                with anyio.CancelScope(shield=True):
+                    await self.on_close()
+
+def event_stream_response(events, on_close=None) -> StreamingResponse:
+    # X-Accel-Buffering stops nginx from holding events back until its buffer fills
+    return EventStreamResponse(
+        events,
+        on_close=on_close,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def reserve_ai_message(message: str, current_user: User, db: Session):
+    """Check the message, look it up in the cache, then take quota if it counts.
+    
+    Returns (prompt_hash, cached answer or None, messages_remaining). Taking
+    quota commits the session, so current_user is expired afterwards.
+    """
+    ai_service.check_message(message)
+    user_id, role = current_user.id, current_user.role
+    max_messages = quota_service.limit_for("ai_messages", role)
+    
+    # Repeated questions are answered from the cache without calling the model
+    prompt_hash = ai_response_cache.key(message, ai_service.model, ai_service.max_tokens)
+    ai_response = ai_response_cache.get(prompt_hash)
+    if ai_response is None:
+        ai_response = await run_in_threadpool(ai_response_cache.get_persistent, db, prompt_hash)
+    counts_against_quota = ai_response is None or settings.AI_CACHE_HITS_COUNT_AGAINST_QUOTA
+    
+    if counts_against_quota:
+        messages_remaining = await run_in_threadpool(
+            quota_service.reserve, db, user_id, role, "ai_messages"
+        )
+        if messages_remaining is None:
+            raise HTTPException(status_code=429, detail=f"Daily limit reached ({max_messages} messages)")
+    else:
+        messages_remaining = quota_service.remaining(current_user, "ai_messages")
+    
+    return prompt_hash, ai_response, messages_remaining
+
+def save_chat_log(user_id: int, message: str, response: str, tokens_used: int, prompt_hash: str, cached: bool):
+    """Write a ChatLog in its own session, for streams that outlive the request's session"""
+    db = SessionLocal()
+    try:
+        db.add(ChatLog(
+            user_id=user_id,
+            message=message,
+            response=response,
+            tokens_used=tokens_used,
+            prompt_hash=prompt_hash,
+            cached=cached
+        ))
+        daily_stats.record(db, ai_messages=1, ai_tokens=tokens_used)
+        db.commit()
+    finally:
+        db.close()
+
 @router.post("/api/ai/chat")
 async def ai_chat(
     message: str = Form(...),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    reset_daily_counter_if_needed(current_user, "ai_messages_today", "ai_messages_reset_date")
-    
-    max_messages = 100 if current_user.role == UserRole.PREMIUM else 50
-    
-    if current_user.ai_messages_today >= max_messages:
-        raise HTTPException(status_code=429, detail=f"Daily limit reached ({max_messages} messages)")
+    # Reserving commits, which expires current_user; reading it again afterwards would query on the event loop
+    user_id, premium = current_user.id, current_user.role == UserRole.PREMIUM
+    prompt_hash, ai_response, messages_remaining = await reserve_ai_message(message, current_user, db)
+    cached = ai_response is not None
     
-    ai_response = await ai_service.chat(message)
-    
-    chat_log = ChatLog(
-        user_id=current_user.id,
-        message=message,
-        response=ai_response["response"],
-        tokens_used=ai_response["tokens_used"]
-    )
-    db.add(chat_log)
+    if not cached:
+        try:
+            ai_response = await ai_scheduler.run(user_id, premium, lambda: ai_service.chat(message))
+        except BaseException:
+            # The message was never answered, so it does not count
+            await run_in_threadpool(quota_service.refund, db, user_id, "ai_messages")
+            raise
+        ai_response_cache.set(prompt_hash, ai_response["response"], ai_response["tokens_used"])
+    
+    def log_chat():
+        chat_log = ChatLog(
+            user_id=user_id,
+            message=message,
+            response=ai_response["response"],
+            tokens_used=0 if cached else ai_response["tokens_used"],
+            prompt_hash=prompt_hash,
+            cached=cached
+        )
+        db.add(chat_log)
+        daily_stats.record(db, ai_messages=1, ai_tokens=chat_log.tokens_used)
+        db.commit()
     
-    current_user.ai_messages_today += 1
-    db.commit()
+    await run_in_threadpool(log_chat)
     
     return {
         "response": ai_response["response"],
-        "messages_remaining": max_messages - current_user.ai_messages_today
+        "cached": cached,
+        "messages_remaining": messages_remaining
     }
 
+@router.post("/api/ai/chat/stream")
+async def ai_chat_stream(
+    message: str = Form(...),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Like /api/ai/chat, but relays the answer as server-sent "delta" events while it is generated.
+    
+    Errors before the first token are ordinary HTTP errors. The stream ends
+    with a "done" event, or an "error" event if the upstream breaks off; the
+    message is charged and logged either way, including when the client
+    disconnects mid-answer.
+    """
+    # Reserving commits, which expires current_user; reading it again afterwards would query on the event loop
+    user_id, premium = current_user.id, current_user.role == UserRole.PREMIUM
+    prompt_hash, cached_response, messages_remaining = await reserve_ai_message(message, current_user, db)
+    
+    if cached_response is not None:
+        await run_in_threadpool(save_chat_log, user_id, message, cached_response["response"], 0, prompt_hash, True)
+        
+        async def cached_events():
+            yield sse_event("delta", {"delta": cached_response["response"]})
+            yield sse_event("done", {"cached": True, "messages_remaining": messages_remaining})
+        
+        return event_stream_response(cached_events())
+    
+    # The upstream slot and connection are held until the stream ends. They
+    # are opened here so that rejections are still HTTP errors, and released
+    # by the response, which cannot skip its cleanup the way an abandoned
+    # generator skips its finally block
+    cleanup = AsyncExitStack()
+    try:
+        await cleanup.enter_async_context(ai_scheduler.slot(user_id, premium))
+        upstream = ai_service.chat_stream(message)
+        cleanup.push_async_callback(upstream.aclose)
+        first_item = await upstream.__anext__()
+    except BaseException:
+        await cleanup.aclose()
+        await run_in_threadpool(quota_service.refund, db, user_id, "ai_messages")
+        raise
+    
+    parts = []
+    result = {"tokens_used": None, "finished": False}
+    
+    async def events():
+        try:
+            item = first_item
+            while "delta" in item:
+                parts.append(item["delta"])
+                yield sse_event("delta", {"delta": item["delta"]})
+                item = await upstream.__anext__()
+            result.update(item)
+            yield sse_event("done", {"cached": False, "messages_remaining": messages_remaining})
+        except HTTPException as e:
+            yield sse_event("error", {"detail": e.detail})
+    
+    async def close_stream():
+        await cleanup.aclose()
+        response = "".join(parts)
+        if result["finished"]:
+            ai_response_cache.set(prompt_hash, response, result["tokens_used"] or 0)
+        # Without a usage report (aborted stream), count one token per delta
+        tokens_used = result["tokens_used"] if result["tokens_used"] is not None else len(parts)
+        # A partial answer is logged without its prompt hash so the persistent cache never serves it
+        await run_in_threadpool(
+            save_chat_log, user_id, message, response, tokens_used, prompt_hash if result["finished"] else None, False
+        )
+    
+    return event_stream_response(events(), on_close=close_stream)
+
 @router.get("/api/ai/chat-history")
-async def get_chat_history(
+def get_chat_history(
     skip: int = 0,
     limit: int = 50,
-    current_user: User = Depends(get_current_user),
+    cursor: str = None,
+    current_user: Principal = Depends(get_current_principal),
     db: Session = Depends(get_db)
 ):
-    chats = db.query(ChatLog).filter(
-        ChatLog.user_id == current_user.id
-    ).order_by(ChatLog.created_at.desc()).offset(skip).limit(limit).all()
+    chats, next_cursor = paginate_keyset(
+        db.query(ChatLog).filter(ChatLog.user_id == current_user.id),
+        [ChatLog.created_at, ChatLog.id], cursor, limit, skip=skip
+    )
     
     result = []
     for chat in chats:
@@ -460,47 +731,103 @@ async def get_chat_history(
             "created_at": chat.created_at
         })
     
-    return {"chats": result}
+    return {"chats": result, "next_cursor": next_cursor}
 
 # NOTIFICATIONS
 @router.get("/api/notifications")
-async def get_notifications(
+def get_notifications(
     skip: int = 0,
     limit: int = 20,
-    current_user: User = Depends(get_current_user),
+    cursor: str = None,
+    current_user: Principal = Depends(get_current_principal),
     db: Session = Depends(get_db)
 ):
-    notifications = db.query(Notification).filter(
-        Notification.user_id == current_user.id
-    ).order_by(Notification.created_at.desc()).offset(skip).limit(limit).all()
-    
-    result = []
-    for notif in notifications:
-        result.append({
-            "id": notif.id,
-            "title": notif.title,
-            "message": notif.message,
-            "is_read": notif.is_read,
-            "created_at": notif.created_at
-        })
+    notifications, next_cursor = paginate_keyset(
+        db.query(Notification).filter(Notification.user_id == current_user.id),
+        [Notification.created_at, Notification.id], cursor, limit, skip=skip
+    )
     
-    return {"notifications": result}
+    return {"notifications": [serialize_notification(notif) for notif in notifications], "next_cursor": next_cursor}
+
+@router.get("/api/notifications/unread-count")
+def get_unread_notification_count(current_user: Principal = Depends(get_current_principal), db: Session = Depends(get_db)):
+    return {"unread_count": unread_count(db, current_user.id)}
+
+@router.get("/api/notifications/stream")
+async def stream_notifications(
+    request: Request,
+    current_user: Principal = Depends(get_current_principal)
+):
+    """Server-sent events: new notifications and unread-count changes, as they are committed"""
+    if not notification_hub.has_capacity(current_user.id):
+        raise HTTPException(status_code=429, detail="Too many open notification streams")
+    def initial_unread_count():
+        # Own session: the request's would be closed long before the stream ends
+        db = SessionLocal()
+        try:
+            return unread_count(db, current_user.id)
+        finally:
+            db.close()
+    
+    async def events():
+        # Subscribe only once the stream runs, so a response that is never
+        # sent leaves nothing registered with the hub
+        queue = notification_hub.subscribe(current_user.id)
+        if queue is None:
+            # Other streams filled the last places since the check above
+            yield sse_event("error", {"detail": "Too many open notification streams"})
+            return
+        try:
+            # Read the snapshot only once subscribed: anything committed after
+            # it is already queued, so nothing falls between the two
+            unread = await run_in_threadpool(initial_unread_count)
+            yield "retry: 5000\n\n"
+            yield sse_event("unread_count", {"type": "unread_count", "unread_count": unread})
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=settings.NOTIFICATION_STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # Comment line keeps proxies and mobile networks from closing an idle stream
+                    yield ": keepalive\n\n"
+                    continue
+                yield sse_event(event["type"], event)
+        finally:
+            notification_hub.unsubscribe(current_user.id, queue)
+    
+    return event_stream_response(events())
 
 @router.post("/api/notifications/{notification_id}/read")
-async def mark_notification_read(
+def mark_notification_read(
     notification_id: int,
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_principal),
     db: Session = Depends(get_db)
 ):
-    notification = db.query(Notification).filter(
+    exists = db.query(Notification.id).filter(
         Notification.id == notification_id,
         Notification.user_id == current_user.id
     ).first()
     
-    if not notification:
+    if not exists:
         raise HTTPException(status_code=404, detail="Notification not found")
     
-    notification.is_read = True
+    mark_read(db, current_user.id, [notification_id])
     db.commit()
     
     return {"message": "Notification marked as read"}
+
+class MarkReadData(BaseModel):
+    notification_ids: Optional[List[int]] = None  # None marks every notification read
+
+@router.post("/api/notifications/read")
+def mark_notifications_read(
+    data: MarkReadData,
+    current_user: Principal = Depends(get_current_principal),
+    db: Session = Depends(get_db)
+):
+    if data.notification_ids is not None and len(data.notification_ids) > 1000:
+        raise HTTPException(status_code=400, detail="At most 1000 notifications per call")
+    
+    marked = mark_read(db, current_user.id, data.notification_ids)
+    db.commit()
+    
+    return {"marked": marked, "unread_count": unread_count(db, current_user.id)}
@@ -1,103 +1,180 @@
 import boto3
+from boto3.s3.transfer import TransferConfig
+from boto3.exceptions import S3UploadFailedError
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from config import get_settings
-from PyPDF2 import PdfReader, PdfWriter
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from io import BytesIO
-import uuid
-from datetime import datetime, timedelta
+from storage import StorageBackend
+from urllib.parse import quote
+import hashlib
+import hmac
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Tuple
+from utils import TTLCache
 
 settings = get_settings()
 
-class S3Service:
+class SigV4Presigner:
+    """Local SigV4 query-string signer for S3 GET URLs, without boto3's per-call request pipeline"""
+    
+    def __init__(self, access_key: str, secret_key: str, region: str, bucket: str):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.bucket = bucket
+        # Dotted bucket names break virtual-host TLS, so they use path-style URLs
+        if "." in bucket:
+            self.host = f"s3.{region}.amazonaws.com"
+            self.path_prefix = f"/{quote(bucket, safe='')}"
+        else:
+            self.host = f"{bucket}.s3.{region}.amazonaws.com"
+            self.path_prefix = ""
+        self._signing_keys = {}
+    
+    def _signing_key(self, date_stamp: str) -> bytes:
+        key = self._signing_keys.get(date_stamp)
+        if key is None:
+            key = f"AWS4{self.secret_key}".encode()
+            for part in (date_stamp, self.region, "s3", "aws4_request"):
+                key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+            # Signing keys are valid for one UTC day; keep only the latest
+            self._signing_keys = {date_stamp: key}
+        return key
+    
+    def presign_get(self, file_key: str, expiration: int, signed_at: float = None) -> str:
+        """Return a presigned GET URL valid for `expiration` seconds from `signed_at`"""
+        timestamp = time.gmtime(time.time() if signed_at is None else signed_at)
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", timestamp)
+        date_stamp = amz_date[:8]
+        scope = f"{date_stamp}/{self.region}/s3/aws4_request"
+        
+        path = f"{self.path_prefix}/{quote(file_key, safe='/-_.~')}"
+        query = "&".join(
+            f"{name}={quote(value, safe='-_.~')}"
+            for name, value in (
+                ("X-Amz-Algorithm", "AWS4-HMAC-SHA256"),
+                ("X-Amz-Credential", f"{self.access_key}/{scope}"),
+                ("X-Amz-Date", amz_date),
+                ("X-Amz-Expires", str(expiration)),
+                ("X-Amz-SignedHeaders", "host"),
+            )
+        )
+        canonical_request = f"GET\n{path}\n{query}\nhost:{self.host}\n\nhost\nUNSIGNED-PAYLOAD"
+        string_to_sign = (
+            f"AWS4-HMAC-SHA256\n{amz_date}\n{scope}\n"
+            f"{hashlib.sha256(canonical_request.encode()).hexdigest()}"
+        )
+        signature = hmac.new(self._signing_key(date_stamp), string_to_sign.encode(), hashlib.sha256).hexdigest()
+        return f"https://{self.host}{path}?{query}&X-Amz-Signature={signature}"
+
+class S3Service(StorageBackend):
     def __init__(self):
         self.s3_client = boto3.client(
             's3',
             region_name=settings.AWS_REGION,
             aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+            # One client is shared by every request thread; size its pool for concurrent uploads
+            config=Config(max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS)
         )
         self.bucket = settings.AWS_S3_BUCKET
+        self.presigner = SigV4Presigner(
+            settings.AWS_ACCESS_KEY_ID,
+            settings.AWS_SECRET_ACCESS_KEY,
+            settings.AWS_REGION,
+            settings.AWS_S3_BUCKET
+        )
+        # Files above the threshold go up as parallel multipart parts
+        self.transfer_config = TransferConfig(
+            multipart_threshold=settings.S3_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+            multipart_chunksize=settings.S3_MULTIPART_CHUNK_SIZE_MB * 1024 * 1024
+        )
+        # file_key -> {expiration: (expiry_bucket, url)}
+        self.url_cache = TTLCache(maxsize=settings.PRESIGNED_URL_CACHE_SIZE, ttl=86400)
     
-    def add_watermark_to_pdf(self, pdf_bytes: bytes, user_id: int) -> bytes:
-        """Add watermark to PDF"""
-        try:
-            pdf_reader = PdfReader(BytesIO(pdf_bytes))
-            pdf_writer = PdfWriter()
-            
-            watermark_text = f"NotesHub - User ID: {user_id}"
-            
-            for page in pdf_reader.pages:
-                packet = BytesIO()
-                can = canvas.Canvas(packet, pagesize=letter)
-                can.setFont("Helvetica", 8)
-                can.setFillColorRGB(0.7, 0.7, 0.7, alpha=0.3)
-                can.drawString(50, 30, watermark_text)
-                can.save()
-                
-                packet.seek(0)
-                watermark_pdf = PdfReader(packet)
-                page.merge_page(watermark_pdf.pages[0])
-                pdf_writer.add_page(page)
-            
-            output = BytesIO()
-            pdf_writer.write(output)
-            output.seek(0)
-            return output.read()
-        except Exception as e:
-            print(f"Watermark error: {e}")
-            return pdf_bytes
-    
-    def upload_note(self, file_content: bytes, filename: str, user_id: int) -> str:
-        """Upload PDF note with watermark to S3"""
-        watermarked_content = self.add_watermark_to_pdf(file_content, user_id)
-        
-        file_key = f"notes-pdf/{user_id}/{uuid.uuid4()}_{filename}"
-        
+    def put_object(self, file_key: str, file_content: bytes, content_type: str, cache_control: str = None) -> str:
+        extra = {'CacheControl': cache_control} if cache_control else {}
         try:
             self.s3_client.put_object(
                 Bucket=self.bucket,
                 Key=file_key,
-                Body=watermarked_content,
-                ContentType='application/pdf'
+                Body=file_content,
+                ContentType=content_type,
+                **extra
             )
             return file_key
         except ClientError as e:
             raise Exception(f"S3 upload failed: {str(e)}")
     
-    def upload_book_image(self, file_content: bytes, filename: str, user_id: int) -> str:
-        """Upload book image to S3"""
-        file_key = f"book-images/{user_id}/{uuid.uuid4()}_{filename}"
-        
+    def put_file(self, file_key: str, file_path: str, content_type: str) -> str:
+        """Upload a file from disk, using multipart for large files"""
         try:
-            self.s3_client.put_object(
-                Bucket=self.bucket,
-                Key=file_key,
-                Body=file_content,
-                ContentType='image/jpeg'
+            self.s3_client.upload_file(
+                file_path,
+                self.bucket,
+                file_key,
+                ExtraArgs={'ContentType': content_type},
+                Config=self.transfer_config
             )
             return file_key
-        except ClientError as e:
+        except (ClientError, S3UploadFailedError) as e:
             raise Exception(f"S3 upload failed: {str(e)}")
     
     def generate_presigned_url(self, file_key: str, expiration: int = 3600) -> str:
-        """Generate presigned URL for private file access"""
+        """Generate presigned URL for private file access.
+        
+        URLs are signed at the start of an expiry bucket half as long as `expiration`,
+        so a cached URL always has at least half of its lifetime left when handed out
+        and every worker produces the same URL for the same bucket.
+        """
+        refresh_interval = max(expiration // 2, 1)
+        now = time.time()
+        expiry_bucket = int(now // refresh_interval)
+        
+        cached = self.url_cache.get(file_key)
+        if cached is not None:
+            entry = cached.get(expiration)
+            if entry is not None and entry[0] == expiry_bucket:
+                return entry[1]
+        
+        signed_at = expiry_bucket * refresh_interval
         try:
-            url = self.s3_client.generate_presigned_url(
-                'get_object',
-                Params={'Bucket': self.bucket, 'Key': file_key},
-                ExpiresIn=expiration
+            url = self.presigner.presign_get(file_key, expiration, signed_at)
+        except Exception as e:
+            print(f"Local presign failed, falling back to boto3: {e}")
+            try:
+                url = self.s3_client.generate_presigned_url(
+                    'get_object',
+                    Params={'Bucket': self.bucket, 'Key': file_key},
+                    ExpiresIn=expiration
+                )
+            except ClientError as e:
+                raise Exception(f"Failed to generate URL: {str(e)}")
+        
+        if cached is None:
+            cached = {}
+        cached[expiration] = (expiry_bucket, url)
+        self.url_cache.set(file_key, cached, ttl=signed_at + refresh_interval - now)
+        return url
+    
+    def delete_files(self, file_keys: List[str]) -> Dict[str, str]:
+        """Delete keys with DeleteObjects, 1000 per request"""
+        failed = {}
+        for start in range(0, len(file_keys), 1000):
+            batch = file_keys[start:start + 1000]
+            for file_key in batch:
+                self.url_cache.pop(file_key)
+            response = self.s3_client.delete_objects(
+                Bucket=self.bucket,
+                Delete={'Objects': [{'Key': file_key} for file_key in batch], 'Quiet': True}
             )
-            return url
-        except ClientError as e:
-            raise Exception(f"Failed to generate URL: {str(e)}")
+            for error in response.get('Errors', []):
+                failed[error['Key']] = f"{error.get('Code')}: {error.get('Message')}"
+        return failed
     
-    def delete_file(self, file_key: str):
-        """Delete file from S3"""
-        try:
-            self.s3_client.delete_object(Bucket=self.bucket, Key=file_key)
-        except ClientError as e:
-            print(f"S3 delete failed: {str(e)}")
-
-s3_service = S3Service()
+    def list_keys(self, prefix: str) -> Iterator[Tuple[str, datetime]]:
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                yield item['Key'], item['LastModified'].astimezone(timezone.utc).replace(tzinfo=None)
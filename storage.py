@@ -0,0 +1,184 @@
+import hashlib
+import hmac
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Dict, Iterator, List, Tuple
+from urllib.parse import quote
+from config import get_settings
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+class StorageError(Exception):
+    """A storage backend could not complete an operation"""
+
+class StorageBackend(ABC):
+    """Object storage for note PDFs and book images.
+    
+    The database only stores keys ("notes-pdf/<user>/<uuid>_<name>",
+    "book-images/<user>/<uuid>/..."), so backends share one key layout.
+    Subclasses implement the storage primitives (put, presign, delete, list);
+    the helpers below are built on those.
+    """
+    
+    @abstractmethod
+    def put_object(self, file_key: str, file_content: bytes, content_type: str, cache_control: str = None) -> str:
+        ...
+    
+    @abstractmethod
+    def put_file(self, file_key: str, file_path: str, content_type: str) -> str:
+        ...
+    
+    @abstractmethod
+    def generate_presigned_url(self, file_key: str, expiration: int = 3600) -> str:
+        ...
+    
+    @abstractmethod
+    def delete_files(self, file_keys: List[str]) -> Dict[str, str]:
+        """Delete many keys; returns {key: error} for the ones that failed. Missing keys count as deleted."""
+    
+    @abstractmethod
+    def list_keys(self, prefix: str) -> Iterator[Tuple[str, datetime]]:
+        """Yield (key, last modified in UTC) for every stored object under a prefix"""
+    
+    def delete_file(self, file_key: str):
+        """Delete one key; raises StorageError if the backend could not"""
+        failed = self.delete_files([file_key])
+        if file_key in failed:
+            raise StorageError(f"Delete of {file_key} failed: {failed[file_key]}")
+    
+    def note_key(self, filename: str, user_id: int) -> str:
+        return f"notes-pdf/{user_id}/{uuid.uuid4()}_{filename}"
+    
+    def upload_note_file(self, file_path: str, filename: str, user_id: int) -> str:
+        """Upload an already watermarked PDF from disk"""
+        return self.put_file(self.note_key(filename, user_id), file_path, 'application/pdf')
+    
+    def book_image_prefix(self, user_id: int) -> str:
+        """Fresh key prefix under which all variants of one book image are stored"""
+        return f"book-images/{user_id}/{uuid.uuid4()}"
+    
+    def upload_book_image_variant(self, file_key: str, file_content: bytes, content_type: str) -> str:
+        """Upload one processed book image under a caller-chosen key"""
+        return self.put_object(file_key, file_content, content_type, cache_control=IMMUTABLE_CACHE_CONTROL)
+
+class LocalStorageBackend(StorageBackend):
+    """Stores objects under LOCAL_STORAGE_DIR and serves them through the app.
+    
+    Download URLs point at /api/files/<key> and carry an HMAC signature over
+    the key and expiry, the same way S3 presigned URLs do.
+    """
+    
+    def __init__(self, root: str, base_url: str, signing_key: bytes):
+        self.root = os.path.realpath(root)
+        self.base_url = base_url.rstrip("/")
+        self.signing_key = signing_key
+        os.makedirs(self.root, exist_ok=True)
+    
+    def path_for(self, file_key: str) -> str:
+        """Filesystem path of a key; refuses keys that would escape the storage root"""
+        path = os.path.realpath(os.path.join(self.root, file_key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Invalid storage key: {file_key}")
+        return path
+    
+    def _write_atomically(self, file_key: str, write):
+        path = self.path_for(file_key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Readers never see a half-written file
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".upload-")
+        os.close(fd)
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        return file_key
+    
+    def put_object(self, file_key: str, file_content: bytes, content_type: str, cache_control: str = None) -> str:
+        def write(tmp_path):
+            with open(tmp_path, "wb") as out:
+                out.write(file_content)
+        try:
+            return self._write_atomically(file_key, write)
+        except OSError as e:
+            raise Exception(f"Local storage write failed: {str(e)}")
+    
+    def put_file(self, file_key: str, file_path: str, content_type: str) -> str:
+        try:
+            # copyfile uses sendfile on Linux, so the PDF never passes through Python buffers
+            return self._write_atomically(file_key, lambda tmp_path: shutil.copyfile(file_path, tmp_path))
+        except OSError as e:
+            raise Exception(f"Local storage write failed: {str(e)}")
+    
+    def sign(self, file_key: str, expires: int) -> str:
+        return hmac.new(self.signing_key, f"{file_key}\n{expires}".encode(), hashlib.sha256).hexdigest()
+    
+    def verify_signature(self, file_key: str, expires: int, signature: str) -> bool:
+        if expires < time.time():
+            return False
+        return hmac.compare_digest(self.sign(file_key, expires), signature)
+    
+    def generate_presigned_url(self, file_key: str, expiration: int = 3600) -> str:
+        """Signed, expiring app URL; like the S3 backend, stable within half the expiration"""
+        refresh_interval = max(expiration // 2, 1)
+        expires = int(time.time() // refresh_interval) * refresh_interval + expiration
+        return (
+            f"{self.base_url}/api/files/{quote(file_key)}"
+            f"?expires={expires}&signature={self.sign(file_key, expires)}"
+        )
+    
+    def delete_files(self, file_keys: List[str]) -> Dict[str, str]:
+        failed = {}
+        for file_key in file_keys:
+            try:
+                path = self.path_for(file_key)
+                os.remove(path)
+            except (FileNotFoundError, ValueError):
+                continue
+            except OSError as e:
+                failed[file_key] = str(e)
+                continue
+            # Drop the per-image variant directory once it is empty
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+        return failed
+    
+    def list_keys(self, prefix: str) -> Iterator[Tuple[str, datetime]]:
+        for directory, _, filenames in os.walk(os.path.join(self.root, prefix)):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    modified = datetime.utcfromtimestamp(os.stat(path).st_mtime)
+                except FileNotFoundError:
+                    continue
+                yield os.path.relpath(path, self.root).replace(os.sep, "/"), modified
+
+def create_storage_backend() -> StorageBackend:
+    settings = get_settings()
+    
+    if settings.STORAGE_BACKEND == "local":
+        if settings.LOCAL_STORAGE_SIGNING_KEY:
+            signing_key = settings.LOCAL_STORAGE_SIGNING_KEY.encode()
+        else:
+            signing_key = hmac.new(settings.JWT_SECRET.encode(), b"local-storage-urls", hashlib.sha256).digest()
+        return LocalStorageBackend(settings.LOCAL_STORAGE_DIR, settings.APP_URL, signing_key)
+    if settings.STORAGE_BACKEND == "s3":
+        if not settings.AWS_S3_BUCKET:
+            raise ValueError("AWS_S3_BUCKET must be set when STORAGE_BACKEND is 's3'")
+        from s3_service import S3Service
+        return S3Service()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {settings.STORAGE_BACKEND}")
+
+storage = create_storage_backend()
@@ -0,0 +1,206 @@
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+from io import BytesIO
+
+# Settings are read at import time, so the environment must be in place first
+TEST_ENV = {
+    "DB_HOST": "localhost",
+    "DB_USER": "test",
+    "DB_PASSWORD": "test",
+    "DB_NAME": "test",
+    "JWT_SECRET": "test-secret-test-secret-test-secret",
+    "GOOGLE_CLIENT_ID": "test-client-id",
+    "AWS_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "AWS_S3_BUCKET": "test-bucket",
+    "OPENROUTER_API_KEY": "test",
+    "GROQ_API_KEY": "test",
+    "APP_URL": "http://testserver"
+}
+for name, value in TEST_ENV.items():
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import uvicorn
+from reportlab.pdfgen import canvas
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
+
+import database
+from database import Note
+
+engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+database.Base.metadata.create_all(engine)
+database.SessionLocal.configure(bind=engine)
+database.engine = engine
+
+import main
+import utils
+from trending_service import trending_service
+from analytics_rollups import daily_stats
+from ai_cache import ai_response_cache
+from auth import create_access_token, principal_cache, token_payload_cache, revoked_tokens
+
+class QueryLog(list):
+    """SQL statements sent to the test database while it is attached"""
+    
+    def __init__(self):
+        super().__init__()
+        event.listen(engine, "before_cursor_execute", self._record)
+    
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.append(statement)
+    
+    def detach(self):
+        event.remove(engine, "before_cursor_execute", self._record)
+
+class EventLoopQueryLog(QueryLog):
+    """Only the statements run on a thread with a running event loop, i.e. ones that block it"""
+    
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self.append(statement)
+
+def make_pdf(pages: int = 3, pagesize=(612, 792)) -> bytes:
+    output = BytesIO()
+    pdf = canvas.Canvas(output, pagesize=pagesize)
+    for number in range(pages):
+        pdf.drawString(72, 720, f"Page {number + 1}")
+        pdf.showPage()
+    pdf.save()
+    return output.getvalue()
+
+def auth_headers(user_id: int) -> dict:
+    return {"Authorization": f"Bearer {create_access_token({'sub': str(user_id)})}"}
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    yield
+    with engine.begin() as conn:
+        for table in reversed(database.Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+    principal_cache.clear()
+    token_payload_cache.clear()
+    main.note_count_cache.clear()
+    ai_response_cache._entries.clear()
+    revoked_tokens.revoked.clear()
+    daily_stats._deltas.clear()
+    daily_stats._rebuilt_at = None
+    utils.rate_limiter.backend = utils.InMemoryRateLimitBackend()
+
+@pytest.fixture(autouse=True)
+def sqlite_trending_score(monkeypatch):
+    # The decayed score uses MySQL's TIMESTAMPDIFF; decay itself is not under test
+    monkeypatch.setattr(trending_service, "score_after_engagement", lambda now, weight: Note.trending_score + weight)
+
+@pytest.fixture
+def rollup_deltas(monkeypatch):
+    """Deltas that reached daily_stats' buffer, i.e. whose transaction committed"""
+    recorded = []
+    add = daily_stats._add
+    def record_and_add(day, deltas):
+        recorded.append(deltas)
+        add(day, deltas)
+    monkeypatch.setattr(daily_stats, "_add", record_and_add)
+    return recorded
+
+@pytest.fixture
+def db():
+    session = database.SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+async def app_with_client_address(scope, receive, send):
+    # Starlette's TestClient leaves scope["client"] empty; servers always set it
+    if scope["type"] == "http" and scope.get("client") is None:
+        scope["client"] = ("testclient", 50000)
+    await main.app(scope, receive, send)
+
+@pytest.fixture
+def file_database(tmp_path):
+    """Pooled, file-backed database for tests that need concurrent connections; sessions use it while active"""
+    file_engine = create_engine(
+        f"sqlite:///{tmp_path / 'test.db'}",
+        connect_args={"check_same_thread": False, "timeout": 60},
+        pool_size=16
+    )
+    database.Base.metadata.create_all(file_engine)
+    database.SessionLocal.configure(bind=file_engine)
+    try:
+        yield file_engine
+    finally:
+        database.SessionLocal.configure(bind=engine)
+        file_engine.dispose()
+
+@pytest.fixture
+def live_server():
+    """The app served by uvicorn on a background thread, for clients that need a real socket; yields the base URL"""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, lifespan="off", log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
+
+@pytest.fixture
+def client():
+    # No context manager: the lifespan's background jobs are not wanted in tests
+    return TestClient(app_with_client_address)
+
+@pytest.fixture
+def query_log():
+    log = QueryLog()
+    try:
+        yield log
+    finally:
+        log.detach()
+
+@pytest.fixture
+def event_loop_queries():
+    log = EventLoopQueryLog()
+    try:
+        yield log
+    finally:
+        log.detach()
+
+@pytest.fixture
+def make_user(db):
+    created = []
+    
+    def make(role=database.UserRole.NORMAL, **fields):
+        number = len(created) + 1
+        user = database.User(
+            email=fields.pop("email", f"user{number}@example.com"),
+            name=fields.pop("name", f"User {number}"),
+            google_id=fields.pop("google_id", f"google-{number}"),
+            role=role,
+            **fields
+        )
+        db.add(user)
+        db.commit()
+        created.append(user)
+        return user
+    
+    return make
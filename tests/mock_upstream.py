@@ -0,0 +1,52 @@
+"""In-process stand-in for the Groq chat completions API, served through httpx.MockTransport"""
+import asyncio
+import json
+
+import httpx
+
+def completion(text: str = "Hello", tokens: int = 12) -> httpx.Response:
+    return httpx.Response(200, json={"choices": [{"message": {"content": text}}], "usage": {"total_tokens": tokens}})
+
+def status(code: int, retry_after: str = None) -> httpx.Response:
+    headers = {"Retry-After": retry_after} if retry_after is not None else {}
+    return httpx.Response(code, json={"error": "upstream"}, headers=headers)
+
+def stream(tokens: int = 5, break_after: int = None, delay: float = 0.0, gate: asyncio.Event = None) -> httpx.Response:
+    """SSE completion of `tokens` chunks; `break_after` drops the connection mid-stream, `gate` holds it open"""
+    async def body():
+        for index in range(tokens):
+            if index == break_after:
+                raise httpx.ReadError("upstream connection lost")
+            if gate is not None and index == 1:
+                await gate.wait()
+            chunk = {"choices": [{"delta": {"content": f"t{index} "}, "finish_reason": None}]}
+            yield f"data: {json.dumps(chunk)}\n\n".encode()
+            await asyncio.sleep(delay)
+        last = {"choices": [{"delta": {}, "finish_reason": "stop"}], "x_groq": {"usage": {"total_tokens": tokens + 10}}}
+        yield f"data: {json.dumps(last)}\n\ndata: [DONE]\n\n".encode()
+    return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=body())
+
+class MockUpstream:
+    """Answers each request with the next scripted response (or a completion once the script runs out).
+    
+    A scripted callable is called per request and may be a coroutine function.
+    """
+    
+    def __init__(self):
+        self.script = []
+        self.requests = []
+    
+    def reply(self, *responses):
+        self.script.extend(responses)
+    
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(json.loads(request.content))
+        response = self.script.pop(0) if self.script else completion()
+        if callable(response):
+            response = response()
+        if asyncio.iscoroutine(response):
+            response = await response
+        return response
+    
+    def client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
@@ -0,0 +1,39 @@
+from ai_cache import ai_response_cache
+from ai_service import ai_service
+from conftest import auth_headers
+from database import ChatLog, User
+
+PROMPT_HASH = ai_response_cache.key("What is entropy?", ai_service.model, ai_service.max_tokens)
+
+def log(db, user, response, tokens_used, cached=False, prompt_hash=PROMPT_HASH):
+    db.add(ChatLog(
+        user_id=user.id, message="What is entropy?", response=response,
+        tokens_used=tokens_used, prompt_hash=prompt_hash, cached=cached
+    ))
+    db.commit()
+
+def test_persistent_tier_skips_rows_that_are_not_real_answers(db, make_user):
+    user = make_user()
+    log(db, user, "", 12)
+    log(db, user, "Half an answ", 0)
+    log(db, user, "Copied from the cache", 0, cached=True)
+    log(db, user, "Cut off mid-stre", 4, prompt_hash=None)
+    
+    assert ai_response_cache.get_persistent(db, PROMPT_HASH) is None
+    
+    log(db, user, "Disorder, roughly", 15)
+    entry = ai_response_cache.get_persistent(db, PROMPT_HASH)
+    
+    assert entry["response"] == "Disorder, roughly"
+    assert entry["tokens_used"] == 15
+
+def test_too_long_message_is_rejected_before_taking_quota(client, db, make_user):
+    user = make_user()
+    
+    response = client.post(
+        "/api/ai/chat", data={"message": "x" * (ai_service.max_message_chars + 1)}, headers=auth_headers(user.id)
+    )
+    
+    assert response.status_code == 400
+    db.expire_all()
+    assert db.get(User, user.id).ai_messages_today == 0
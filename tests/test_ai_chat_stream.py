@@ -0,0 +1,128 @@
+"""Streaming AI chat against a mock upstream: the scheduler slot, upstream stream and quota are settled however the stream ends"""
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+import routes
+from ai_scheduler import ai_scheduler
+from ai_service import ai_service
+from database import ChatLog, SessionLocal, User
+from mock_upstream import MockUpstream, stream
+from conftest import auth_headers
+
+@pytest.fixture
+def upstream(monkeypatch):
+    upstream = MockUpstream()
+    monkeypatch.setattr(ai_service, "_client", upstream.client())
+    return upstream
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+def parse_events(lines):
+    events = []
+    name = None
+    for line in lines:
+        if line.startswith("event: "):
+            name = line[len("event: "):]
+        elif line.startswith("data: "):
+            events.append((name, json.loads(line[len("data: "):])))
+    return events
+
+def chat_logs():
+    db = SessionLocal()
+    try:
+        return [(log.response, log.tokens_used) for log in db.query(ChatLog)]
+    finally:
+        db.close()
+
+def ai_messages_today(user_id):
+    db = SessionLocal()
+    try:
+        return db.get(User, user_id).ai_messages_today
+    finally:
+        db.close()
+
+def assert_released():
+    assert ai_scheduler.metrics()["running"] == 0
+    assert not ai_scheduler._per_user
+
+def post_stream(http, user_id, message):
+    return http.stream("POST", "/api/ai/chat/stream", data={"message": message}, headers=auth_headers(user_id))
+
+def test_complete_stream(make_user, upstream, live_server, rollup_deltas):
+    user = make_user()
+    upstream.reply(stream(tokens=3))
+    
+    with httpx.Client(base_url=live_server, timeout=10) as http:
+        with post_stream(http, user.id, "Explain the complete stream") as response:
+            assert response.status_code == 200
+            events = parse_events(response.iter_lines())
+    
+    assert [data["delta"] for name, data in events if name == "delta"] == ["t0 ", "t1 ", "t2 "]
+    assert events[-1][0] == "done"
+    wait_for(lambda: chat_logs() == [("t0 t1 t2 ", 13)])
+    assert_released()
+    assert ai_messages_today(user.id) == 1
+    assert rollup_deltas == [{"ai_messages": 1, "ai_tokens": 13}]
+
+def test_upstream_failure_mid_stream(make_user, upstream, live_server, rollup_deltas):
+    user = make_user()
+    upstream.reply(stream(tokens=5, break_after=2))
+    
+    with httpx.Client(base_url=live_server, timeout=10) as http:
+        with post_stream(http, user.id, "Explain the broken stream") as response:
+            assert response.status_code == 200
+            events = parse_events(response.iter_lines())
+    
+    assert [name for name, _ in events] == ["delta", "delta", "error"]
+    # The partial answer is logged and charged, one token per delta
+    wait_for(lambda: chat_logs() == [("t0 t1 ", 2)])
+    assert_released()
+    assert ai_messages_today(user.id) == 1
+
+def test_client_disconnect_mid_stream(make_user, upstream, live_server, rollup_deltas):
+    user = make_user()
+    # Never set: the upstream stalls after its first chunk until the client gives up
+    upstream.reply(stream(tokens=5, gate=asyncio.Event()))
+    
+    with httpx.Client(base_url=live_server, timeout=10) as http:
+        with post_stream(http, user.id, "Explain the abandoned stream") as response:
+            lines = response.iter_lines()
+            assert next(lines) == "event: delta"
+            assert ai_scheduler.metrics()["running"] == 1
+    
+    wait_for(lambda: chat_logs() == [("t0 ", 1)])
+    assert_released()
+    assert ai_messages_today(user.id) == 1
+
+def test_disconnect_before_the_first_byte_is_sent(make_user, upstream, rollup_deltas):
+    user = make_user()
+    upstream.reply(stream(tokens=3))
+    
+    async def abandon():
+        db = SessionLocal()
+        try:
+            response = await routes.ai_chat_stream("Explain the unsent stream", db.get(User, user.id), db)
+        finally:
+            db.close()
+        assert ai_scheduler.metrics()["running"] == 1
+        
+        sent = []
+        async def receive():
+            return {"type": "http.disconnect"}
+        async def send(message):
+            sent.append(message)
+        await response({"type": "http"}, receive, send)
+    
+    asyncio.run(abandon())
+    
+    assert_released()
+    assert len(chat_logs()) == 1
+    assert ai_messages_today(user.id) == 1
@@ -0,0 +1,171 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from ai_scheduler import AIRequestScheduler
+
+@pytest.fixture
+def scheduler():
+    scheduler = AIRequestScheduler()
+    scheduler.max_concurrent = 1
+    scheduler.max_per_user = 2
+    scheduler.max_queue = 10
+    scheduler.deadline = 5
+    scheduler._avg_service_seconds = 0.01
+    return scheduler
+
+async def hold(scheduler, user_id, premium, release: asyncio.Event, order: list):
+    async with scheduler.slot(user_id, premium):
+        order.append(user_id)
+        await release.wait()
+
+async def started(scheduler, waiting: int):
+    """Let the tasks run until one holds the slot and `waiting` others are queued"""
+    for _ in range(100):
+        if scheduler._running == 1 and len(scheduler._waiters) == waiting:
+            return
+        await asyncio.sleep(0)
+    raise AssertionError(f"expected {waiting} waiters, found {len(scheduler._waiters)}")
+
+def test_priority_lane_is_served_before_earlier_normal_requests(scheduler):
+    async def scenario():
+        release = asyncio.Event()
+        order = []
+        tasks = [asyncio.create_task(hold(scheduler, 1, False, release, order))]
+        await started(scheduler, 0)
+        for user_id, premium in ((2, False), (3, False), (4, True)):
+            tasks.append(asyncio.create_task(hold(scheduler, user_id, premium, release, order)))
+            await asyncio.sleep(0)
+        await started(scheduler, 3)
+        assert scheduler.metrics()["lanes"]["priority"]["queued"] == 1
+        
+        release.set()
+        await asyncio.gather(*tasks)
+        return order
+    
+    assert asyncio.run(scenario()) == [1, 4, 2, 3]
+    assert scheduler.metrics()["completed"] == 4
+    assert scheduler.metrics()["running"] == 0
+
+def test_full_queue_is_shed_immediately(scheduler):
+    scheduler.max_queue = 1
+    
+    async def scenario():
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(hold(scheduler, user_id, False, release, [])) for user_id in (1, 2)]
+        await started(scheduler, 1)
+        with pytest.raises(HTTPException) as error:
+            async with scheduler.slot(3, False):
+                pass
+        release.set()
+        await asyncio.gather(*tasks)
+        return error.value
+    
+    error = asyncio.run(scenario())
+    assert error.status_code == 503
+    assert "Retry-After" in error.headers
+    assert scheduler.metrics()["shed_queue_full"] == 1
+
+def test_request_that_cannot_start_by_the_deadline_is_shed_up_front(scheduler):
+    scheduler._avg_service_seconds = 30
+    
+    async def scenario():
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(scheduler, 1, False, release, []))
+        await started(scheduler, 0)
+        with pytest.raises(HTTPException) as error:
+            async with scheduler.slot(2, False):
+                pass
+        release.set()
+        await holder
+        return error.value
+    
+    error = asyncio.run(scenario())
+    assert error.status_code == 503
+    assert error.headers["Retry-After"] == "30"
+    assert scheduler.metrics()["shed_deadline"] == 1
+
+def test_waiter_is_shed_when_the_deadline_passes(scheduler):
+    scheduler.deadline = 0.05
+    
+    async def scenario():
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(scheduler, 1, False, release, []))
+        await started(scheduler, 0)
+        with pytest.raises(HTTPException) as error:
+            async with scheduler.slot(2, False):
+                pass
+        release.set()
+        await holder
+        return error.value
+    
+    assert asyncio.run(scenario()).status_code == 503
+    assert scheduler.metrics()["shed_deadline"] == 1
+    assert scheduler.metrics()["running"] == 0
+    assert scheduler._per_user == {}
+
+def test_per_user_cap_returns_429(scheduler):
+    scheduler.max_per_user = 1
+    
+    async def scenario():
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(scheduler, 1, False, release, []))
+        await started(scheduler, 0)
+        with pytest.raises(HTTPException) as error:
+            async with scheduler.slot(1, False):
+                pass
+        release.set()
+        await holder
+        return error.value
+    
+    assert asyncio.run(scenario()).status_code == 429
+    assert scheduler.metrics()["rejected_per_user"] == 1
+
+def test_cancelled_waiter_does_not_leak_its_place(scheduler):
+    async def scenario():
+        release = asyncio.Event()
+        order = []
+        holder = asyncio.create_task(hold(scheduler, 1, False, release, order))
+        await started(scheduler, 0)
+        waiter = asyncio.create_task(hold(scheduler, 2, False, release, order))
+        await started(scheduler, 1)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        release.set()
+        await holder
+        async with scheduler.slot(3, False):
+            order.append(3)
+        return order
+    
+    assert asyncio.run(scenario()) == [1, 3]
+    assert scheduler.metrics()["running"] == 0
+    assert scheduler._per_user == {}
+
+def test_timed_out_waiters_leave_the_queue(scheduler):
+    scheduler.max_queue = 2
+    scheduler.deadline = 0.05
+    
+    async def scenario():
+        release = asyncio.Event()
+        order = []
+        holder = asyncio.create_task(hold(scheduler, 1, False, release, order))
+        await started(scheduler, 0)
+        for user_id in (2, 3):
+            with pytest.raises(HTTPException):
+                async with scheduler.slot(user_id, False):
+                    pass
+        assert scheduler.metrics()["queue_depth"] == 0
+        assert scheduler.metrics()["lanes"]["normal"]["queued"] == 0
+        
+        # With the slot still held, a new request queues instead of being shed as "queue full"
+        waiter = asyncio.create_task(hold(scheduler, 4, False, release, order))
+        await started(scheduler, 1)
+        release.set()
+        await asyncio.gather(holder, waiter)
+        return order
+    
+    assert asyncio.run(scenario()) == [1, 4]
+    assert scheduler.metrics()["shed_queue_full"] == 0
+    assert scheduler.metrics()["shed_deadline"] == 2
+    assert scheduler.metrics()["running"] == 0
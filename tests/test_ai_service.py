@@ -0,0 +1,172 @@
+import asyncio
+import time
+from email.utils import formatdate
+
+import pytest
+from fastapi import HTTPException
+
+from ai_service import AIService, CircuitBreaker, parse_retry_after
+from mock_upstream import MockUpstream, completion, status, stream
+
+@pytest.fixture
+def upstream():
+    return MockUpstream()
+
+@pytest.fixture
+def service(upstream, monkeypatch):
+    service = AIService()
+    service.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+    service._client = upstream.client()
+    # Keep jittered backoff short; Retry-After from the upstream still applies
+    monkeypatch.setattr("ai_service.settings.AI_RETRY_BACKOFF_SECONDS", 0.001)
+    return service
+
+def chat(service, message="What is entropy?"):
+    return asyncio.run(service.chat(message))
+
+def test_breaker_opens_after_threshold_and_closes_after_successful_trial():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+    
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.retry_after() >= 1
+    
+    time.sleep(0.12)
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow(), "only one trial call while half-open"
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+def test_failed_trial_reopens_breaker():
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=0.1)
+    for _ in range(5):
+        breaker.record_failure()
+    time.sleep(0.12)
+    
+    assert breaker.allow()
+    breaker.record_failure()
+    
+    assert breaker.state == "open"
+
+def test_released_trial_lets_another_call_through():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    
+    assert breaker.allow()
+    breaker.release()
+    
+    assert breaker.allow()
+
+def test_upstream_outage_opens_breaker_and_fails_fast(service, upstream):
+    upstream.reply(*[status(503)] * 6)
+    
+    for _ in range(2):
+        with pytest.raises(HTTPException) as error:
+            chat(service)
+        assert error.value.status_code == 502
+    sent = len(upstream.requests)
+    
+    with pytest.raises(HTTPException) as error:
+        chat(service)
+    
+    assert error.value.status_code == 503
+    assert "Retry-After" in error.value.headers
+    assert len(upstream.requests) == sent == 6
+    
+    time.sleep(0.25)
+    assert chat(service)["response"] == "Hello"
+    assert service.breaker.state == "closed"
+
+def test_retry_after_is_honoured_before_retrying(service, upstream):
+    upstream.reply(status(429, retry_after="0.3"), completion("Second try"))
+    
+    started = time.monotonic()
+    result = chat(service)
+    
+    assert result == {"response": "Second try", "tokens_used": 12}
+    assert time.monotonic() - started >= 0.3
+    assert len(upstream.requests) == 2
+
+def test_final_rate_limit_returns_503_with_upstream_retry_after(service, upstream):
+    upstream.reply(*[status(429, retry_after="0")] * 2, status(429, retry_after="7"))
+    
+    with pytest.raises(HTTPException) as error:
+        chat(service)
+    
+    assert error.value.status_code == 503
+    assert error.value.headers["Retry-After"] == "7"
+    assert service.breaker.state == "closed"
+
+def test_final_rate_limit_leaves_half_open_breaker_half_open(service, upstream):
+    service.breaker.record_failure()
+    service.breaker.record_failure()
+    time.sleep(0.25)
+    assert service.breaker.state == "half_open"
+    upstream.reply(*[status(429, retry_after="0")] * 3)
+    
+    with pytest.raises(HTTPException):
+        chat(service)
+    
+    assert service.breaker.state == "half_open"
+    assert service.breaker.allow(), "the trial slot is free for the next call"
+
+def test_cancelled_call_does_not_free_a_trial_it_never_held(service, upstream):
+    async def scenario():
+        gate = asyncio.Event()
+        async def stalled():
+            await gate.wait()
+            return completion()
+        upstream.reply(stalled)
+        # Sent while the breaker was still closed, then stuck upstream
+        in_flight = asyncio.create_task(service.chat("What is entropy?"))
+        await asyncio.sleep(0.01)
+        service.breaker.record_failure()
+        service.breaker.record_failure()
+        await asyncio.sleep(0.25)
+        assert service.breaker.allow(), "another call takes the half-open trial"
+        
+        in_flight.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await in_flight
+        
+        assert not service.breaker.allow(), "the trial is still held by the other call"
+    
+    asyncio.run(scenario())
+
+def test_parse_retry_after_accepts_seconds_and_http_dates():
+    assert parse_retry_after("2.5") == 2.5
+    assert parse_retry_after("-1") == 0.0
+    assert 8 <= parse_retry_after(formatdate(time.time() + 10, usegmt=True)) <= 10
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after(None) is None
+
+def test_stream_yields_deltas_then_usage(service, upstream):
+    upstream.reply(lambda: stream(tokens=3))
+    
+    async def collect():
+        return [event async for event in service.chat_stream("Explain osmosis")]
+    events = asyncio.run(collect())
+    
+    assert events[:-1] == [{"delta": "t0 "}, {"delta": "t1 "}, {"delta": "t2 "}]
+    assert events[-1] == {"tokens_used": 13, "finished": True}
+    assert upstream.requests[0]["stream"] is True
+
+def test_stream_broken_mid_way_raises_502(service, upstream):
+    upstream.reply(lambda: stream(tokens=5, break_after=2))
+    
+    async def collect():
+        events = []
+        with pytest.raises(HTTPException) as error:
+            async for event in service.chat_stream("Explain osmosis"):
+                events.append(event)
+        return events, error.value
+    events, error = asyncio.run(collect())
+    
+    assert events == [{"delta": "t0 "}, {"delta": "t1 "}]
+    assert error.status_code == 502
@@ -0,0 +1,113 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from auth import RevokedTokenFilter, principal_cache, principal_invalidations
+from conftest import auth_headers
+from database import TokenBlacklist, UserRole
+
+def blacklist(db, id, jti, blacklisted_at):
+    db.add(TokenBlacklist(
+        id=id, jti=jti, expires_at=datetime.utcnow() + timedelta(hours=1), blacklisted_at=blacklisted_at
+    ))
+    db.commit()
+
+def test_incremental_refresh_sees_rows_committed_out_of_id_order(db):
+    revocations = RevokedTokenFilter()
+    blacklist(db, 10, "committed-first", datetime.utcnow())
+    assert revocations.is_revoked("committed-first", db)
+    
+    # Row 5 was inserted before row 10 but its transaction commits only now
+    blacklist(db, 5, "committed-late", datetime.utcnow() - timedelta(seconds=2))
+    revocations.next_refresh = 0.0
+    
+    assert revocations.is_revoked("committed-late", db)
+    assert revocations.is_revoked("committed-first", db)
+
+def test_incremental_refresh_skips_rows_older_than_the_skew(db):
+    revocations = RevokedTokenFilter()
+    assert not revocations.is_revoked("anything", db)
+    
+    blacklist(db, 1, "seen-by-full-reload", datetime.utcnow() - timedelta(days=1))
+    revocations.next_refresh = 0.0
+    assert not revocations.is_revoked("seen-by-full-reload", db)
+    
+    revocations.next_refresh = revocations.next_full_reload = 0.0
+    assert revocations.is_revoked("seen-by-full-reload", db)
+
+def test_failed_refresh_backs_off_and_keeps_the_last_set(db, monkeypatch):
+    revocations = RevokedTokenFilter()
+    blacklist(db, 1, "loaded", datetime.utcnow())
+    assert revocations.is_revoked("loaded", db)
+    
+    attempts = []
+    def broken(db):
+        attempts.append(db)
+        raise RuntimeError("database unavailable")
+    monkeypatch.setattr(revocations, "_refresh", broken)
+    revocations.next_refresh = 0.0
+    
+    assert revocations.is_revoked("loaded", db)
+    assert revocations.is_revoked("loaded", db)
+    assert len(attempts) == 1
+    assert revocations.next_refresh > 0.0
+
+def test_failed_first_load_is_not_treated_as_an_empty_set(db, monkeypatch):
+    revocations = RevokedTokenFilter()
+    def broken(db):
+        raise RuntimeError("database unavailable")
+    monkeypatch.setattr(revocations, "_refresh", broken)
+    
+    with pytest.raises(RuntimeError):
+        revocations.is_revoked("anything", db)
+
+def test_add_waits_for_a_running_refresh():
+    revocations = RevokedTokenFilter()
+    expires_at = datetime.utcnow() + timedelta(hours=1)
+    
+    with revocations._lock:
+        adder = threading.Thread(target=revocations.add, args=("new", expires_at))
+        adder.start()
+        adder.join(timeout=0.2)
+        assert adder.is_alive()
+        # What a refresh does while holding the lock
+        revocations.revoked = {}
+    adder.join()
+    
+    assert revocations.revoked == {"new": expires_at}
+
+class RecordingRedis:
+    def __init__(self):
+        self.published = []
+    
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+
+@pytest.fixture
+def redis_channel(monkeypatch):
+    redis = RecordingRedis()
+    monkeypatch.setattr(principal_invalidations, "redis", redis)
+    return redis
+
+def test_blocking_a_user_publishes_invalidation(client, make_user, redis_channel):
+    admin = make_user(role=UserRole.ADMIN)
+    user = make_user()
+    assert client.get("/api/notifications/unread-count", headers=auth_headers(user.id)).status_code == 200
+    assert principal_cache.get(user.id) is not None
+    
+    response = client.post(f"/api/admin/users/{user.id}/block", headers=auth_headers(admin.id))
+    
+    assert response.status_code == 200
+    assert redis_channel.published == [(principal_invalidations.CHANNEL, user.id)]
+    assert principal_cache.get(user.id) is None
+    assert client.get("/api/notifications/unread-count", headers=auth_headers(user.id)).status_code == 403
+
+def test_invalidation_from_another_worker_drops_cached_principal(client, make_user):
+    user = make_user()
+    client.get("/api/notifications/unread-count", headers=auth_headers(user.id))
+    assert principal_cache.get(user.id) is not None
+    
+    principal_invalidations._dispatch(str(user.id).encode())
+    
+    assert principal_cache.get(user.id) is None
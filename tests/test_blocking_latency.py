@@ -0,0 +1,72 @@
+"""Load test: latency of unrelated requests while slow queries are in flight"""
+import asyncio
+import time
+
+import httpx
+import pytest
+from fastapi import Depends
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+import main
+from database import get_db, Note, User
+
+SLOW_QUERY_SECONDS = 0.5
+SLOW_REQUESTS = 4
+FAST_REQUESTS = 200
+
+def slow_query_sync(db: Session = Depends(get_db)):
+    return {"slept": db.execute(text("SELECT sleep(:seconds)"), {"seconds": SLOW_QUERY_SECONDS}).scalar()}
+
+async def slow_query_async(db: Session = Depends(get_db)):
+    # How every handler was written before: a sync Session inside `async def`
+    return slow_query_sync(db)
+
+@pytest.fixture
+def slow_routes(file_database):
+    event.listen(file_database, "connect", lambda connection, record: connection.create_function("sleep", 1, time.sleep))
+    file_database.dispose()
+    db = main.SessionLocal()
+    db.add(User(id=1, email="owner@example.com", name="Owner", google_id="owner"))
+    db.add_all(Note(user_id=1, title=f"Note {index}", subject="Physics", file_path=f"{index}.pdf") for index in range(20))
+    db.commit()
+    db.close()
+    
+    routes = list(main.app.router.routes)
+    main.app.add_api_route("/test/slow-sync", slow_query_sync)
+    main.app.add_api_route("/test/slow-async", slow_query_async)
+    yield
+    main.app.router.routes[:] = routes
+
+async def unrelated_latencies(base_url: str, slow_path: str) -> list:
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        slow = [asyncio.create_task(client.get(slow_path)) for _ in range(SLOW_REQUESTS)]
+        await asyncio.sleep(0.01)
+        
+        async def timed_request():
+            started = time.perf_counter()
+            response = await client.get("/api/notes?limit=5&include_total=false")
+            assert response.status_code == 200
+            return time.perf_counter() - started
+        
+        latencies = []
+        for _ in range(FAST_REQUESTS // 10):
+            latencies += await asyncio.gather(*(timed_request() for _ in range(10)))
+        for response in await asyncio.gather(*slow):
+            assert response.status_code == 200
+        return sorted(latencies)
+
+def percentile(latencies: list, fraction: float) -> float:
+    return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+
+@pytest.mark.benchmark
+def test_benchmark_unrelated_request_latency_during_slow_queries(slow_routes, live_server):
+    results = {}
+    for name, path in (("async def handlers", "/test/slow-async"), ("threadpool handlers", "/test/slow-sync")):
+        latencies = asyncio.run(unrelated_latencies(live_server, path))
+        results[name] = (percentile(latencies, 0.5), percentile(latencies, 0.99))
+        print(f"{name}: p50 {results[name][0] * 1000:.1f}ms, p99 {results[name][1] * 1000:.1f}ms")
+    
+    # Blocking handlers stall the loop for every slow query in turn
+    assert results["async def handlers"][1] >= SLOW_QUERY_SECONDS
+    assert results["threadpool handlers"][1] < SLOW_QUERY_SECONDS
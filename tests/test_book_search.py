@@ -0,0 +1,85 @@
+"""Geo mode of GET /api/books: the geohash/bounding-box prefilter must never drop a book inside the radius"""
+import math
+from datetime import datetime, timedelta
+
+import pytest
+
+from database import Book, BookCondition, BookStatus
+from utils import EARTH_RADIUS_KM, bounding_box, encode_geohash, geohash_cells_for_bbox
+
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180
+# Just north-east of where the four top-level geohash cells meet, so nearby
+# books land in cells that share no prefix with the origin's
+LATITUDE, LONGITUDE = 0.01, 0.01
+
+@pytest.fixture
+def add_book(db, make_user):
+    owner = make_user()
+    
+    def add(title, latitude, longitude):
+        db.add(Book(
+            user_id=owner.id, title=title, condition=BookCondition.GOOD, price=100.0,
+            latitude=latitude, longitude=longitude, geohash=encode_geohash(latitude, longitude),
+            status=BookStatus.AVAILABLE, expires_at=datetime.utcnow() + timedelta(days=30)
+        ))
+        db.commit()
+    return add
+
+def search(client, radius=10, **params):
+    response = client.get("/api/books", params={"latitude": LATITUDE, "longitude": LONGITUDE, "radius": radius, **params})
+    assert response.status_code == 200
+    return response.json()
+
+def test_results_are_ordered_by_distance(client, add_book):
+    add_book("Far", LATITUDE + 0.06, LONGITUDE)
+    add_book("Near", LATITUDE + 0.01, LONGITUDE)
+    add_book("Middle", LATITUDE, LONGITUDE + 0.03)
+    
+    books = search(client)["books"]
+    
+    assert [book["title"] for book in books] == ["Near", "Middle", "Far"]
+    distances = [book["distance_km"] for book in books]
+    assert distances == sorted(distances)
+    assert distances[0] == pytest.approx(0.01 * KM_PER_DEGREE, abs=0.01)
+
+def test_books_across_a_geohash_cell_edge_are_found(client, add_book):
+    corners = {
+        "South-west": (LATITUDE - 0.03, LONGITUDE - 0.03),
+        "South": (LATITUDE - 0.03, LONGITUDE),
+        "West": (LATITUDE, LONGITUDE - 0.03),
+        "Here": (LATITUDE, LONGITUDE),
+    }
+    for title, (latitude, longitude) in corners.items():
+        add_book(title, latitude, longitude)
+    # The prefilter is in play, and every book sits in a different top-level cell
+    assert geohash_cells_for_bbox(*bounding_box(LATITUDE, LONGITUDE, 10))
+    assert len({encode_geohash(*point)[0] for point in corners.values()}) == 4
+    
+    books = search(client)["books"]
+    
+    assert {book["title"] for book in books} == set(corners)
+
+def test_radius_is_a_hard_cutoff(client, add_book):
+    # Due south, across the equator: 9.9 km and 10.1 km away
+    add_book("Inside", LATITUDE - 9.9 / KM_PER_DEGREE, LONGITUDE)
+    add_book("Outside", LATITUDE - 10.1 / KM_PER_DEGREE, LONGITUDE)
+    # Inside the bounding box's corner but outside the circle
+    add_book("Corner", LATITUDE + 9 / KM_PER_DEGREE, LONGITUDE + 9 / KM_PER_DEGREE)
+    
+    books = search(client)["books"]
+    
+    assert [book["title"] for book in books] == ["Inside"]
+    assert books[0]["distance_km"] == pytest.approx(9.9, abs=0.01)
+    assert [book["title"] for book in search(client, radius=11)["books"]] == ["Inside", "Outside"]
+
+def test_cursor_pages_through_the_ranked_list(client, add_book):
+    for index in range(5):
+        add_book(f"Book {index}", LATITUDE + index * 0.005, LONGITUDE)
+    
+    first = search(client, limit=2)
+    second = search(client, limit=2, cursor=first["next_cursor"])
+    third = search(client, limit=2, cursor=second["next_cursor"])
+    
+    titles = [book["title"] for page in (first, second, third) for book in page["books"]]
+    assert titles == [f"Book {index}" for index in range(5)]
+    assert third["next_cursor"] is None
@@ -0,0 +1,138 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+import database
+from analytics_rollups import daily_stats, DailyStatsRollup, ROLLUP_FIELDS
+from database import DailyStat
+
+@pytest.fixture
+def sqlite_upsert(monkeypatch):
+    # The flush's upsert is MySQL's ON DUPLICATE KEY UPDATE; SQLite spells it ON CONFLICT
+    def upsert(self, db, day, values, replace=False):
+        statement = sqlite_insert(DailyStat).values(day=day, **values)
+        db.execute(statement.on_conflict_do_update(
+            index_elements=[DailyStat.day],
+            set_={
+                field: statement.excluded[field] if replace else getattr(DailyStat, field) + statement.excluded[field]
+                for field in values
+            }
+        ))
+    monkeypatch.setattr(DailyStatsRollup, "_upsert", upsert)
+
+def stored_rows():
+    db = database.SessionLocal()
+    try:
+        return {row.day: (row.signups, row.downloads, row.earnings) for row in db.query(DailyStat)}
+    finally:
+        db.close()
+
+def test_deltas_are_buffered_when_the_transaction_commits(db, query_log):
+    daily_stats.record(db, signups=1)
+    assert daily_stats.pending() == {}
+    
+    db.commit()
+    
+    today = datetime.utcnow().date()
+    assert daily_stats.pending()[today]["signups"] == 1
+    assert not [statement for statement in query_log if "daily_stats" in statement]
+
+def test_rolled_back_deltas_are_dropped(db):
+    db.add(database.User(email="signup@example.com", name="Signup", google_id="signup"))
+    db.flush()
+    daily_stats.record(db, signups=1)
+    db.rollback()
+    db.commit()
+    
+    assert daily_stats.pending() == {}
+
+def test_flush_merges_buffered_deltas_into_the_day_row(db, sqlite_upsert):
+    today = datetime.utcnow().date()
+    for _ in range(3):
+        daily_stats.record(db, downloads=1, earnings=0.1)
+        db.commit()
+    
+    assert daily_stats.flush() == 1
+    daily_stats.record(db, downloads=1, earnings=0.1, signups=1)
+    db.commit()
+    assert daily_stats.flush() == 1
+    
+    signups, downloads, earnings = stored_rows()[today]
+    assert (signups, downloads) == (1, 4)
+    assert earnings == pytest.approx(0.4)
+    assert daily_stats.pending() == {}
+    assert daily_stats.flush() == 0
+
+def test_failed_flush_keeps_the_deltas(db, monkeypatch):
+    def broken(self, db, day, values, replace=False):
+        raise RuntimeError("database unavailable")
+    monkeypatch.setattr(DailyStatsRollup, "_upsert", broken)
+    daily_stats.record(db, signups=2)
+    db.commit()
+    
+    with pytest.raises(RuntimeError):
+        daily_stats.flush()
+    
+    assert daily_stats.pending()[datetime.utcnow().date()]["signups"] == 2
+
+def test_totals_and_series_include_unflushed_deltas(db, sqlite_upsert):
+    daily_stats.record(db, downloads=2, earnings=0.2)
+    db.commit()
+    daily_stats.flush()
+    daily_stats.record(db, downloads=1, earnings=0.1)
+    db.commit()
+    
+    totals = daily_stats.totals(db)
+    assert totals["downloads"] == 3
+    assert totals["earnings"] == pytest.approx(0.3)
+    series = daily_stats.series(db, "day", 2)
+    assert [bucket["downloads"] for bucket in series] == [0, 3]
+
+def add_stat_row(day, **values):
+    db = database.SessionLocal()
+    db.add(DailyStat(day=day, **{**dict.fromkeys(ROLLUP_FIELDS, 0), **values}))
+    db.commit()
+    db.close()
+
+def test_backfill_overwrites_each_day_in_place(make_user, sqlite_upsert):
+    today = datetime.utcnow().date()
+    old_day = today - timedelta(days=10)
+    add_stat_row(today, signups=99, downloads=7, earnings=0.7)
+    add_stat_row(old_day, signups=5)
+    make_user()
+    make_user()
+    
+    assert daily_stats.backfill() == 1
+    
+    assert stored_rows() == {today: (2, 0, 0), old_day: (0, 0, 0)}
+
+def test_only_one_worker_rebuilds_at_a_time(db, sqlite_upsert):
+    daily_stats._state(db).locked_until = datetime.utcnow() + timedelta(minutes=5)
+    db.commit()
+    
+    assert daily_stats.backfill() is None
+    
+    daily_stats._state(db).locked_until = datetime.utcnow() - timedelta(seconds=1)
+    db.commit()
+    assert daily_stats.backfill() == 0
+    assert daily_stats._state(db).locked_until is None
+
+def test_startup_backfill_runs_once_across_workers(sqlite_upsert):
+    other_worker = DailyStatsRollup()
+    
+    assert daily_stats.backfill(only_if_never_built=True) == 0
+    assert other_worker.backfill(only_if_never_built=True) is None
+
+def test_flush_drops_deltas_the_rebuild_already_counted(make_user, sqlite_upsert):
+    # Another worker buffered a signup before the rebuild read the users table and one after
+    other_worker = DailyStatsRollup()
+    today = datetime.utcnow().date()
+    make_user()
+    other_worker._merge_back({(today, datetime.utcnow().replace(microsecond=0) - timedelta(seconds=5)): {"signups": 1}})
+    
+    assert daily_stats.backfill() == 1
+    other_worker._merge_back({(today, datetime.utcnow().replace(microsecond=0) + timedelta(seconds=5)): {"signups": 1}})
+    other_worker.flush()
+    
+    assert stored_rows()[today][0] == 2
@@ -0,0 +1,142 @@
+"""The storage deletion outbox against an in-memory storage backend"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+import deletion_outbox as outbox
+from database import Note, StorageDeletion
+from storage import StorageBackend
+
+class FakeStorage(StorageBackend):
+    """Keeps objects in a dict and records every delete_files batch"""
+    
+    def __init__(self):
+        self.objects = {}
+        self.batches = []
+        self.failing = set()
+        self.down = False
+    
+    def put_object(self, file_key, file_content, content_type, cache_control=None):
+        self.objects[file_key] = (file_content, datetime.utcnow())
+        return file_key
+    
+    def put_file(self, file_key, file_path, content_type):
+        with open(file_path, "rb") as f:
+            return self.put_object(file_key, f.read(), content_type)
+    
+    def generate_presigned_url(self, file_key, expiration=3600):
+        return f"memory://{file_key}"
+    
+    def delete_files(self, file_keys):
+        self.batches.append(list(file_keys))
+        if self.down:
+            raise ConnectionError("storage unreachable")
+        failed = {}
+        for file_key in file_keys:
+            if file_key in self.failing:
+                failed[file_key] = "access denied"
+            else:
+                self.objects.pop(file_key, None)
+        return failed
+    
+    def list_keys(self, prefix):
+        for file_key, (_, last_modified) in list(self.objects.items()):
+            if file_key.startswith(prefix):
+                yield file_key, last_modified
+
+@pytest.fixture
+def storage(monkeypatch):
+    storage = FakeStorage()
+    monkeypatch.setattr(outbox, "storage", storage)
+    return storage
+
+def queued():
+    db = database.SessionLocal()
+    try:
+        return {row.file_key: row for row in db.query(StorageDeletion)}
+    finally:
+        db.close()
+
+def enqueue(*file_keys):
+    db = database.SessionLocal()
+    outbox.deletion_outbox.enqueue(db, file_keys)
+    db.commit()
+    db.close()
+
+def make_due():
+    db = database.SessionLocal()
+    db.query(StorageDeletion).update({StorageDeletion.next_attempt_at: datetime.utcnow() - timedelta(seconds=1)})
+    db.commit()
+    db.close()
+
+def test_drain_deletes_queued_keys(storage):
+    for file_key in ("notes-pdf/1/a.pdf", "notes-pdf/1/b.pdf", "book-images/1/x/full.jpg"):
+        storage.put_object(file_key, b"data", "application/octet-stream")
+        enqueue(file_key)
+    
+    outbox.deletion_outbox.run_drain_job()
+    
+    assert storage.objects == {}
+    assert queued() == {}
+
+def test_failed_delete_is_retried_with_backoff(storage):
+    storage.failing.add("notes-pdf/1/stuck.pdf")
+    enqueue("notes-pdf/1/stuck.pdf", "notes-pdf/1/fine.pdf")
+    
+    assert outbox.deletion_outbox.drain_batch() == 2
+    
+    row = queued()["notes-pdf/1/stuck.pdf"]
+    assert list(queued()) == ["notes-pdf/1/stuck.pdf"]
+    assert row.attempts == 1
+    assert row.last_error == "access denied"
+    assert row.next_attempt_at > datetime.utcnow() + timedelta(seconds=outbox.RETRY_BASE_SECONDS - 5)
+    # Not due yet, so the next drain leaves it alone
+    assert outbox.deletion_outbox.drain_batch() == 0
+    
+    storage.failing.clear()
+    make_due()
+    assert outbox.deletion_outbox.drain_batch() == 1
+    assert queued() == {}
+
+def test_unreachable_storage_keeps_the_whole_batch(storage):
+    storage.down = True
+    enqueue("notes-pdf/1/a.pdf", "notes-pdf/1/b.pdf")
+    
+    outbox.deletion_outbox.drain_batch()
+    
+    rows = queued()
+    assert set(rows) == {"notes-pdf/1/a.pdf", "notes-pdf/1/b.pdf"}
+    assert all(row.attempts == 1 and "unreachable" in row.last_error for row in rows.values())
+
+def test_drain_job_works_in_batches(storage, monkeypatch):
+    monkeypatch.setattr(outbox, "DELETE_BATCH_SIZE", 2)
+    enqueue(*[f"notes-pdf/1/{index}.pdf" for index in range(5)])
+    
+    outbox.deletion_outbox.run_drain_job()
+    
+    assert [len(batch) for batch in storage.batches] == [2, 2, 1]
+    assert queued() == {}
+
+def test_delete_now_queues_only_what_failed(storage):
+    storage.failing.add("book-images/1/x/thumb.webp")
+    
+    assert outbox.deletion_outbox.delete_now(["book-images/1/x/full.jpg", "book-images/1/x/thumb.webp"]) == 1
+    
+    assert list(queued()) == ["book-images/1/x/thumb.webp"]
+
+def test_reconcile_queues_old_unreferenced_files(storage, db, make_user):
+    user = make_user()
+    old = datetime.utcnow() - timedelta(days=30)
+    storage.objects = {
+        "notes-pdf/1/kept.pdf": (b"", old),
+        "notes-pdf/1/orphan.pdf": (b"", old),
+        "notes-pdf/1/just-uploaded.pdf": (b"", datetime.utcnow()),
+    }
+    db.add(Note(user_id=user.id, title="Kept", subject="Maths", file_path="notes-pdf/1/kept.pdf"))
+    db.commit()
+    
+    assert outbox.deletion_outbox.reconcile() == 1
+    assert list(queued()) == ["notes-pdf/1/orphan.pdf"]
+    # Already queued keys are not queued twice
+    assert outbox.deletion_outbox.reconcile() == 0
@@ -0,0 +1,166 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fakeredis
+import pytest
+from sqlalchemy import update
+
+import database
+import engagement_counters as counters_module
+from conftest import auth_headers
+from database import Note
+from engagement_counters import engagement_counters, EngagementCounterBuffer, RedisCounterStore
+
+@pytest.fixture
+def note(db, make_user):
+    note = Note(user_id=make_user().id, title="Optics", subject="Physics", file_path="notes/optics.pdf")
+    db.add(note)
+    db.commit()
+    return note.id
+
+def read_note(note_id):
+    db = database.SessionLocal()
+    try:
+        return db.query(Note.downloads, Note.earnings, Note.views).filter(Note.id == note_id).one()
+    finally:
+        db.close()
+
+def test_download_credits_earnings_without_waiting_for_a_flush(client, make_user, note, rollup_deltas):
+    headers = auth_headers(make_user().id)
+    
+    for _ in range(2):
+        assert client.post(f"/api/notes/{note}/download", headers=headers).status_code == 200
+    
+    downloads, earnings, _ = read_note(note)
+    assert downloads == 1
+    assert earnings == pytest.approx(0.1)
+    assert rollup_deltas == [{"downloads": 1, "earnings": 0.1}]
+    assert engagement_counters.pending(note, "trending") == 1
+    engagement_counters.flush()
+
+def test_concurrent_views_are_all_flushed(client, make_user, note):
+    headers = auth_headers(make_user().id)
+    
+    def view(_):
+        return client.post(f"/api/notes/{note}/view", data={"view_duration": 5}, headers=headers).status_code
+    
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        assert set(pool.map(view, range(200))) == {200}
+    assert engagement_counters.flush() == 1
+    
+    assert read_note(note).views == 200
+    assert engagement_counters.pending(note, "views") == 0
+
+@pytest.fixture
+def redis_server():
+    return fakeredis.FakeServer()
+
+def redis_buffer(server) -> EngagementCounterBuffer:
+    """A worker's buffer; buffers built on the same server share the store, like workers sharing Redis"""
+    return EngagementCounterBuffer(RedisCounterStore(fakeredis.FakeRedis(server=server)))
+
+class BrokenSession:
+    def execute(self, *args, **kwargs):
+        raise RuntimeError("database unavailable")
+    
+    def rollback(self):
+        pass
+    
+    def close(self):
+        pass
+
+def test_clicks_in_redis_survive_a_worker_crash(note, redis_server):
+    crashed = redis_buffer(redis_server)
+    for _ in range(3):
+        crashed.increment(note, views=1)
+    crashed.increment(note, shares=1, trending=0.5)
+    assert crashed._deltas == {}
+    
+    # A restarted worker drains what the crashed one acknowledged
+    restarted = redis_buffer(redis_server)
+    assert restarted.pending(note, "views") == 3
+    assert restarted.flush() == 1
+    
+    assert read_note(note).views == 3
+    assert restarted.pending(note, "views") == 0
+    assert restarted.flush() == 0
+
+def test_failed_flush_leaves_the_batch_in_redis_for_the_next_one(note, redis_server, monkeypatch):
+    worker = redis_buffer(redis_server)
+    worker.increment(note, views=2)
+    
+    with monkeypatch.context() as patch:
+        patch.setattr(counters_module, "SessionLocal", BrokenSession)
+        with pytest.raises(RuntimeError):
+            worker.flush()
+    worker.increment(note, views=1)
+    
+    assert worker.flush() == 1
+    assert read_note(note).views == 3
+    assert worker.flush() == 0
+    assert read_note(note).views == 3
+
+def test_only_one_worker_drains_the_shared_batch_at_a_time(note, redis_server):
+    flushing, other = redis_buffer(redis_server), redis_buffer(redis_server)
+    other.increment(note, views=4)
+    lock = flushing.store.lock()
+    assert lock.acquire()
+    
+    assert other.flush() == 0
+    lock.release()
+    assert other.flush() == 1
+    assert read_note(note).views == 4
+
+def test_clicks_fall_back_to_memory_while_redis_is_down(note, redis_server, capsys):
+    worker = redis_buffer(redis_server)
+    redis_server.connected = False
+    for _ in range(5):
+        worker.increment(note, views=1)
+    
+    assert worker.pending(note, "views") == 5
+    assert capsys.readouterr().out.count("Counter store unreachable") == 1
+    assert worker.flush() == 1
+    assert read_note(note).views == 5
+    
+    redis_server.connected = True
+    worker.increment(note, views=1)
+    assert worker._deltas == {}
+    assert worker.flush() == 1
+    assert read_note(note).views == 6
+
+@pytest.mark.benchmark
+def test_benchmark_concurrent_clicks_on_one_note(file_database):
+    threads, clicks = 16, 250
+    db = database.SessionLocal()
+    db.add(database.User(id=1, email="owner@example.com", name="Owner", google_id="owner"))
+    db.add(Note(id=1, user_id=1, title="Hot", subject="Physics", file_path="notes/hot.pdf"))
+    db.commit()
+    db.close()
+    
+    def update_per_click(_):
+        for _ in range(clicks):
+            session = database.SessionLocal()
+            session.execute(update(Note).where(Note.id == 1).values(views=Note.views + 1))
+            session.commit()
+            session.close()
+    
+    def buffer_clicks(_):
+        for _ in range(clicks):
+            engagement_counters.increment(1, views=1)
+    
+    timings = {}
+    for name, worker in (("update per click", update_per_click), ("buffered", buffer_clicks)):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(worker, range(threads)))
+        engagement_counters.flush()
+        timings[name] = time.perf_counter() - started
+    
+    total = threads * clicks
+    for name, seconds in timings.items():
+        print(f"{name}: {total} clicks in {seconds:.3f}s ({total / seconds:,.0f} clicks/s)")
+    
+    session = database.SessionLocal()
+    assert session.query(Note.views).filter(Note.id == 1).scalar() == 2 * total
+    session.close()
+    assert timings["buffered"] < timings["update per click"]
@@ -0,0 +1,113 @@
+import os
+import socket
+import time
+
+import boto3
+import httpx
+import pytest
+from moto.server import ThreadedMotoServer
+
+import file_routes
+from storage import LocalStorageBackend, StorageBackend, StorageError
+
+KEY = "notes-pdf/1/lecture.pdf"
+
+@pytest.fixture
+def local_storage(tmp_path, monkeypatch, live_server):
+    backend = LocalStorageBackend(str(tmp_path / "storage"), live_server, b"test-signing-key")
+    monkeypatch.setattr(file_routes, "storage", backend)
+    return backend
+
+def store(backend, size: int) -> bytes:
+    content = os.urandom(size)
+    path = backend.path_for(KEY)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+    return content
+
+def test_signed_url_serves_whole_file_and_ranges(local_storage):
+    content = store(local_storage, 256 * 1024)
+    url = local_storage.generate_presigned_url(KEY, 3600)
+    
+    whole = httpx.get(url)
+    partial = httpx.get(url, headers={"Range": "bytes=1000-1999"})
+    suffix = httpx.get(url, headers={"Range": "bytes=-100"})
+    past_end = httpx.get(url, headers={"Range": f"bytes={len(content)}-"})
+    
+    assert whole.status_code == 200 and whole.content == content
+    assert whole.headers["accept-ranges"] == "bytes"
+    assert partial.status_code == 206 and partial.content == content[1000:2000]
+    assert partial.headers["content-range"] == f"bytes 1000-1999/{len(content)}"
+    assert suffix.status_code == 206 and suffix.content == content[-100:]
+    assert past_end.status_code == 416
+
+def test_tampered_or_expired_urls_are_refused(local_storage):
+    store(local_storage, 1024)
+    url = local_storage.generate_presigned_url(KEY, 3600)
+    expires = int(time.time()) - 1
+    
+    assert httpx.get(url.replace("lecture.pdf", "other.pdf")).status_code == 403
+    assert httpx.get(f"{local_storage.base_url}/api/files/{KEY}?expires={expires}&signature={local_storage.sign(KEY, expires)}").status_code == 403
+
+def test_empty_file_is_sent_whole_even_with_a_range(local_storage):
+    store(local_storage, 0)
+    url = local_storage.generate_presigned_url(KEY, 3600)
+    
+    response = httpx.get(url, headers={"Range": "bytes=0-"})
+    
+    assert response.status_code == 200 and response.content == b""
+
+def test_storage_backend_is_abstract():
+    with pytest.raises(TypeError):
+        StorageBackend()
+
+def test_delete_file_raises_when_the_backend_fails(local_storage, monkeypatch):
+    store(local_storage, 16)
+    local_storage.delete_file(KEY)
+    assert not os.path.exists(local_storage.path_for(KEY))
+    
+    monkeypatch.setattr(LocalStorageBackend, "delete_files", lambda self, file_keys: {key: "disk unavailable" for key in file_keys})
+    with pytest.raises(StorageError):
+        local_storage.delete_file(KEY)
+
+def download_rate(url: str) -> float:
+    """MB/s for one streamed GET of `url`"""
+    started = time.perf_counter()
+    received = 0
+    with httpx.stream("GET", url, timeout=120) as response:
+        assert response.status_code == 200
+        for chunk in response.iter_bytes():
+            received += len(chunk)
+    return received / (time.perf_counter() - started) / (1024 * 1024)
+
+@pytest.fixture
+def moto_server():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    server.start()
+    yield f"http://127.0.0.1:{port}"
+    server.stop()
+
+@pytest.mark.benchmark
+def test_benchmark_large_pdf_download_throughput(local_storage, moto_server):
+    size = 64 * 1024 * 1024
+    content = store(local_storage, size)
+    s3 = boto3.client("s3", region_name="us-east-1", endpoint_url=moto_server)
+    s3.create_bucket(Bucket="downloads")
+    s3.put_object(Bucket="downloads", Key=KEY, Body=content)
+    del content
+    
+    urls = {
+        "local backend (app, ranged FileResponse)": local_storage.generate_presigned_url(KEY, 3600),
+        "s3 backend (moto server stand-in)": s3.generate_presigned_url("get_object", Params={"Bucket": "downloads", "Key": KEY}, ExpiresIn=600)
+    }
+    rates = {}
+    for name, url in urls.items():
+        rates[name] = max(download_rate(url) for _ in range(3))
+        print(f"{name}: {rates[name]:,.0f} MB/s for a {size // (1024 * 1024)}MB PDF")
+    
+    assert all(rate > 0 for rate in rates.values())
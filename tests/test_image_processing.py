@@ -0,0 +1,61 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from image_processing import IMAGE_FORMATS, IMAGE_VARIANTS, InvalidImageError, build_image_variants, variant_key, variant_keys
+
+def encode(image: Image.Image, pil_format: str = "JPEG", **options) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, pil_format, **options)
+    return buffer.getvalue()
+
+def open_variant(variants, name):
+    content_type, content = variants[name]
+    return content_type, Image.open(BytesIO(content))
+
+def test_every_variant_is_built_in_every_format():
+    variants = build_image_variants(encode(Image.new("RGB", (3200, 2000), (200, 40, 40))))
+    
+    assert set(variants) == {f"{name}.{extension}" for name in IMAGE_VARIANTS for extension in IMAGE_FORMATS}
+    for name, max_side in IMAGE_VARIANTS.items():
+        for extension, (pil_format, content_type, _) in IMAGE_FORMATS.items():
+            stored_type, image = open_variant(variants, f"{name}.{extension}")
+            assert stored_type == content_type
+            assert image.format == pil_format
+            # Longest side scaled to the variant, aspect ratio kept
+            assert image.size == (max_side, max_side * 5 // 8)
+
+def test_small_images_are_not_upscaled():
+    variants = build_image_variants(encode(Image.new("RGB", (120, 90)), "PNG"))
+    
+    assert {open_variant(variants, f"{name}.jpg")[1].size for name in IMAGE_VARIANTS} == {(120, 90)}
+
+def test_exif_orientation_is_applied_and_exif_dropped():
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Rotated 90° clockwise
+    exif[0x010F] = "Camera maker"
+    original = encode(Image.new("RGB", (400, 200)), exif=exif.tobytes())
+    
+    _, image = open_variant(build_image_variants(original), "full.jpg")
+    
+    assert image.size == (200, 400)
+    assert not image.getexif()
+
+def test_transparency_is_flattened_onto_white():
+    variants = build_image_variants(encode(Image.new("RGBA", (50, 50), (0, 0, 0, 0)), "PNG"))
+    
+    _, image = open_variant(variants, "thumb.jpg")
+    
+    assert image.mode == "RGB"
+    assert all(channel > 250 for channel in image.getpixel((25, 25)))
+
+def test_invalid_image_is_rejected():
+    with pytest.raises(InvalidImageError):
+        build_image_variants(b"not an image")
+
+def test_variant_keys_cover_old_and_new_images():
+    assert variant_keys("book-images/1/old.jpg", None) == ["book-images/1/old.jpg"]
+    assert len(variant_keys(None, "book-images/1/abc")) == len(IMAGE_VARIANTS) * len(IMAGE_FORMATS)
+    assert variant_key(None, "book-images/1/abc", "thumb", "webp") == "book-images/1/abc/thumb.webp"
+    assert variant_key("book-images/1/old.jpg", None, "thumb") == "book-images/1/old.jpg"
@@ -0,0 +1,66 @@
+"""Keyset cursors on GET /api/notes: (created_at, id) pages stay stable and tampered cursors are refused"""
+import base64
+from datetime import datetime, timedelta
+
+import pytest
+
+from database import Note
+from utils import encode_cursor
+
+def add_notes(db, user_id, created_at, count, first=0):
+    for index in range(first, first + count):
+        db.add(Note(user_id=user_id, title=f"Note {index}", subject="Maths", file_path=f"notes/{index}.pdf", created_at=created_at))
+    db.commit()
+
+def page_through(client, limit):
+    titles = []
+    cursor = None
+    while True:
+        params = {"limit": limit, "include_total": False}
+        if cursor:
+            params["cursor"] = cursor
+        page = client.get("/api/notes", params=params).json()
+        titles += [note["title"] for note in page["notes"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            return titles
+
+def test_pages_split_ties_on_created_at_by_id(client, db, make_user):
+    user_id = make_user().id
+    now = datetime.utcnow().replace(microsecond=0)
+    # Two groups of notes that share a timestamp, so pages break inside a tie
+    add_notes(db, user_id, now - timedelta(minutes=1), 4)
+    add_notes(db, user_id, now, 5, first=4)
+    
+    titles = page_through(client, limit=3)
+    
+    assert titles == [f"Note {index}" for index in range(8, -1, -1)]
+
+def test_notes_added_between_pages_do_not_shift_later_pages(client, db, make_user):
+    user_id = make_user().id
+    created_at = datetime.utcnow().replace(microsecond=0) - timedelta(minutes=5)
+    add_notes(db, user_id, created_at, 6)
+    
+    first = client.get("/api/notes", params={"limit": 3}).json()
+    add_notes(db, user_id, datetime.utcnow(), 2, first=6)
+    second = client.get("/api/notes", params={"limit": 3, "cursor": first["next_cursor"]}).json()
+    
+    assert [note["title"] for note in first["notes"]] == ["Note 5", "Note 4", "Note 3"]
+    assert [note["title"] for note in second["notes"]] == ["Note 2", "Note 1", "Note 0"]
+
+@pytest.mark.parametrize("cursor", [
+    "not a cursor!",
+    base64.urlsafe_b64encode(b"{}").decode(),
+    encode_cursor([5]),
+    encode_cursor([datetime(2024, 1, 1), 5, 6]),
+    encode_cursor([5, datetime(2024, 1, 1)]),
+    encode_cursor([datetime(2024, 1, 1), "5"]),
+    encode_cursor([datetime(2024, 1, 1), True]),
+    encode_cursor([None, None]),
+    encode_cursor([{"$dt": "yesterday"}, 5]),
+])
+def test_tampered_cursors_are_rejected(client, cursor):
+    response = client.get("/api/notes", params={"cursor": cursor})
+    
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor"
@@ -0,0 +1,117 @@
+"""The notification event stream registers with the hub only while it is actually being sent"""
+import asyncio
+import time
+from contextlib import ExitStack
+
+import httpx
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import routes
+from auth import Principal
+from database import SessionLocal
+from notifications import notification_hub, create_notification, unread_count
+from conftest import auth_headers
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+def open_stream(user_id):
+    async def call():
+        request = Request({"type": "http", "method": "GET", "path": "/api/notifications/stream", "headers": []})
+        principal = Principal(id=user_id, role=0, is_blocked=False, name="User")
+        return await routes.stream_notifications(request, principal)
+    return asyncio.run(call())
+
+def test_response_that_is_never_sent_holds_no_subscription(make_user):
+    user = make_user()
+    
+    responses = [open_stream(user.id) for _ in range(notification_hub.max_streams_per_user + 1)]
+    
+    assert len(responses) == notification_hub.max_streams_per_user + 1
+    assert notification_hub.connected_streams() == 0
+
+def test_stream_subscribes_while_open_and_unsubscribes_on_disconnect(make_user, live_server):
+    user = make_user()
+    
+    with httpx.Client(base_url=live_server, headers=auth_headers(user.id), timeout=10) as http:
+        with http.stream("GET", "/api/notifications/stream") as response:
+            assert response.status_code == 200
+            lines = response.iter_lines()
+            assert next(lines) == "retry: 5000"
+            wait_for(lambda: notification_hub.connected_streams() == 1)
+        
+        wait_for(lambda: notification_hub.connected_streams() == 0)
+
+def test_too_many_open_streams_is_rejected_before_streaming(make_user, live_server):
+    user = make_user()
+    
+    with httpx.Client(base_url=live_server, headers=auth_headers(user.id), timeout=10) as http, ExitStack() as streams:
+        open_lines = []
+        for _ in range(notification_hub.max_streams_per_user):
+            response = streams.enter_context(http.stream("GET", "/api/notifications/stream"))
+            assert response.status_code == 200
+            open_lines.append(response.iter_lines())
+            next(open_lines[-1])
+        wait_for(lambda: notification_hub.connected_streams() == notification_hub.max_streams_per_user)
+        
+        assert http.get("/api/notifications/stream").status_code == 429
+    
+    wait_for(lambda: notification_hub.connected_streams() == 0)
+
+def test_hub_limit_is_enforced_by_the_generator_too(make_user):
+    user = make_user()
+    response = open_stream(user.id)
+    queues = [notification_hub.subscribe(user.id) for _ in range(notification_hub.max_streams_per_user)]
+    
+    async def first_event():
+        body = response.body_iterator
+        try:
+            return await body.__anext__()
+        finally:
+            await body.aclose()
+    
+    try:
+        assert asyncio.run(first_event()).startswith("event: error")
+        with pytest.raises(HTTPException) as rejected:
+            open_stream(user.id)
+        assert rejected.value.status_code == 429
+    finally:
+        for queue in queues:
+            notification_hub.unsubscribe(user.id, queue)
+
+def test_notification_committed_while_the_stream_opens_is_delivered(make_user, monkeypatch):
+    user = make_user()
+    
+    def count_after_a_notification_lands(db, user_id):
+        # Committed between the subscription and the snapshot
+        other = SessionLocal()
+        create_notification(other, user_id, "Raced", "Sent while the stream was opening")
+        other.commit()
+        other.close()
+        return unread_count(db, user_id)
+    monkeypatch.setattr(routes, "unread_count", count_after_a_notification_lands)
+    
+    async def first_events():
+        await notification_hub.start()
+        await asyncio.sleep(0)
+        async def receive():
+            await asyncio.Event().wait()
+        request = Request({"type": "http", "method": "GET", "path": "/api/notifications/stream", "headers": []}, receive)
+        principal = Principal(id=user.id, role=0, is_blocked=False, name="User")
+        response = await routes.stream_notifications(request, principal)
+        body = response.body_iterator
+        try:
+            return [await asyncio.wait_for(body.__anext__(), timeout=5) for _ in range(3)]
+        finally:
+            await body.aclose()
+            await notification_hub.stop()
+    
+    retry, snapshot, pushed = asyncio.run(first_events())
+    
+    assert snapshot.startswith("event: unread_count") and '"unread_count": 1' in snapshot
+    assert pushed.startswith("event: notification") and '"Raced"' in pushed
@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+from PyPDF2 import PdfReader
+
+from conftest import make_pdf
+from pdf_processing import PdfProcessor
+
+@pytest.fixture
+def processor():
+    processor = PdfProcessor()
+    yield processor
+    processor.shutdown()
+
+@pytest.fixture
+def spooled(tmp_path):
+    def spool(pages: int) -> str:
+        path = tmp_path / f"upload-{pages}.pdf"
+        path.write_bytes(make_pdf(pages))
+        return str(path)
+    return spool
+
+def run(processor, source, output, user_id=7):
+    return asyncio.run(processor.process(source, output, user_id))
+
+def test_process_validates_and_watermarks(processor, spooled, tmp_path):
+    output = tmp_path / "out.pdf"
+    
+    result = run(processor, spooled(3), str(output))
+    
+    assert result["page_count"] == 3
+    assert result["watermarked_size"] == output.stat().st_size
+    assert "User ID: 7" in PdfReader(str(output)).pages[0].extract_text()
+    assert processor.metrics()["completed"] == 1
+    assert processor.metrics()["in_flight"] == 0
+
+def test_invalid_pdf_is_rejected(processor, tmp_path):
+    source = tmp_path / "fake.pdf"
+    source.write_bytes(b"%PDF-1.4 not really")
+    
+    with pytest.raises(HTTPException) as error:
+        run(processor, str(source), str(tmp_path / "out.pdf"))
+    
+    assert error.value.status_code == 400
+    assert processor.metrics()["in_flight"] == 0
+
+def test_full_queue_is_rejected(processor, spooled, tmp_path):
+    processor.max_in_flight = 0
+    
+    with pytest.raises(HTTPException) as error:
+        run(processor, spooled(1), str(tmp_path / "out.pdf"))
+    
+    assert error.value.status_code == 503
+    assert error.value.headers["Retry-After"] == "5"
+    assert processor.metrics()["rejected"] == 1
+
+def test_timeout_terminates_stuck_worker_and_frees_slot(processor, spooled, tmp_path):
+    run(processor, spooled(1), str(tmp_path / "warm.pdf"))
+    stuck_pool = processor._executor
+    workers = list(stuck_pool._processes.values())
+    processor.timeout = 0.05
+    
+    started = time.monotonic()
+    with pytest.raises(HTTPException) as error:
+        run(processor, spooled(500), str(tmp_path / "slow.pdf"))
+    
+    assert error.value.status_code == 503
+    assert time.monotonic() - started < 1
+    assert processor.metrics()["in_flight"] == 0
+    assert processor.metrics()["timed_out"] == 1
+    assert processor._executor is None
+    for worker in workers:
+        worker.join(timeout=5)
+        assert not worker.is_alive()
+    
+    processor.timeout = 60
+    assert run(processor, spooled(2), str(tmp_path / "after.pdf"))["page_count"] == 2
+    assert processor._executor is not stuck_pool
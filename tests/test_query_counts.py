@@ -0,0 +1,78 @@
+"""Statements issued per list endpoint must not grow with the page size"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import auth_headers
+from database import Note, Book, BookBuyRequest, BookCondition, BookStatus
+from utils import encode_geohash
+
+LATITUDE, LONGITUDE = 28.6139, 77.2090
+
+@pytest.fixture
+def catalog(db, make_user):
+    """Two users; the owner has 25 notes and 25 books, each with a buy request from the buyer"""
+    owner = make_user()
+    buyer = make_user()
+    now = datetime.utcnow()
+    for index in range(25):
+        created_at = now - timedelta(minutes=index)
+        db.add(Note(
+            user_id=owner.id, title=f"Note {index}", subject="Physics", file_path=f"notes/{index}.pdf",
+            trending_score=float(index), created_at=created_at
+        ))
+        latitude = LATITUDE + index * 0.001
+        book = Book(
+            user_id=owner.id, title=f"Book {index}", condition=BookCondition.GOOD, price=100.0,
+            latitude=latitude, longitude=LONGITUDE, geohash=encode_geohash(latitude, LONGITUDE),
+            status=BookStatus.AVAILABLE, expires_at=now + timedelta(days=30), created_at=created_at
+        )
+        db.add(book)
+        db.flush()
+        db.add(BookBuyRequest(
+            book_id=book.id, buyer_id=buyer.id, full_name="Buyer", mobile_number="9999999999",
+            latitude=LATITUDE, longitude=LONGITUDE
+        ))
+    db.commit()
+    return {"owner": owner.id, "buyer": buyer.id, "book": book.id}
+
+def count_statements(client, query_log, url, headers=None):
+    # The first call warms the token, principal and count caches
+    assert client.get(url, headers=headers).status_code == 200
+    query_log.clear()
+    response = client.get(url, headers=headers)
+    assert response.status_code == 200
+    return len(query_log), response.json()
+
+@pytest.mark.parametrize("url, expected", [
+    ("/api/books?limit={limit}", 1),
+    (f"/api/books?limit={{limit}}&latitude={LATITUDE}&longitude={LONGITUDE}&radius=50", 2),
+    ("/api/notes?limit={limit}", 1),
+    ("/api/notes?limit={limit}&sort=trending", 1),
+    ("/api/notes?limit={limit}&search=No", 1),
+])
+def test_public_lists_use_fixed_statement_count(client, query_log, catalog, url, expected):
+    small, small_page = count_statements(client, query_log, url.format(limit=5))
+    large, large_page = count_statements(client, query_log, url.format(limit=20))
+    
+    assert len(next(iter(small_page.values()))) == 5
+    assert len(next(iter(large_page.values()))) == 20
+    assert small == large == expected
+
+@pytest.mark.parametrize("path, expected", [
+    ("/api/user/my-books", 2),
+    ("/api/user/my-notes", 1),
+])
+def test_owner_lists_use_fixed_statement_count(client, query_log, catalog, path, expected):
+    statements, body = count_statements(client, query_log, path, auth_headers(catalog["owner"]))
+    
+    assert len(next(iter(body.values()))) == 25
+    assert statements == expected
+
+def test_book_requests_use_fixed_statement_count(client, query_log, catalog):
+    url = f"/api/books/{catalog['book']}/requests"
+    statements, body = count_statements(client, query_log, url, auth_headers(catalog["owner"]))
+    
+    assert len(body["requests"]) == 1
+    assert body["requests"][0]["buyer"]["id"] == catalog["buyer"]
+    assert statements == 2
@@ -0,0 +1,89 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+from ai_service import ai_service
+from conftest import auth_headers
+from database import User, UserRole
+from mock_upstream import MockUpstream
+from quota_service import quota_service
+
+PARALLEL_REQUESTS = 32
+
+def add_user(**fields) -> int:
+    db = database.SessionLocal()
+    user = User(email="student@example.com", name="Student", google_id="student", role=UserRole.NORMAL, **fields)
+    db.add(user)
+    db.commit()
+    user_id = user.id
+    db.close()
+    return user_id
+
+def reserve_in_parallel(user_id: int, kind: str) -> list:
+    start = threading.Barrier(PARALLEL_REQUESTS)
+    
+    def reserve(_):
+        db = database.SessionLocal()
+        try:
+            start.wait()
+            return quota_service.reserve(db, user_id, UserRole.NORMAL, kind)
+        finally:
+            db.close()
+    
+    with ThreadPoolExecutor(max_workers=PARALLEL_REQUESTS) as pool:
+        return list(pool.map(reserve, range(PARALLEL_REQUESTS)))
+
+def used_today(user_id: int) -> int:
+    db = database.SessionLocal()
+    try:
+        return db.query(User.ai_messages_today).filter(User.id == user_id).scalar()
+    finally:
+        db.close()
+
+@pytest.mark.parametrize("limit", [1, 3])
+def test_parallel_reservations_never_exceed_the_limit(file_database, monkeypatch, limit):
+    monkeypatch.setattr("quota_service.settings.AI_DAILY_LIMIT_NORMAL", limit)
+    user_id = add_user()
+    
+    results = reserve_in_parallel(user_id, "ai_messages")
+    
+    granted = [left for left in results if left is not None]
+    assert sorted(granted) == list(range(limit))
+    assert results.count(None) == PARALLEL_REQUESTS - limit
+    assert used_today(user_id) == limit
+
+def test_counter_left_from_yesterday_is_reset_once(file_database, monkeypatch):
+    monkeypatch.setattr("quota_service.settings.AI_DAILY_LIMIT_NORMAL", 1)
+    user_id = add_user(ai_messages_today=1, ai_messages_reset_date=datetime.utcnow() - timedelta(days=1))
+    
+    results = reserve_in_parallel(user_id, "ai_messages")
+    
+    assert results.count(0) == 1
+    assert results.count(None) == PARALLEL_REQUESTS - 1
+    assert used_today(user_id) == 1
+
+def test_refund_gives_the_unit_back(file_database, monkeypatch):
+    monkeypatch.setattr("quota_service.settings.AI_DAILY_LIMIT_NORMAL", 1)
+    user_id = add_user()
+    db = database.SessionLocal()
+    
+    assert quota_service.reserve(db, user_id, UserRole.NORMAL, "ai_messages") == 0
+    assert quota_service.reserve(db, user_id, UserRole.NORMAL, "ai_messages") is None
+    quota_service.refund(db, user_id, "ai_messages")
+    
+    assert quota_service.reserve(db, user_id, UserRole.NORMAL, "ai_messages") == 0
+    db.close()
+
+def test_ai_chat_runs_no_queries_on_the_event_loop(client, make_user, monkeypatch, event_loop_queries, rollup_deltas):
+    upstream = MockUpstream()
+    monkeypatch.setattr(ai_service, "_client", upstream.client())
+    user = make_user(role=UserRole.PREMIUM)
+    
+    response = client.post("/api/ai/chat", data={"message": "What is a quota?"}, headers=auth_headers(user.id))
+    
+    assert response.status_code == 200, response.text
+    assert response.json()["messages_remaining"] == quota_service.limit_for("ai_messages", UserRole.PREMIUM) - 1
+    assert event_loop_queries == []
@@ -0,0 +1,74 @@
+import fakeredis
+import pytest
+import redis
+
+from utils import InMemoryRateLimitBackend, RedisRateLimitBackend, RateLimiter
+
+WINDOW = 60
+
+@pytest.fixture
+def redis_server():
+    return fakeredis.FakeServer()
+
+@pytest.fixture(params=["memory", "redis"])
+def backend(request, redis_server):
+    if request.param == "memory":
+        return InMemoryRateLimitBackend()
+    return RedisRateLimitBackend(fakeredis.FakeRedis(server=redis_server))
+
+def hits(backend, count, now, key="client", limit=3):
+    return [backend.hit(key, limit, WINDOW, now) for _ in range(count)]
+
+def test_limit_applies_within_a_window(backend):
+    start = 10 * WINDOW
+    
+    assert hits(backend, 4, start) == [True, True, True, False]
+    assert hits(backend, 1, start, key="other client") == [True]
+
+def test_previous_window_counts_in_proportion_to_its_overlap(backend):
+    start = 10 * WINDOW
+    hits(backend, 3, start)
+    
+    # A third into the next window, two thirds of the previous 3 requests still count
+    assert hits(backend, 2, start + WINDOW + WINDOW / 3) == [True, False]
+    # Two windows later the old requests no longer count
+    assert hits(backend, 3, start + 3 * WINDOW) == [True, True, True]
+
+def test_redis_keys_expire_after_two_windows(redis_server):
+    client = fakeredis.FakeRedis(server=redis_server)
+    RedisRateLimitBackend(client).hit("client", 3, WINDOW, 10 * WINDOW)
+    
+    (key,) = client.keys("ratelimit:client:*")
+    assert 0 < client.ttl(key) <= 2 * WINDOW
+
+def test_idle_keys_are_evicted_from_memory():
+    backend = InMemoryRateLimitBackend(max_keys=2)
+    for number in range(3):
+        backend.hit(f"client {number}", 3, WINDOW, 10 * WINDOW)
+    
+    assert list(backend.windows) == ["client 1", "client 2"]
+    backend.hit("client 1", 3, WINDOW, 13 * WINDOW)
+    assert list(backend.windows) == ["client 1"]
+
+def test_redis_outage_falls_back_to_local_limits_and_logs_once(redis_server, capsys):
+    limiter = RateLimiter(
+        backend=RedisRateLimitBackend(fakeredis.FakeRedis(server=redis_server)),
+        fallback=InMemoryRateLimitBackend()
+    )
+    redis_server.connected = False
+    
+    assert [limiter.check_rate_limit("client", 3, WINDOW) for _ in range(5)] == [True, True, True, False, False]
+    assert capsys.readouterr().out.count("Rate limit backend error") == 1
+    
+    redis_server.connected = True
+    assert limiter.check_rate_limit("client", 3, WINDOW)
+    assert capsys.readouterr().out.count("Rate limit backend recovered") == 1
+    assert limiter.check_rate_limit("client", 3, WINDOW)
+    assert capsys.readouterr().out == ""
+
+def test_backend_errors_propagate_without_a_fallback(redis_server):
+    limiter = RateLimiter(backend=RedisRateLimitBackend(fakeredis.FakeRedis(server=redis_server)))
+    redis_server.connected = False
+    
+    with pytest.raises(redis.exceptions.ConnectionError):
+        limiter.check_rate_limit("client", 3, WINDOW)
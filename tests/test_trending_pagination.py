@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+from database import Note
+
+def seed_notes(db, user_id, count=10):
+    now = datetime.utcnow()
+    for index in range(count):
+        db.add(Note(
+            user_id=user_id, title=f"Note {index}", subject="Maths", file_path=f"notes/{index}.pdf",
+            trending_score=float(index + 1), trending_updated_at=now - timedelta(hours=index)
+        ))
+    db.commit()
+
+def test_trending_pages_survive_score_rewrite(client, db, make_user):
+    seed_notes(db, make_user().id)
+    
+    first = client.get("/api/notes?sort=trending&limit=4").json()
+    # The re-decay job shrinks every score between the two page loads
+    db.execute(update(Note).values(trending_score=Note.trending_score * 0.25))
+    db.commit()
+    second = client.get(f"/api/notes?sort=trending&limit=4&cursor={first['next_cursor']}").json()
+    third = client.get(f"/api/notes?sort=trending&limit=4&cursor={second['next_cursor']}").json()
+    
+    titles = [note["title"] for page in (first, second, third) for note in page["notes"]]
+    assert titles == [f"Note {index}" for index in range(9, -1, -1)]
+    assert third["next_cursor"] is None
+
+def test_trending_cursor_is_offset_not_score(client, db, make_user):
+    seed_notes(db, make_user().id, count=3)
+    
+    page = client.get("/api/notes?sort=trending&limit=2").json()
+    
+    assert [note["title"] for note in page["notes"]] == ["Note 2", "Note 1"]
+    assert client.get(f"/api/notes?sort=trending&limit=2&cursor={page['next_cursor']}").json()["notes"][0]["title"] == "Note 0"
@@ -0,0 +1,286 @@
+import asyncio
+import glob
+import hashlib
+import os
+import tempfile
+import tracemalloc
+from io import BytesIO
+
+import boto3
+import pytest
+from moto import mock_aws
+from PIL import Image
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+import main
+from analytics_rollups import DailyStatsRollup
+from conftest import auth_headers, make_pdf
+from database import Book, BookImage, Note, StorageDeletion
+from image_processing import variant_keys
+from storage import storage
+from utils import MB
+
+BOUNDARY = "noteshub-test-boundary"
+
+@pytest.fixture
+def s3(monkeypatch):
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=storage.bucket)
+        monkeypatch.setattr(storage, "s3_client", client)
+        yield client
+
+@pytest.fixture(scope="module")
+def large_pdf(tmp_path_factory) -> str:
+    """About 12MB of PDF: one page holding an incompressible image"""
+    path = tmp_path_factory.mktemp("pdf") / "large.pdf"
+    image = Image.frombytes("RGB", (2000, 2000), os.urandom(2000 * 2000 * 3))
+    pdf = canvas.Canvas(str(path))
+    pdf.drawImage(ImageReader(image), 0, 0, 595, 842)
+    pdf.showPage()
+    pdf.save()
+    return str(path)
+
+def form_parts(fields: dict, filename: str, source, content_type="application/pdf", chunk_size=64 * 1024):
+    """multipart/form-data body in chunks, reading the file part from `source` as it goes"""
+    for name, value in fields.items():
+        yield f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+    yield (
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode()
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+    yield f"\r\n--{BOUNDARY}--\r\n".encode()
+
+def post_streamed(path: str, headers: dict, chunks) -> tuple:
+    """Send a chunked body straight to the ASGI app; returns (status, detail, body bytes the app read)"""
+    received = 0
+    chunks = iter(chunks)
+    response = {}
+    
+    async def receive():
+        nonlocal received
+        chunk = next(chunks, None)
+        if chunk is None:
+            return {"type": "http.request", "body": b"", "more_body": False}
+        received += len(chunk)
+        return {"type": "http.request", "body": chunk, "more_body": True}
+    
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            response["body"] = response.get("body", b"") + message.get("body", b"")
+    
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+        "client": ("127.0.0.1", 50000), "server": ("testserver", 80),
+        "headers": [
+            (b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode()),
+            (b"transfer-encoding", b"chunked"),
+            *((name.lower().encode(), value.encode()) for name, value in headers.items())
+        ]
+    }
+    asyncio.run(main.app(scope, receive, send))
+    return response["status"], response["body"], received
+
+def test_upload_note_spools_hashes_and_stores(client, make_user, s3, rollup_deltas):
+    user = make_user()
+    pdf = make_pdf(3)
+    
+    response = client.post(
+        "/api/notes/upload",
+        data={"title": "Thermodynamics", "subject": "Physics", "description": "Week 3"},
+        files={"file": ("thermo.pdf", pdf, "application/pdf")},
+        headers=auth_headers(user.id)
+    )
+    
+    assert response.status_code == 200, response.text
+    db = main.SessionLocal()
+    note = db.query(Note).filter(Note.id == response.json()["note_id"]).one()
+    db.close()
+    assert (note.title, note.subject, note.description) == ("Thermodynamics", "Physics", "Week 3")
+    assert note.file_size == len(pdf)
+    assert note.file_hash == hashlib.sha256(pdf).hexdigest()
+    stored = s3.get_object(Bucket=storage.bucket, Key=note.file_path)["Body"].read()
+    assert stored.startswith(b"%PDF") and stored != pdf
+    assert rollup_deltas == [{"notes_uploaded": 1}]
+
+def test_large_upload_goes_to_s3_in_parts(client, make_user, s3, large_pdf, rollup_deltas):
+    with open(large_pdf, "rb") as f:
+        response = client.post(
+            "/api/notes/upload",
+            data={"title": "Scans", "subject": "Biology"},
+            files={"file": ("scans.pdf", f, "application/pdf")},
+            headers=auth_headers(make_user().id)
+        )
+    
+    assert response.status_code == 200, response.text
+    key = s3.list_objects_v2(Bucket=storage.bucket)["Contents"][0]["Key"]
+    head = s3.head_object(Bucket=storage.bucket, Key=key)
+    assert head["ContentLength"] > os.path.getsize(large_pdf) * 0.9
+    # Multipart uploads get an ETag of the form "<md5 of part md5s>-<part count>"
+    assert head["ETag"].strip('"').endswith("-2")
+
+def test_missing_fields_and_wrong_type_are_rejected(client, make_user):
+    headers = auth_headers(make_user().id)
+    pdf = make_pdf(1)
+    
+    missing_subject = client.post(
+        "/api/notes/upload", data={"title": "x"}, files={"file": ("a.pdf", pdf, "application/pdf")}, headers=headers
+    )
+    wrong_type = client.post(
+        "/api/notes/upload", data={"title": "x", "subject": "y"}, files={"file": ("a.png", pdf, "image/png")}, headers=headers
+    )
+    
+    assert missing_subject.status_code == 400
+    assert wrong_type.status_code == 400
+    assert wrong_type.json()["detail"] == "Only PDF files allowed"
+
+def test_oversize_chunked_upload_stops_at_the_limit(make_user, monkeypatch):
+    monkeypatch.setattr(main.settings, "MAX_PDF_SIZE_MB", 2)
+    spooled_before = set(glob.glob(os.path.join(tempfile.gettempdir(), "noteshub-*")))
+    
+    status, body, received = post_streamed(
+        "/api/notes/upload", auth_headers(make_user().id),
+        form_parts({"title": "Big", "subject": "Physics"}, "big.pdf", BytesIO(b"x" * 50 * MB))
+    )
+    
+    assert status == 400
+    assert b"File too large" in body
+    assert received < 3 * MB
+    assert set(glob.glob(os.path.join(tempfile.gettempdir(), "noteshub-*"))) == spooled_before
+
+def test_oversize_chunked_book_upload_is_cut_off_by_the_middleware(make_user):
+    limit = 5 * main.settings.MAX_IMAGE_SIZE_MB * MB
+    
+    status, body, received = post_streamed(
+        "/api/books/upload", auth_headers(make_user().id),
+        form_parts({"title": "Atlas"}, "cover.jpg", BytesIO(b"x" * (limit + 10 * MB)), "image/jpeg")
+    )
+    
+    assert status == 413
+    assert received < limit + 2 * MB
+
+@pytest.mark.benchmark
+def test_upload_memory_stays_flat(make_user, large_pdf, monkeypatch, rollup_deltas):
+    stored = {}
+    
+    def upload_note_file(path, filename, user_id):
+        # Stands in for S3, which would otherwise keep the object in this process's memory
+        stored["size"] = os.path.getsize(path)
+        return f"notes-pdf/{user_id}/{filename}"
+    monkeypatch.setattr(storage, "upload_note_file", upload_note_file)
+    headers = auth_headers(make_user().id)
+    
+    tracemalloc.start()
+    try:
+        with open(large_pdf, "rb") as f:
+            status, body, received = post_streamed(
+                "/api/notes/upload", headers, form_parts({"title": "Scans", "subject": "Biology"}, "scans.pdf", f)
+            )
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    
+    print(f"{received / MB:.1f}MB upload, peak traced memory {peak / MB:.2f}MB")
+    assert status == 200, body
+    assert stored["size"] > 0
+    assert peak < 2 * MB
+
+def test_upload_note_runs_no_queries_on_the_event_loop(client, make_user, s3, event_loop_queries, rollup_deltas):
+    response = client.post(
+        "/api/notes/upload",
+        data={"title": "Kinetics", "subject": "Chemistry"},
+        files={"file": ("kinetics.pdf", make_pdf(2), "application/pdf")},
+        headers=auth_headers(make_user().id)
+    )
+    
+    assert response.status_code == 200, response.text
+    assert event_loop_queries == []
+
+def jpeg(size=(640, 480)) -> bytes:
+    buffer = BytesIO()
+    Image.new("RGB", size, (30, 90, 160)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+def post_book(client, user_id, images=2):
+    return client.post(
+        "/api/books/upload",
+        data={"title": "Atlas", "condition": "good", "price": "250", "latitude": "28.6139", "longitude": "77.2090"},
+        files=[("images", (f"cover{index}.jpg", jpeg(), "image/jpeg")) for index in range(images)],
+        headers=auth_headers(user_id)
+    )
+
+def stored_keys(s3) -> list:
+    return sorted(item["Key"] for item in s3.list_objects_v2(Bucket=storage.bucket).get("Contents", []))
+
+def saved_rows(model) -> list:
+    db = main.SessionLocal()
+    try:
+        return db.query(model).all()
+    finally:
+        db.close()
+
+def fail_first_upload_of(monkeypatch, variant):
+    upload = type(storage).upload_book_image_variant
+    failed = []
+    
+    def flaky(self, file_key, file_content, content_type):
+        if file_key.endswith(f"/{variant}") and not failed:
+            failed.append(file_key)
+            raise ConnectionError("upload reset")
+        return upload(self, file_key, file_content, content_type)
+    monkeypatch.setattr(type(storage), "upload_book_image_variant", flaky)
+    return failed
+
+def test_upload_book_stores_every_variant_of_every_image(client, make_user, s3, rollup_deltas):
+    response = post_book(client, make_user().id)
+    
+    assert response.status_code == 200, response.text
+    assert response.json()["images_uploaded"] == 2
+    images = saved_rows(BookImage)
+    assert stored_keys(s3) == sorted(key for image in images for key in variant_keys(image.image_path, image.variant_prefix))
+    assert rollup_deltas == [{"books_listed": 1}]
+
+def test_failed_variant_upload_drops_that_image_and_its_other_variants(client, make_user, s3, monkeypatch, rollup_deltas):
+    failed = fail_first_upload_of(monkeypatch, "medium.webp")
+    
+    response = post_book(client, make_user().id)
+    
+    assert response.status_code == 200, response.text
+    assert response.json()["images_uploaded"] == 1
+    (image,) = saved_rows(BookImage)
+    assert not failed[0].startswith(image.variant_prefix)
+    assert stored_keys(s3) == sorted(variant_keys(image.image_path, image.variant_prefix))
+    assert saved_rows(StorageDeletion) == []
+
+def test_variants_that_cannot_be_cleaned_up_go_to_the_outbox(client, make_user, s3, monkeypatch, rollup_deltas):
+    failed = fail_first_upload_of(monkeypatch, "full.jpg")
+    monkeypatch.setattr(type(storage), "delete_files", lambda self, file_keys: {key: "access denied" for key in file_keys})
+    
+    response = post_book(client, make_user().id, images=1)
+    
+    assert response.status_code == 200, response.text
+    prefix = failed[0].rsplit("/", 1)[0]
+    queued = sorted(row.file_key for row in saved_rows(StorageDeletion))
+    assert queued == stored_keys(s3) and queued
+    assert all(key.startswith(prefix) for key in queued)
+
+def test_book_that_fails_to_save_leaves_no_images_behind(client, make_user, s3, monkeypatch):
+    def broken(self, db, **deltas):
+        raise RuntimeError("database unavailable")
+    monkeypatch.setattr(DailyStatsRollup, "record", broken)
+    
+    with pytest.raises(RuntimeError):
+        post_book(client, make_user().id)
+    
+    assert stored_keys(s3) == []
+    assert saved_rows(Book) == []
+    assert saved_rows(StorageDeletion) == []
@@ -0,0 +1,97 @@
+import time
+from io import BytesIO
+
+import pytest
+from PyPDF2 import PdfReader, PdfWriter
+from reportlab.lib.pagesizes import A4, letter
+from reportlab.pdfgen import canvas
+
+import pdf_processing
+from conftest import make_pdf
+from pdf_processing import add_watermark, get_watermark_overlay
+
+def watermark_per_page(pdf_bytes: bytes, user_id: int) -> bytes:
+    """The watermarking this engine replaced: one overlay rendered and parsed per page, always letter size"""
+    pdf_reader = PdfReader(BytesIO(pdf_bytes))
+    pdf_writer = PdfWriter()
+    for page in pdf_reader.pages:
+        packet = BytesIO()
+        can = canvas.Canvas(packet, pagesize=letter)
+        can.setFont("Helvetica", 8)
+        can.setFillColorRGB(0.7, 0.7, 0.7, alpha=0.3)
+        can.drawString(50, 30, f"NotesHub - User ID: {user_id}")
+        can.save()
+        packet.seek(0)
+        page.merge_page(PdfReader(packet).pages[0])
+        pdf_writer.add_page(page)
+    output = BytesIO()
+    pdf_writer.write(output)
+    return output.getvalue()
+
+@pytest.fixture(autouse=True)
+def empty_overlay_cache():
+    pdf_processing._overlay_cache.clear()
+    yield
+    pdf_processing._overlay_cache.clear()
+
+def test_pages_of_one_size_share_a_rendered_overlay(monkeypatch):
+    renders = []
+    render = pdf_processing._render_overlay
+    monkeypatch.setattr(pdf_processing, "_render_overlay", lambda *key: renders.append(key) or render(*key))
+    
+    watermarked = add_watermark(make_pdf(20), 3)
+    
+    assert len(renders) == 1
+    pages = PdfReader(BytesIO(watermarked)).pages
+    assert len(pages) == 20
+    assert all("User ID: 3" in page.extract_text() for page in pages)
+
+def test_overlay_matches_page_size_and_rotation():
+    writer = PdfWriter()
+    for page in PdfReader(BytesIO(make_pdf(1, A4))).pages:
+        writer.add_page(page)
+    for page in PdfReader(BytesIO(make_pdf(1))).pages:
+        page.rotate(90)
+        writer.add_page(page)
+    source = BytesIO()
+    writer.write(source)
+    
+    add_watermark(source.getvalue(), 3)
+    
+    assert set(pdf_processing._overlay_cache) == {
+        (round(A4[0], 2), round(A4[1], 2), 0, "NotesHub - User ID: 3"),
+        (612.0, 792.0, 90, "NotesHub - User ID: 3")
+    }
+
+def test_overlay_cache_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(pdf_processing, "WATERMARK_CACHE_SIZE", 2)
+    first = get_watermark_overlay(612, 792, 0, "a")
+    get_watermark_overlay(612, 792, 0, "b")
+    assert get_watermark_overlay(612, 792, 0, "a") is first
+    
+    get_watermark_overlay(612, 792, 0, "c")
+    
+    assert [key[3] for key in pdf_processing._overlay_cache] == ["a", "c"]
+
+def test_unreadable_pdf_is_passed_through():
+    assert add_watermark(b"not a pdf", 3) == b"not a pdf"
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("pages", [10, 100, 500])
+def test_benchmark_watermark_throughput(pages):
+    source = make_pdf(pages)
+    timings = {}
+    for name, watermark in (("per-page overlay", watermark_per_page), ("cached overlay", add_watermark)):
+        watermark(make_pdf(1), 3)  # warm up fonts and imports
+        best = float("inf")
+        for _ in range(max(3, 100 // pages)):
+            pdf_processing._overlay_cache.clear()
+            started = time.perf_counter()
+            output = watermark(source, 3)
+            best = min(best, time.perf_counter() - started)
+        timings[name] = best
+        assert len(PdfReader(BytesIO(output)).pages) == pages
+    
+    for name, seconds in timings.items():
+        print(f"{pages} pages, {name}: {pages / seconds:,.0f} pages/s")
+    assert timings["cached overlay"] < timings["per-page overlay"]
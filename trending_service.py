@@ -0,0 +1,74 @@
+from datetime import datetime
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+from database import Note, SessionLocal
+from config import get_settings
+
+settings = get_settings()
+
+# Engagement weights, matching the original downloads + likes*2 + shares*3 ranking
+DOWNLOAD_WEIGHT = 1.0
+LIKE_WEIGHT = 2.0
+SHARE_WEIGHT = 3.0
+
+REDECAY_BATCH_SIZE = 5000
+
+class TrendingService:
+    """Time-decayed trending score kept on Note.trending_score.
+    
+    The score halves every TRENDING_HALF_LIFE_HOURS. Engagement first decays the
+    stored score to now and then adds its weight, and a periodic job
+    re-decays every note so idle notes sink even without new events.
+    """
+    
+    def __init__(self):
+        self.half_life_seconds = settings.TRENDING_HALF_LIFE_HOURS * 3600
+    
+    def _decayed_score(self, now: datetime):
+        age_seconds = func.timestampdiff(text("SECOND"), Note.trending_updated_at, now)
+        return Note.trending_score * func.pow(0.5, age_seconds / self.half_life_seconds)
+    
+    def score_after_engagement(self, now: datetime, weight):
+        """SQL expression for a note's score decayed to `now` plus an engagement weight"""
+        return func.greatest(self._decayed_score(now) + weight, 0)
+    
+    def redecay_all(self, db: Session) -> int:
+        """Decay every positive score to the current time, in id-ordered batches"""
+        now = datetime.utcnow()
+        last_id = 0
+        updated = 0
+        while True:
+            batch_end = db.query(Note.id).filter(Note.id > last_id).order_by(Note.id).offset(
+                REDECAY_BATCH_SIZE - 1
+            ).limit(1).scalar()
+            if batch_end is None:
+                batch_end = db.query(func.max(Note.id)).filter(Note.id > last_id).scalar()
+                if batch_end is None:
+                    break
+            
+            updated += db.query(Note).filter(
+                Note.id > last_id,
+                Note.id <= batch_end,
+                Note.trending_score > 0
+            ).update(
+                {
+                    Note.trending_score: self._decayed_score(now),
+                    Note.trending_updated_at: now,
+                    # Decay is bookkeeping, not an edit; keep updated_at as is
+                    Note.updated_at: Note.updated_at
+                },
+                synchronize_session=False
+            )
+            db.commit()
+            last_id = batch_end
+        return updated
+    
+    def run_redecay_job(self):
+        db = SessionLocal()
+        try:
+            updated = self.redecay_all(db)
+            print(f"📉 Re-decayed trending score for {updated} notes")
+        finally:
+            db.close()
+
+trending_service = TrendingService()
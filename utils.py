@@ -1,45 +1,576 @@
 from geopy.distance import geodesic
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from multipart.multipart import MultipartParser, parse_options_header
+from sqlalchemy import and_, or_
+from config import get_settings
 from datetime import datetime, timedelta
-from typing import Tuple
-from collections import defaultdict
+from typing import Tuple, List, Sequence, Callable, Optional
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+import threading
+import asyncio
+import base64
+import json
+import math
+import re
 import time
 
+class InMemoryRateLimitBackend:
+    """Per-process sliding-window counter with O(1) state per key and idle-key expiry"""
+    
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        # key -> [window_index, current_count, previous_count, window_seconds]
+        self.windows = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _evict_idle(self, now: float):
+        # Least recently used keys sit at the front; stop at the first one still live
+        while self.windows:
+            key, (window_index, _, _, window_seconds) = next(iter(self.windows.items()))
+            if (window_index + 2) * window_seconds > now and len(self.windows) <= self.max_keys:
+                break
+            self.windows.popitem(last=False)
+    
+    def hit(self, key: str, max_requests: int, window_seconds: int, now: float) -> bool:
+        window_index = int(now // window_seconds)
+        with self._lock:
+            entry = self.windows.get(key)
+            if entry is None or entry[3] != window_seconds or entry[0] < window_index - 1:
+                entry = [window_index, 0, 0, window_seconds]
+            elif entry[0] == window_index - 1:
+                entry = [window_index, 0, entry[1], window_seconds]
+            
+            elapsed = (now - window_index * window_seconds) / window_seconds
+            estimate = entry[2] * (1 - elapsed) + entry[1]
+            allowed = estimate < max_requests
+            if allowed:
+                entry[1] += 1
+            
+            self.windows[key] = entry
+            self.windows.move_to_end(key)
+            self._evict_idle(now)
+            return allowed
+
+class RedisRateLimitBackend:
+    """Sliding-window counter shared by all workers through Redis"""
+    
+    SCRIPT = """
+    local window = tonumber(ARGV[2])
+    local now = tonumber(ARGV[1])
+    local index = math.floor(now / window)
+    local current_key = KEYS[1] .. ':' .. index
+    local previous_key = KEYS[1] .. ':' .. (index - 1)
+    local current = tonumber(redis.call('GET', current_key) or '0')
+    local previous = tonumber(redis.call('GET', previous_key) or '0')
+    local elapsed = (now - index * window) / window
+    if previous * (1 - elapsed) + current >= tonumber(ARGV[3]) then
+        return 0
+    end
+    redis.call('INCR', current_key)
+    redis.call('EXPIRE', current_key, window * 2)
+    return 1
+    """
+    
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.script = redis_client.register_script(self.SCRIPT)
+    
+    def hit(self, key: str, max_requests: int, window_seconds: int, now: float) -> bool:
+        return bool(self.script(keys=[f"ratelimit:{key}"], args=[now, window_seconds, max_requests]))
+
 class RateLimiter:
-    def __init__(self):
-        self.requests = defaultdict(list)
+    def __init__(self, backend=None, fallback=None):
+        self.backend = backend or InMemoryRateLimitBackend()
+        self.fallback = fallback
+        self._backend_down = False
     
     def check_rate_limit(self, key: str, max_requests: int, window_seconds: int) -> bool:
         """Check if request is within rate limit"""
         now = time.time()
-        window_start = now - window_seconds
-        
-        # Clean old requests
-        self.requests[key] = [req_time for req_time in self.requests[key] if req_time > window_start]
-        
-        if len(self.requests[key]) >= max_requests:
-            return False
-        
-        self.requests[key].append(now)
-        return True
+        try:
+            allowed = self.backend.hit(key, max_requests, window_seconds, now)
+        except Exception as e:
+            if self.fallback is None:
+                raise
+            # One line per outage, not one per request
+            if not self._backend_down:
+                self._backend_down = True
+                print(f"⚠️ Rate limit backend error, using local limits until it recovers: {e}")
+            return self.fallback.hit(key, max_requests, window_seconds, now)
+        if self._backend_down:
+            self._backend_down = False
+            print("✅ Rate limit backend recovered")
+        return allowed
 
-rate_limiter = RateLimiter()
+def create_rate_limiter() -> RateLimiter:
+    settings = get_settings()
+    
+    local_backend = InMemoryRateLimitBackend(max_keys=settings.RATE_LIMIT_MAX_KEYS)
+    if settings.REDIS_URL:
+        import redis
+        return RateLimiter(
+            backend=RedisRateLimitBackend(redis.Redis.from_url(settings.REDIS_URL)),
+            fallback=local_backend
+        )
+    return RateLimiter(backend=local_backend)
+
+rate_limiter = create_rate_limiter()
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after a per-entry TTL"""
+    
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+    
+    def set(self, key, value, ttl: float = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[0]
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def items(self) -> list:
+        """Snapshot of live (key, value) pairs"""
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value) for key, (value, expires_at) in self._data.items() if expires_at > now]
+    
+    def __len__(self):
+        return len(self._data)
 
 def calculate_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     """Calculate distance between two coordinates in kilometers"""
     return geodesic((lat1, lon1), (lat2, lon2)).kilometers
 
+EARTH_RADIUS_KM = 6371.0088
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_PRECISION = 8
+
+def encode_geohash(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    """Encode coordinates as a geohash string"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    
+    while len(geohash) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if longitude >= mid:
+                bits = (bits << 1) | 1
+                lon_range[0] = mid
+            else:
+                bits = bits << 1
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if latitude >= mid:
+                bits = (bits << 1) | 1
+                lat_range[0] = mid
+            else:
+                bits = bits << 1
+                lat_range[1] = mid
+        even = not even
+        bit_count += 1
+        
+        if bit_count == 5:
+            geohash.append(GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    
+    return "".join(geohash)
+
+def bounding_box(latitude: float, longitude: float, radius_km: float) -> Tuple[float, float, float, float]:
+    """Return (min_lat, max_lat, min_lon, max_lon) enclosing a radius around a point"""
+    lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    min_lat = max(latitude - lat_delta, -90.0)
+    max_lat = min(latitude + lat_delta, 90.0)
+    
+    # Near the poles the box covers every longitude
+    if max_lat >= 90.0 or min_lat <= -90.0:
+        return min_lat, max_lat, -180.0, 180.0
+    
+    lon_delta = math.degrees(radius_km / (EARTH_RADIUS_KM * math.cos(math.radians(latitude))))
+    if lon_delta >= 180.0:
+        return min_lat, max_lat, -180.0, 180.0
+    return min_lat, max_lat, longitude - lon_delta, longitude + lon_delta
+
+def geohash_cells_for_bbox(min_lat: float, max_lat: float, min_lon: float, max_lon: float, max_cells: int = 32) -> List[str]:
+    """Return geohash prefixes covering a bounding box, using the finest precision that stays under max_cells"""
+    if min_lon < -180.0 or max_lon > 180.0:
+        # Box wraps the antimeridian; callers fall back to the plain bounding box
+        return []
+    
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        step_lat = 180.0 / (2 ** ((5 * precision) // 2))
+        step_lon = 360.0 / (2 ** ((5 * precision + 1) // 2))
+        rows = int((max_lat - min_lat) / step_lat) + 2
+        cols = int((max_lon - min_lon) / step_lon) + 2
+        if rows * cols > max_cells:
+            continue
+        
+        cells = set()
+        lat = min_lat
+        while True:
+            lon = min_lon
+            while True:
+                cells.add(encode_geohash(min(lat, max_lat), min(lon, max_lon), precision))
+                if lon >= max_lon:
+                    break
+                lon = min(lon + step_lon, max_lon)
+            if lat >= max_lat:
+                break
+            lat = min(lat + step_lat, max_lat)
+        return sorted(cells)
+    return []
+
+def haversine_distances(latitude: float, longitude: float, points: Sequence[Tuple[float, float]]) -> List[float]:
+    """Great-circle distances in kilometers from one origin to many (lat, lon) points"""
+    lat1 = math.radians(latitude)
+    lon1 = math.radians(longitude)
+    cos_lat1 = math.cos(lat1)
+    sin = math.sin
+    cos = math.cos
+    asin = math.asin
+    sqrt = math.sqrt
+    radians = math.radians
+    
+    distances = []
+    for lat2, lon2 in points:
+        lat2 = radians(lat2)
+        half_dlat = (lat2 - lat1) / 2
+        half_dlon = (radians(lon2) - lon1) / 2
+        a = sin(half_dlat) ** 2 + cos_lat1 * cos(lat2) * sin(half_dlon) ** 2
+        distances.append(2 * EARTH_RADIUS_KM * asin(sqrt(min(a, 1.0))))
+    return distances
+
+def backfill_book_geohashes(db) -> int:
+    """Fill in geohash for books created before the column existed"""
+    from database import Book
+    
+    books = db.query(Book.id, Book.latitude, Book.longitude).filter(Book.geohash.is_(None)).all()
+    for book_id, latitude, longitude in books:
+        db.query(Book).filter(Book.id == book_id).update(
+            {Book.geohash: encode_geohash(latitude, longitude)},
+            synchronize_session=False
+        )
+    db.commit()
+    return len(books)
+
+# InnoDB ignores tokens shorter than innodb_ft_min_token_size (3 by default)
+FULLTEXT_MIN_TOKEN_LENGTH = 3
+FULLTEXT_MAX_TOKENS = 10
+
+def fulltext_boolean_query(search: str) -> str:
+    """Build a MySQL boolean-mode FULLTEXT query matching any search token as a prefix.
+    
+    Returns an empty string when no token is long enough to be indexed.
+    """
+    tokens = []
+    for token in re.findall(r"\w+", search.lower()):
+        if len(token) >= FULLTEXT_MIN_TOKEN_LENGTH and token not in tokens:
+            tokens.append(token)
+    return " ".join(f"{token}*" for token in tokens[:FULLTEXT_MAX_TOKENS])
+
+def _cursor_default(value):
+    if isinstance(value, datetime):
+        return {"$dt": value.isoformat()}
+    raise TypeError(f"Cannot encode {type(value).__name__} in cursor")
+
+def _cursor_object_hook(obj):
+    if "$dt" in obj:
+        return datetime.fromisoformat(obj["$dt"])
+    return obj
+
+def encode_cursor(values: Sequence) -> str:
+    """Encode sort-key values as an opaque, URL-safe pagination cursor"""
+    raw = json.dumps(list(values), default=_cursor_default, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, size: int) -> list:
+    """Decode a cursor produced by encode_cursor, expecting `size` sort-key values"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw, object_hook=_cursor_object_hook)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def decode_keyset_cursor(cursor: str, order_columns: Sequence) -> list:
+    """Decode a keyset cursor, rejecting values whose types don't match the sort columns"""
+    values = decode_cursor(cursor, len(order_columns))
+    for column, value in zip(order_columns, values):
+        # Cursors are client-supplied: a tampered one must not reach the SQL comparison
+        if isinstance(value, bool) or not isinstance(value, column.type.python_type):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def keyset_filter(order_columns: Sequence, values: Sequence, descending: bool = True):
+    """Filter selecting rows strictly after `values` in (c1, c2, ...) order"""
+    clauses = []
+    for idx, column in enumerate(order_columns):
+        after = column < values[idx] if descending else column > values[idx]
+        equal_prefix = [order_columns[i] == values[i] for i in range(idx)]
+        clauses.append(and_(*equal_prefix, after) if equal_prefix else after)
+    return or_(*clauses)
+
+def paginate_keyset(
+    query,
+    order_columns: Sequence,
+    cursor: Optional[str],
+    limit: int,
+    skip: int = 0,
+    descending: bool = True
+) -> Tuple[list, Optional[str]]:
+    """Return one page of `query` plus the cursor for the next page.
+    
+    With a cursor the page starts right after the encoded sort key, otherwise
+    `skip` is applied as a plain offset for older clients.
+    """
+    ordering = [column.desc() if descending else column.asc() for column in order_columns]
+    if cursor:
+        query = query.filter(keyset_filter(order_columns, decode_keyset_cursor(cursor, order_columns), descending))
+        query = query.order_by(*ordering)
+    else:
+        query = query.order_by(*ordering).offset(skip)
+    rows = query.limit(limit).all()
+    
+    next_cursor = None
+    if rows and len(rows) == limit:
+        last = rows[-1]
+        next_cursor = encode_cursor([getattr(last, column.key) for column in order_columns])
+    return rows, next_cursor
+
+def offset_cursor_page(cursor: Optional[str], skip: int) -> int:
+    """Resolve the start offset for endpoints whose cursor wraps a plain offset"""
+    if not cursor:
+        return skip
+    offset = decode_cursor(cursor, 1)[0]
+    if not isinstance(offset, int) or offset < 0:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return offset
+
 def is_within_radius(lat1: float, lon1: float, lat2: float, lon2: float, radius_km: float) -> bool:
     """Check if two locations are within specified radius"""
     distance = calculate_distance(lat1, lon1, lat2, lon2)
     return distance <= radius_km
 
-def reset_daily_counter_if_needed(user, field_name: str, reset_date_field: str):
-    """Reset daily counter if date has changed"""
-    now = datetime.utcnow()
-    reset_date = getattr(user, reset_date_field)
+MB = 1024 * 1024
+# Room for multipart boundaries and the other form fields on top of the file limits
+UPLOAD_FORM_OVERHEAD_BYTES = 64 * 1024
+MAX_FORM_FIELD_BYTES = 32 * 1024
+
+def remove_temp_file(path: Optional[str]):
+    """Delete a spooled upload file, ignoring files that are already gone"""
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class StreamingUploadParser:
+    """Parses a multipart/form-data body as it arrives, spooling one file field to disk.
+    
+    Only the chunk being parsed is held in memory. The file part is hashed
+    and written to a temp file, and parsing stops with 400 as soon as it
+    passes `max_bytes`, without reading the rest of the body. Text fields
+    are kept, up to MAX_FORM_FIELD_BYTES each. After `parse`, `path` holds
+    the file (the caller removes it), with `filename`, `content_type`,
+    `size` and `sha256` describing it.
+    """
+    
+    def __init__(self, file_field: str, max_bytes: int, suffix: str = ""):
+        self.file_field = file_field
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.fields = {}
+        self.path = None
+        self.filename = None
+        self.content_type = None
+        self.size = 0
+        self.sha256 = None
+        self._digest = hashlib.sha256()
+        self._file_chunks = []
+        self._headers = {}
+        self._header_name = b""
+        self._header_value = b""
+        self._field_name = None
+        self._field_data = bytearray()
+        self._in_file = False
     
-    if reset_date.date() < now.date():
-        setattr(user, field_name, 0)
-        setattr(user, reset_date_field, now)
-        return True
-    return False
+    def on_part_begin(self):
+        self._headers = {}
+        self._field_data = bytearray()
+        self._in_file = False
+    
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+    
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+    
+    def on_header_end(self):
+        self._headers[self._header_name.lower()] = self._header_value
+        self._header_name = self._header_value = b""
+    
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._field_name = options.get(b"name", b"").decode("utf-8", "replace")
+        if b"filename" in options:
+            if self._field_name != self.file_field or self.filename is not None:
+                raise HTTPException(status_code=400, detail=f"Unexpected file field '{self._field_name}'")
+            self._in_file = True
+            self.filename = options[b"filename"].decode("utf-8", "replace")
+            self.content_type = self._headers.get(b"content-type", b"").decode("latin-1")
+    
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self._in_file:
+            self.size += end - start
+            if self.size > self.max_bytes:
+                raise HTTPException(status_code=400, detail=f"File too large (max {self.max_bytes // MB}MB)")
+            chunk = data[start:end]
+            self._digest.update(chunk)
+            self._file_chunks.append(chunk)
+        else:
+            self._field_data += data[start:end]
+            if len(self._field_data) > MAX_FORM_FIELD_BYTES:
+                raise HTTPException(status_code=400, detail=f"Form field '{self._field_name}' is too long")
+    
+    def on_part_end(self):
+        if not self._in_file:
+            self.fields[self._field_name] = self._field_data.decode("utf-8", "replace")
+    
+    async def parse(self, request):
+        """Consume `request.stream()`; on error the temp file is already removed"""
+        content_type, params = parse_options_header(request.headers.get("content-type", ""))
+        boundary = params.get(b"boundary")
+        if content_type != b"multipart/form-data" or not boundary:
+            raise HTTPException(status_code=400, detail="Expected a multipart/form-data body")
+        
+        parser = MultipartParser(boundary, {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished
+        })
+        fd, self.path = tempfile.mkstemp(prefix="noteshub-", suffix=self.suffix)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                async for chunk in request.stream():
+                    parser.write(chunk)
+                    if self._file_chunks:
+                        chunks, self._file_chunks = self._file_chunks, []
+                        await run_in_threadpool(out.writelines, chunks)
+            parser.finalize()
+        except BaseException:
+            remove_temp_file(self.path)
+            self.path = None
+            raise
+        self.sha256 = self._digest.hexdigest()
+
+async def read_upload_limited(upload, max_bytes: int) -> Optional[bytes]:
+    """Read an UploadFile in chunks, giving up (None) once it passes `max_bytes`"""
+    chunk_size = get_settings().UPLOAD_CHUNK_SIZE_KB * 1024
+    chunks = []
+    size = 0
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            return None
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+class UploadSizeLimitMiddleware:
+    """Cap upload request bodies at the route's limit.
+    
+    A Content-Length over the limit is refused with 413 before anything is
+    read. Bodies without one (chunked) or that turn out longer than declared
+    are counted as they are received and fail with 413 once they pass it.
+    """
+    
+    def __init__(self, app, limits: dict):
+        self.app = app
+        self.limits = limits
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST":
+            max_bytes = self.limits.get(scope["path"])
+            if max_bytes is not None:
+                max_body = max_bytes + UPLOAD_FORM_OVERHEAD_BYTES
+                content_length = dict(scope["headers"]).get(b"content-length", b"")
+                if content_length.isdigit() and int(content_length) > max_body:
+                    body = json.dumps({"detail": f"Upload too large (max {max_bytes // MB}MB)"}).encode()
+                    await send({
+                        "type": "http.response.start",
+                        "status": 413,
+                        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+                    })
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                receive = self._limited_receive(receive, max_body, max_bytes)
+        await self.app(scope, receive, send)
+    
+    @staticmethod
+    def _limited_receive(receive, max_body: int, max_bytes: int):
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_body:
+                    # Raised inside the app, so the exception handlers turn it into the response
+                    raise HTTPException(status_code=413, detail=f"Upload too large (max {max_bytes // MB}MB)")
+            return message
+        return limited_receive
+
+async def run_periodically(interval_seconds: float, job: Callable, name: str):
+    """Run a blocking job in a worker thread every `interval_seconds` until cancelled"""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await asyncio.to_thread(job)
+        except Exception as e:
+            print(f"❌ {name} failed: {e}")
+